@@ -1,26 +1,101 @@
 # app.py  ―― メール機能を除去した最小構成
-from flask import Flask, render_template
-
-# 各種 Blueprint をインポート
-from blueprints.dashboard import dashboard_bp
-from blueprints.auth import auth
-from blueprints.user_mgmt import user_mgmt_bp
-from estimate import estimate_blueprint
-from blueprints.export import export_bp
-
-app = Flask(__name__)
-app.secret_key = 'your_secret_key'      # セッション用シークレット
-
-# Blueprint 登録
-app.register_blueprint(auth, url_prefix='')
-app.register_blueprint(dashboard_bp, url_prefix='/dashboard')
-app.register_blueprint(user_mgmt_bp, url_prefix='/user_mgmt')
-app.register_blueprint(estimate_blueprint, url_prefix='/estimate')
-app.register_blueprint(export_bp)
-
-@app.route('/')
-def index():
-    return render_template('login.html')
+#
+# アプリは create_app() で組み立てる。一括出力（blueprints/export.py）のワーカーは spawn で
+# 起動し、spawn の子は起動元のこのファイルを __mp_main__ として実行し直すので、
+# そこでは何も組み立てない（Blueprint の import も create_app() の中で行う）。
+from flask import Flask, render_template, session, jsonify
+
+import config
+
+
+def _stats_denied():
+    """運用確認用の /stats/* は config.ADMIN_USER_IDS のユーザーだけ（それ以外はエラー応答を返す）。"""
+    if 'user_id' not in session:
+        return jsonify({"error": "ログインが必要です。"}), 401
+    if session['user_id'] not in config.ADMIN_USER_IDS:
+        return jsonify({"error": "権限がありません。"}), 403
+    return None
+
+
+def create_app() -> Flask:
+    # 各種 Blueprint をインポート
+    from blueprints.dashboard import dashboard_bp, estimate_writer
+    from blueprints.auth import auth
+    from blueprints.user_mgmt import user_mgmt_bp
+    from estimate import estimate_blueprint
+    from blueprints.export import export_bp
+    from blueprints.dump import dump_bp
+    from blueprints.presets import presets_bp
+    from blueprints.profiles import profiles_bp
+    from session_store import init_session_store
+    from db import init_db, pool_stats
+    from migrations import init_schema
+    from repository import init_repository
+    from job_queue import init_job_queue
+    from export_store import init_export_store
+    from password_hasher import hasher
+    from assets import init_assets
+    from profiles import init_profiles
+
+    app = Flask(__name__)
+    app.secret_key = 'your_secret_key'      # セッション用シークレット
+    init_session_store(app)                 # dashboard_data などはサーバー側に保存
+    init_db(app)                            # リクエスト単位の DB 接続をプールへ返却
+    init_schema(app)                        # スキーマが古ければ起動しない（DDL はここでだけ流す）
+    init_repository(app)                    # users のカラム構成を調べて SQL を組み立てておく
+    init_job_queue(app)                     # Excel 出力などをリクエストの外で実行
+    init_export_store(app)                  # 出力ファイルは内容ハッシュで 1 つだけ保存
+    init_assets(app)                        # static/dist/（python assets.py）があればハッシュ付き + 事前圧縮で配信
+    init_profiles(app)                      # 係数プロファイルをメモリに読み、変更を監視（計算のたびに DB は読まない）
+
+    # Blueprint 登録
+    app.register_blueprint(auth, url_prefix='')
+    app.register_blueprint(dashboard_bp, url_prefix='/dashboard')
+    app.register_blueprint(user_mgmt_bp, url_prefix='/user_mgmt')
+    app.register_blueprint(estimate_blueprint, url_prefix='/estimate')
+    app.register_blueprint(export_bp)
+    app.register_blueprint(dump_bp)
+    app.register_blueprint(presets_bp)
+    app.register_blueprint(profiles_bp)
+
+    @app.route('/')
+    def index():
+        return render_template('login.html')
+
+    @app.route('/stats/db')
+    def db_stats():
+        """DB コネクションプールの状況（運用確認用）"""
+        denied = _stats_denied()
+        if denied:
+            return denied
+        return jsonify(pool_stats())
+
+    @app.route('/stats/writers')
+    def writer_stats():
+        """write-behind（履歴・見積り）のキューの深さとフラッシュ時間（運用確認用）"""
+        denied = _stats_denied()
+        if denied:
+            return denied
+        writers = {
+            "excel_history": app.extensions.get('history_writer'),
+            "estimates": estimate_writer,
+        }
+        return jsonify({name: w.stats() for name, w in writers.items() if w is not None})
+
+    @app.route('/stats/auth')
+    def auth_stats():
+        """パスワードハッシュ計算の待ち時間・計算時間・拒否数（運用確認用）"""
+        denied = _stats_denied()
+        if denied:
+            return denied
+        return jsonify(hasher.stats())
+
+    return app
+
+
+# spawn の子プロセス（__mp_main__）ではアプリを組み立てない
+if __name__ != '__mp_main__':
+    app = create_app()
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,191 @@
+# assets.py ―― 静的ファイルのビルド（ハッシュ付きファイル名 + 事前圧縮 + サムネイル）
+#
+#   python assets.py    static/{css,js,img} から static/dist/ を作る（デプロイ時に 1 回）
+#
+# ・ファイル名に内容ハッシュを入れる（css/style.css → dist/css/style.3f2a1b4c.css）。
+#   中身が変われば名前も変わるので、ブラウザには 1 年キャッシュ + immutable を返せる
+# ・css / js は .gz と .br（brotli が入っていれば）も作り、Accept-Encoding に合わせて返す
+# ・img/ の画像は表示サイズの AVIF / WebP サムネイルを作る（Pillow が入っていれば）
+# 対応表は static/dist/manifest.json。init_assets(app) がこれを読み、
+# url_for('static', filename=...) をハッシュ付きの名前に差し替える。
+# manifest が無ければ何もしない（開発時は今までどおり元のファイルを返す）。
+# 古いハッシュのファイルは消さない（デプロイ直後に古い HTML から参照されても返せるように）。
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+from io import BytesIO
+
+from flask import request, send_file, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+import config
+
+try:
+    import brotli
+except ImportError:         # brotli が無ければ .gz だけ作る
+    brotli = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:         # Pillow が無ければサムネイルは作らない
+    Image = ImageOps = None
+
+DIST_DIR = 'dist'
+SOURCE_DIRS = ('css', 'js', 'img')
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json')
+THUMBNAIL_SOURCES = ('.png', '.jpg', '.jpeg')
+# (Accept-Encoding の値, 拡張子)。先にあるものを優先する
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+# ----------------- ビルド ----------------- #
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def _write(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _compress(static_folder: str, out: str, data: bytes):
+    """out の .gz / .br を作る（元より小さくならなければ作らない）。"""
+    variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data, quality=11)))
+    for suffix, compressed in variants:
+        if len(compressed) < len(data):
+            _write(os.path.join(static_folder, out + suffix), compressed)
+
+
+def _thumbnails(static_folder: str, rel: str, data: bytes, digest: str) -> dict:
+    """{"avif": [[path, width], ...], "webp": [...]}。この Pillow で書けない形式は省く。"""
+    base = os.path.splitext(rel)[0]
+    variants = {}
+    with Image.open(BytesIO(data)) as im:
+        im = im.convert('RGBA')
+        for fmt, ext in (('AVIF', 'avif'), ('WEBP', 'webp')):
+            entries = []
+            for size in config.ASSET_THUMB_SIZES:
+                # CSS（object-fit: cover の正方形）と同じ切り抜き
+                thumb = ImageOps.fit(im, (size, size), Image.LANCZOS)
+                buf = BytesIO()
+                try:
+                    thumb.save(buf, fmt, quality=config.ASSET_THUMB_QUALITY)
+                except (KeyError, OSError):
+                    break
+                out = f"{DIST_DIR}/{base}.{size}.{digest}.{ext}"
+                _write(os.path.join(static_folder, out), buf.getvalue())
+                entries.append([out, size])
+            if entries:
+                variants[ext] = entries
+    return variants
+
+
+def build(static_folder: str, verbose: bool = False) -> dict:
+    """static_folder/dist/ にビルドし、manifest を返す。"""
+    manifest = {"files": {}, "images": {}}
+    for sub in SOURCE_DIRS:
+        for root, _, names in os.walk(os.path.join(static_folder, sub)):
+            for name in sorted(names):
+                src = os.path.join(root, name)
+                rel = os.path.relpath(src, static_folder).replace(os.sep, '/')
+                ext = os.path.splitext(name)[1].lower()
+                with open(src, 'rb') as f:
+                    data = f.read()
+                digest = _digest(data)
+                out = f"{DIST_DIR}/{os.path.splitext(rel)[0]}.{digest}{ext}"
+                _write(os.path.join(static_folder, out), data)
+                if ext in COMPRESSIBLE:
+                    _compress(static_folder, out, data)
+                manifest["files"][rel] = out
+                if ext in THUMBNAIL_SOURCES and Image is not None:
+                    manifest["images"][rel] = _thumbnails(static_folder, rel, data, digest)
+                if verbose:
+                    print(f"{rel} -> {out}")
+    _write(os.path.join(static_folder, DIST_DIR, 'manifest.json'),
+           json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+# ----------------- 配信 ----------------- #
+def _send_hashed(static_folder: str, filename: str):
+    """ハッシュ付きファイル。事前圧縮版があれば Accept-Encoding に合わせて返す。"""
+    path = safe_join(static_folder, filename)
+    response = None
+    if path is not None:
+        for encoding, suffix in ENCODINGS:
+            if request.accept_encodings[encoding] and os.path.isfile(path + suffix):
+                response = send_file(
+                    path + suffix,
+                    mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                    conditional=True,
+                )
+                response.headers['Content-Encoding'] = encoding
+                break
+    if response is None:
+        response = send_from_directory(static_folder, filename)
+    response.headers['Cache-Control'] = f"public, max-age={config.ASSET_MAX_AGE}, immutable"
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def _srcset(entries) -> str:
+    return ", ".join(f"{url_for('static', filename=path)} {width}w" for path, width in entries)
+
+
+def init_assets(app):
+    """
+    static/dist/manifest.json があれば、url_for('static', ...) をハッシュ付きの名前にし、
+    それらを事前圧縮 + immutable で返す。テンプレートには static_images() を渡す
+    （{元のパス: {"src", "avif", "webp"}}。<picture> の srcset 用）。
+    """
+    manifest_path = os.path.join(app.static_folder, DIST_DIR, 'manifest.json')
+    manifest = {"files": {}, "images": {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    files = manifest["files"]
+    hashed = set(files.values()) | {
+        path for variants in manifest["images"].values()
+        for entries in variants.values() for path, _ in entries
+    }
+    app.extensions['asset_manifest'] = manifest
+
+    def static_images() -> dict:
+        return {
+            rel: {"src": url_for('static', filename=rel),
+                  **{fmt: _srcset(entries) for fmt, entries in variants.items()}}
+            for rel, variants in manifest["images"].items()
+        }
+
+    app.jinja_env.globals['static_images'] = static_images
+    if not files:
+        return
+
+    @app.url_defaults
+    def _hashed_static(endpoint, values):
+        if endpoint == 'static' and values.get('filename') in files:
+            values['filename'] = files[values['filename']]
+
+    serve_plain = app.view_functions['static']
+
+    def static(filename):
+        if filename in hashed:
+            return _send_hashed(app.static_folder, filename)
+        return serve_plain(filename=filename)
+
+    app.view_functions['static'] = static
+
+
+if __name__ == '__main__':
+    import sys
+    static_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    result = build(static_folder, verbose='-q' not in sys.argv[1:])
+    print(f"built {len(result['files'])} file(s), {len(result['images'])} image(s) with thumbnails")
@@ -1,7 +1,7 @@
 # auth.py
 from flask import Blueprint, render_template, request, session, redirect, url_for
-from db import get_connection, get_account_column
-from passlib.hash import bcrypt_sha256
+from repository import get_repository
+from password_hasher import hasher, login_throttle, HasherBusy
 
 # Blueprint の作成（'auth' が Blueprint 名、__name__ はモジュール名）
 auth = Blueprint('auth', __name__)
@@ -15,20 +15,31 @@ def login():
         password = request.form.get('password')
         if not account_name or not password:
             return "アカウント名 / パスワードを入力してください。"
-        account_col = get_account_column()
-        conn = get_connection()
-        user = None
-        with conn.cursor() as cursor:
-            sql = f"SELECT * FROM users WHERE {account_col}=%s"
-            cursor.execute(sql, (account_name,))
-            user = cursor.fetchone()
-        conn.close()
-        if user and bcrypt_sha256.verify(password, user['password_hash']):
+        # 続けて失敗しているアカウントはハッシュ計算の前に断る
+        retry_after = login_throttle.retry_after(account_name)
+        if retry_after:
+            return "ログイン失敗: 試行回数が多すぎます。しばらくしてから再度お試しください。", 429, \
+                {"Retry-After": str(retry_after)}
+        repo = get_repository()
+        user = repo.find_user_for_login(account_name)
+        try:
+            ok = bool(user) and hasher.verify(password, user['password_hash'])
+        except HasherBusy:
+            return "混み合っています。しばらくしてから再度お試しください。", 503, {"Retry-After": "1"}
+        if ok:
+            login_throttle.succeed(account_name)
+            # 古いコストのハッシュは裏で作り直す（応答は待たせない）
+            if hasher.needs_update(user['password_hash']):
+                user_id = user['id']
+                hasher.upgrade_later(
+                    password, lambda new_hash: repo.update_password_hash(user_id, new_hash)
+                )
             session.clear()
             session['user_id'] = user['id']
-            session['account_name'] = user.get(account_col, account_name)
+            session['account_name'] = user.get('account_name') or account_name
             return redirect(url_for('dashboard.dashboard'))
         else:
+            login_throttle.fail(account_name)
             return "ログイン失敗: アカウント名またはパスワードが違います。"
 
 @auth.route('/register', methods=['GET', 'POST'])
@@ -40,27 +51,19 @@ def register():
         password = request.form.get('password')
         if not account_name or not password:
             return "必須項目が未入力です。"
-        password_hash = bcrypt_sha256.hash(password)
-        account_col = get_account_column()
-        conn = get_connection()
+        repo = get_repository()
         try:
-            with conn.cursor() as cursor:
-                # アカウント名の重複を事前にチェック
-                cursor.execute(f"SELECT id FROM users WHERE {account_col}=%s", (account_name,))
-                if cursor.fetchone():
-                    conn.close()
-                    return "登録に失敗しました。既に使われているアカウント名です。"
-
-                cursor.execute(
-                    f"INSERT INTO users ({account_col}, password_hash) VALUES (%s, %s)",
-                    (account_name, password_hash),
-                )
-            conn.commit()
+            # アカウント名の重複を事前にチェック（重複ならハッシュ計算をしない）
+            if repo.account_exists(account_name):
+                return "登録に失敗しました。既に使われているアカウント名です。"
+            try:
+                password_hash = hasher.hash(password)
+            except HasherBusy:
+                return "混み合っています。しばらくしてから再度お試しください。", 503, {"Retry-After": "1"}
+            repo.create_user(account_name, password_hash)
         except Exception:
             # 例外内容は伏せ、一般的なエラーとして扱う
-            conn.close()
             return "登録に失敗しました。管理者にお問い合わせください。"
-        conn.close()
         return redirect(url_for('auth.login'))
 
 @auth.route('/logout')
@@ -1,46 +1,49 @@
 # blueprints/dashboard.py
 
-from flask import Blueprint, request, session, render_template, jsonify
+from flask import Blueprint, Response, request, session, render_template, jsonify
+import csv
+import io
 import json
-from db import get_connection
+from functools import lru_cache
+import numpy as np
+import config
+import secrets
+from calc_cache import ResultCache, StateStore, make_key
+from formula_spec import (
+    INPUT_PARSERS, SECTIONS, SPEC, CompiledFormula, VectorFormula,
+    _round0, safe_float, section_dependencies, spec_flags,
+)
+from profiles import DEFAULT_PROFILE, Profile, profile_cache
+from repository import get_repository
+from write_behind import CoalescingWriter
 
-######################################
-# 定数・係数
-######################################
-DOHDAI_COEFFICIENT       = 0.042
-DRYING_FUEL_COEFFICIENT  = 0.025
-BISQUE_FUEL_COEFFICIENT  = 0.04
-HASSUI_COEFFICIENT       = 0.04
-PAINT_COEFFICIENT        = 0.05
-FIRING_GAS_CONSTANT      = 370
-MOLD_DIVISOR             = 100
-HOURLY_WAGE              = 3000
+# バッチ計算で 1 リクエストあたりに受け付ける最大行数
+BATCH_MAX_ROWS           = 20000
+# what-if スイープで 1 リクエストあたりに計算する最大格子点数
+SWEEP_MAX_POINTS         = 1_000_000
 
 
 dashboard_bp = Blueprint('dashboard', __name__)
 
+# /dashboard/calculate の結果キャッシュ（キーは解析済み入力 + include フラグ）
+calc_cache = ResultCache(
+    maxsize=config.CALC_CACHE_MAXSIZE,
+    ttl=config.CALC_CACHE_TTL,
+    shared_path=config.CALC_CACHE_SHARED_PATH,
+)
 
+# /dashboard/calculate/delta の直近状態（トークンごと）
+delta_states = StateStore(
+    maxsize=config.DELTA_STATE_MAXSIZE,
+    ttl=config.DELTA_STATE_TTL,
+    shared_path=config.DELTA_STATE_SHARED_PATH,
+)
 
 
-# ----------------- 共通ヘルパ ----------------- #
-def safe_float(val: str | None) -> float:
-    """
-    '', None や空白文字列を 0.0 に変換して float を返す。
-    数値化できない文字列も 0.0 にフォールバックする。
-    """
-    try:
-        return float(val) if val not in (None, '', ' ') else 0.0
-    except ValueError:
-        return 0.0
 
 
-
-def safe_div(numerator: float, denominator: float) -> float:
-    """
-    denominator<=0 の場合 0.0 を返す（0除算回避）。
-    """
-    return numerator / denominator if denominator > 0 else 0.0
-    
+# ----------------- 共通ヘルパ ----------------- #
+# safe_float は式グラフと共有するため formula_spec にある
 # --------------------------------------------- #
 
 
@@ -55,455 +58,447 @@ def format_thousand(value):
         return value
 
 
-def round_values_in_dict(data, digits=0):
-    for key, val in data.items():
-        if isinstance(val, float):
-            data[key] = round(val, digits)
-    return data
+# ----------------- バッチ計算（NumPy 列演算） ----------------- #
+# 各行はフォームと同じキー（sales_price, include_dohdai ...）を持つ dict。
+# 入力の検証は 1 行ずつ INPUT_PARSERS で行い、原価計算そのものは
+# formula_spec.VectorFormula で同じ SPEC を列（np.ndarray）単位でまとめて評価する。
+# include_* も列なので、フラグの組み合わせが行ごとに違っても 1 回の評価で済む。
+
+# SPEC の群の項目と式が参照する include_* フラグ（並び順は項目の順）
+INCLUDE_FLAGS = spec_flags(SPEC)
+
+# dashboard_data が入力値をそのまま返すキー（並び順も同じ）
+_INPUT_NAMES = {name for name, _ in SPEC["inputs"]}
+DASHBOARD_INPUT_KEYS = tuple(key for key in SPEC["outputs"] if key in _INPUT_NAMES)
 
-def parse_input_data(req):
+# JSON / CSV でチェックボックスを「外した」とみなす値
+_FALSE_FLAG_VALUES = ('', '0', 'false', 'off', 'no')
+
+
+def _normalize_batch_row(row: dict) -> dict:
+    """
+    JSON / CSV の 1 行をフォームと同じ形（値は文字列、チェック済みは 'on'）に揃える。
+    """
+    form = {}
+    for key, val in row.items():
+        if key is None:
+            continue
+        if key in INCLUDE_FLAGS:
+            if val is None or val is False or str(val).strip().lower() in _FALSE_FLAG_VALUES:
+                continue
+            form[key] = 'on'
+        else:
+            form[key] = '' if val is None else str(val)
+    return form
+
+
+def read_batch_rows(req) -> list[dict]:
+    """
+    JSON（配列 または {"rows": [...]}）か CSV（本文 または file フィールド）を読み込む。
+    """
+    upload = req.files.get('file')
+    if upload is not None:
+        text = upload.read().decode('utf-8-sig')
+        rows = list(csv.DictReader(io.StringIO(text)))
+    elif req.is_json:
+        payload = req.get_json(silent=True)
+        rows = payload.get('rows') if isinstance(payload, dict) else payload
+        if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+            raise ValueError("rows は オブジェクトの配列で指定してください。")
+    else:
+        text = req.get_data(as_text=True).lstrip('\ufeff')
+        rows = list(csv.DictReader(io.StringIO(text)))
+
+    if len(rows) > BATCH_MAX_ROWS:
+        raise ValueError(f"一度に計算できるのは {BATCH_MAX_ROWS} 行までです。")
+    return [_normalize_batch_row(r) for r in rows]
+
+
+@lru_cache(maxsize=64)
+def compile_vector_model(constants: tuple = DEFAULT_PROFILE.key) -> VectorFormula:
+    """係数プロファイルごとの VectorFormula をメモ化して返す（include_* は実行時の列）。"""
+    return VectorFormula(SPEC, dict(constants))
+
+
+def _price_column(forms: list[dict], name: str):
+    """price 項目の列と、float にできない（スカラー版なら ValueError になる）行の bool 配列。"""
+    values = np.zeros(len(forms))
+    invalid = np.zeros(len(forms), dtype=bool)
+    for i, form in enumerate(forms):
+        try:
+            values[i] = float(form.get(name, '0') or 0)
+        except (TypeError, ValueError):
+            invalid[i] = True
+    return values, invalid
+
+
+def _scalar_error(form, profile) -> str | None:
+    """_compute_dashboard_data がこの行で出すエラーの文言（エラーにならなければ None）。"""
     try:
-        client_name     = req.get('client_name', '').strip()
-        # Excel テンプレートに既に「様」があるため、入力で重複しないよう末尾の「様」を除外
-        client_name     = client_name.removesuffix('様').strip()
-        subject         = req.get('subject', '').strip()
-        sales_price     = float(req.get('sales_price', '').strip())
-        order_quantity  = int(req.get('order_quantity', '').strip())
-        product_weight  = float(req.get('product_weight', '').strip())
-        mold_unit_price = float(req.get('mold_unit_price', '').strip())
-        mold_count      = int(req.get('mold_count', '').strip())
-        glaze_cost      = float(req.get('glaze_cost', '').strip())
-        poly_count      = int(req.get('poly_count', '').strip())
-        kiln_count      = int(req.get('kiln_count', '').strip())
-        gas_unit_price  = float(req.get('gas_unit_price', '').strip())
-        loss_defective  = float(req.get('loss_defective', '').strip())
-    except Exception as e:
-        raise ValueError("入力項目が不十分です: " + str(e))
-
-    return {
-        "client_name": client_name,
-        "subject": subject,
-        "sales_price": sales_price,
-        "order_quantity": order_quantity,
-        "product_weight": product_weight,
-        "mold_unit_price": mold_unit_price,
-        "mold_count": mold_count,
-        "glaze_cost": glaze_cost,
-        "poly_count": poly_count,
-        "kiln_count": kiln_count,
-        "gas_unit_price": gas_unit_price,
-        "loss_defective": loss_defective,
-    }
+        _compute_dashboard_data(form, profile)
+    except (ValueError, ZeroDivisionError) as e:
+        return str(e)
+    return None
 
-def calculate_raw_material_costs(inp, form):
-    include_dohdai          = form.get('include_dohdai')
-    include_kata            = form.get('include_kata')
-    include_drying_fuel     = form.get('include_drying_fuel')
-    include_bisque_fuel     = form.get('include_bisque_fuel')
-    include_hassui          = form.get('include_hassui')
-    include_paint           = form.get('include_paint')
-    include_logo_copper     = form.get('include_logo_copper')
-    include_glaze_material  = form.get('include_glaze_material')
-    include_main_firing_gas = form.get('include_main_firing_gas')
-    include_transfer_sheet  = form.get('include_transfer_sheet')
-
-    sales_price     = inp["sales_price"]
-    order_quantity  = inp["order_quantity"]
-    product_weight  = inp["product_weight"]
-    mold_unit_price = inp["mold_unit_price"]
-    mold_count      = inp["mold_count"]
-    glaze_cost      = inp["glaze_cost"]
-    poly_count      = inp["poly_count"]
-    kiln_count      = inp["kiln_count"]
-    gas_unit_price  = inp["gas_unit_price"]
-
-    dohdai_cost           = 0
-    kata_cost             = 0
-    drying_fuel_cost      = 0
-    bisque_fuel_cost      = 0
-    hassui_cost           = 0
-    paint_cost            = 0
-    logo_copper_cost      = 0
-    glaze_material_cost   = 0
-    main_firing_gas_cost  = 0
-    transfer_sheet_cost   = 0
-
-    copper_unit_price         = 0
-    transfer_sheet_unit_price = 0
-
-    if include_dohdai:
-        dohdai_cost = product_weight * DOHDAI_COEFFICIENT * order_quantity
-
-    if include_kata:
-        if mold_count <= 0:
-            raise ValueError("使用型の数出し数が0以下です。")
-        kata_cost = (mold_unit_price / mold_count) / MOLD_DIVISOR * order_quantity
-
-    if include_drying_fuel:
-        drying_fuel_cost = product_weight * DRYING_FUEL_COEFFICIENT * order_quantity
-
-    if include_bisque_fuel:
-        bisque_fuel_cost = product_weight * BISQUE_FUEL_COEFFICIENT * order_quantity
-
-    if include_hassui:
-        hassui_cost = product_weight * HASSUI_COEFFICIENT * order_quantity
-
-    if include_paint:
-        paint_cost = product_weight * PAINT_COEFFICIENT * order_quantity
-
-    if include_logo_copper:
-        copper_unit_price = float(form.get('copper_unit_price', '0') or 0)
-        logo_copper_cost  = copper_unit_price * order_quantity
-
-    if include_glaze_material:
-        if poly_count <= 0:
-            raise ValueError("ポリの枚数が0以下です。")
-        glaze_material_cost = (glaze_cost / poly_count) * order_quantity
-
-    if include_main_firing_gas:
-        if kiln_count <= 0:
-            raise ValueError("窯入数が0以下です。")
-        main_firing_gas_cost = (gas_unit_price * FIRING_GAS_CONSTANT) / kiln_count * order_quantity
-
-    if include_transfer_sheet:
-        transfer_sheet_unit_price = float(form.get('transfer_sheet_unit_price', '0') or 0)
-        transfer_sheet_cost       = transfer_sheet_unit_price * order_quantity
-
-    genzairyousyoukei_coefficient = (
-    (product_weight * DOHDAI_COEFFICIENT if include_dohdai else 0)
-    + ((mold_unit_price / mold_count / MOLD_DIVISOR) if include_kata and mold_count > 0 else 0)
-    + (product_weight * DRYING_FUEL_COEFFICIENT if include_drying_fuel else 0)
-    + (product_weight * BISQUE_FUEL_COEFFICIENT if include_bisque_fuel else 0)
-    + (product_weight * HASSUI_COEFFICIENT if include_hassui else 0)
-    + (product_weight * PAINT_COEFFICIENT if include_paint else 0)
-    + (copper_unit_price if include_logo_copper else 0)
-    + ((glaze_cost / poly_count) if include_glaze_material and poly_count > 0 else 0)
-    + ((gas_unit_price * FIRING_GAS_CONSTANT / kiln_count) if include_main_firing_gas and kiln_count > 0 else 0)
-    + (transfer_sheet_unit_price if include_transfer_sheet else 0)
-)
 
-    raw_material_cost_total = (
-        dohdai_cost + kata_cost + drying_fuel_cost + bisque_fuel_cost
-        + hassui_cost + paint_cost + logo_copper_cost
-        + glaze_material_cost + main_firing_gas_cost + transfer_sheet_cost
-    )
+def compute_dashboard_batch(forms: list[dict], profile: Profile = DEFAULT_PROFILE) -> list[dict]:
+    """
+    複数行の入力をまとめて計算し、行ごとに _compute_dashboard_data と同じ dict
+    （エラー行は {"error": 同じ例外の文言}）を返す。profile は係数プロファイル。
+    """
+    if not forms:
+        return []
+    model = compile_vector_model(profile.key)
+    n = len(forms)
+
+    # 入力値は 1 行ずつ解析する（読めない行は 0 で埋めて、あとでエラー行にする）
+    parsed, failed = [], np.zeros(n, dtype=bool)
+    numeric = {name: np.zeros(n) for name in model.numeric_inputs}
+    for i, form in enumerate(forms):
+        try:
+            row = {name: parse(form.get(name, '')) for name, parse in INPUT_PARSERS}
+        except Exception:
+            failed[i] = True
+            row = None
+        else:
+            for name in model.numeric_inputs:
+                numeric[name][i] = row[name]
+        parsed.append(row)
+
+    columns, invalid = {}, {}
+    for name in model.field_names:
+        columns[name] = np.array([safe_float(form.get(name)) for form in forms])
+    for name in model.price_names:
+        columns[name], invalid[name] = _price_column(forms, name)
+    flags = {name: np.array([bool(form.get(name)) for form in forms]) for name in model.flags}
+
+    st, errors = model.run(numeric, columns, flags, invalid)
+    failed |= errors
+
+    outputs = {}
+    for key, flag in model.outputs:
+        values = np.round(np.broadcast_to(st[key], (n,)), 0)
+        outputs[key] = (values.tolist(), None if flag is None else flags[flag])
+
+    results = []
+    for i, form in enumerate(forms):
+        if failed[i]:
+            # 文言はスカラー版と同じにする（最初に当たった検査の文言）
+            message = _scalar_error(form, profile)
+            results.append({"error": message} if message is not None
+                           else _compute_dashboard_data(form, profile))
+            continue
+        row = {}
+        for key in SPEC["outputs"]:
+            if key in outputs:
+                values, on = outputs[key]
+                row[key] = values[i] if on is None or on[i] else 0
+            else:
+                row[key] = _round0(parsed[i][key])
+        results.append(row)
+    return results
 
-    raw_material_cost_ratio = (
-    genzairyousyoukei_coefficient * (1 + inp["loss_defective"])
-) / sales_price * 100
-    # 1＋ロスの意味は、「ロス分も含めた実際にかかる材料費」
-
-    
-    return {
-        "dohdai_cost": dohdai_cost,
-        "kata_cost": kata_cost,
-        "drying_fuel_cost": drying_fuel_cost,
-        "bisque_fuel_cost": bisque_fuel_cost,
-        "hassui_cost": hassui_cost,
-        "paint_cost": paint_cost,
-        "logo_copper_cost": logo_copper_cost,
-        "glaze_material_cost": glaze_material_cost,
-        "main_firing_gas_cost": main_firing_gas_cost,
-        "transfer_sheet_cost": transfer_sheet_cost,
-
-        "raw_material_cost_total": raw_material_cost_total,
-        "raw_material_cost_ratio": raw_material_cost_ratio,
-        "genzairyousyoukei_coefficient": genzairyousyoukei_coefficient
-    }
+# --------------------------------------------- #
 
-def calculate_manufacturing_costs(inp, form, raw_material_cost_total):
-    include_chumikin         = form.get('include_chumikin')
-    include_shiagechin       = form.get('include_shiagechin')
-    include_haiimonochin     = form.get('include_haiimonochin')
-    include_seisojiken       = form.get('include_seisojiken')
-    include_soyakeire_dashi  = form.get('include_soyakeire_dashi')
-    include_soyakebarimono   = form.get('include_soyakebarimono')
-    include_doban_hari       = form.get('include_doban_hari')
-    include_hassui_kakouchin = form.get('include_hassui_kakouchin')
-    include_shiyu_hiyou      = form.get('include_shiyu_hiyou')
-    include_shiyu_cost       = form.get('include_shiyu_cost')
-    include_kamairi          = form.get('include_kamairi')
-    include_kamadashi        = form.get('include_kamadashi')
-    include_hamasuri         = form.get('include_hamasuri')
-    include_kenpin           = form.get('include_kenpin')
-    include_print_kakouchin  = form.get('include_print_kakouchin')
-
-    order_quantity  = inp["order_quantity"]
-    mold_unit_price = inp["mold_unit_price"]
-    kiln_count      = inp["kiln_count"]
-    loss_defective  = inp["loss_defective"]
-    sales_price     = inp["sales_price"]
-
-    chumikin_cost  = safe_float(form.get('chumikin_unit'))  * order_quantity if include_chumikin  else 0
-    shiagechin_cost= safe_float(form.get('shiagechin_unit'))* order_quantity if include_shiagechin else 0
-
-    haiimonochin_cost   = safe_div(mold_unit_price, safe_float(form.get('sawaimono_work')))       * order_quantity if include_haiimonochin else 0
-    seisojiken_cost     = safe_div(HOURLY_WAGE,   safe_float(form.get('seisojiken_work')))        * order_quantity if include_seisojiken else 0
-    soyakeire_dashi_cost= safe_div(HOURLY_WAGE,   safe_float(form.get('soyakeire_work')))         * order_quantity if include_soyakeire_dashi else 0
-    soyakebarimono_cost = safe_div(HOURLY_WAGE,   safe_float(form.get('soyakebarimono_work')))    * order_quantity if include_soyakebarimono else 0
-
-    doban_hari_cost       = safe_float(form.get('doban_hari_unit'))       * order_quantity if include_doban_hari       else 0
-    hassui_kakouchin_cost = safe_div(HOURLY_WAGE, safe_float(form.get('hassui_kakouchin_work')))  * order_quantity if include_hassui_kakouchin else 0
-    shiyu_hiyou_cost = safe_float(form.get('shiyu_hiyou_unit')) * order_quantity if include_shiyu_hiyou else 0
-    shiyu_cost          = safe_div(HOURLY_WAGE,   safe_float(form.get('shiyu_work')))             * order_quantity if include_shiyu_cost else 0
-    
-    kamairi_cost  = (HOURLY_WAGE * safe_float(form.get('kamairi_time'))   / kiln_count * order_quantity) if include_kamairi  else 0
-    kamadashi_cost= (HOURLY_WAGE * safe_float(form.get('kamadashi_time')) / kiln_count * order_quantity) if include_kamadashi else 0
-    hamasuri_cost = (HOURLY_WAGE * safe_float(form.get('hamasuri_time'))  / kiln_count * order_quantity) if include_hamasuri else 0
-    kenpin_cost   = (HOURLY_WAGE * safe_float(form.get('kenpin_time'))    / kiln_count * order_quantity) if include_kenpin   else 0
-
-    print_kakouchin_cost = safe_float(form.get('print_kakouchin_unit')) * order_quantity if include_print_kakouchin else 0
-
-    seizousyoukei_total = (
-        chumikin_cost + shiagechin_cost + haiimonochin_cost + seisojiken_cost +
-        soyakeire_dashi_cost + soyakebarimono_cost + doban_hari_cost +
-        hassui_kakouchin_cost + shiyu_hiyou_cost + shiyu_cost +
-        kamairi_cost + kamadashi_cost + hamasuri_cost +
-        kenpin_cost + print_kakouchin_cost
-    )
 
-    seizousyoukei_coefficient = seizousyoukei_total / order_quantity if order_quantity else 0
-    yield_coefficient         = (seizousyoukei_coefficient + raw_material_cost_total / order_quantity) * loss_defective
-    manufacturing_cost_total  = seizousyoukei_total + (yield_coefficient * order_quantity)
-    manufacturing_cost_ratio  = ((seizousyoukei_coefficient + yield_coefficient) / sales_price * 100) if sales_price else 0
-
-    return {
-        "chumikin_cost": chumikin_cost,
-        "shiagechin_cost": shiagechin_cost,
-        "haiimonochin_cost": haiimonochin_cost,
-        "seisojiken_cost": seisojiken_cost,
-        "soyakeire_dashi_cost": soyakeire_dashi_cost,
-        "soyakebarimono_cost": soyakebarimono_cost,
-        "doban_hari_cost": doban_hari_cost,
-        "hassui_kakouchin_cost": hassui_kakouchin_cost,
-        "shiyu_hiyou_cost": shiyu_hiyou_cost,
-        "shiyu_cost": shiyu_cost,
-        "kamairi_cost": kamairi_cost,
-        "kamadashi_cost": kamadashi_cost,
-        "hamasuri_cost": hamasuri_cost,
-        "kenpin_cost": kenpin_cost,
-        "print_kakouchin_cost": print_kakouchin_cost,
-        "seizousyoukei_coefficient": seizousyoukei_coefficient,
-        "yield_coefficient": yield_coefficient,
-        "manufacturing_cost_total": manufacturing_cost_total,
-        "manufacturing_cost_ratio": manufacturing_cost_ratio,
-    }
+# ----------------- コンパイル済み原価モデル ----------------- #
+# 式と係数は formula_spec.SPEC（ブラウザの static/js/formula.js と共有）。
+# include_* フラグをビットマスクにまとめ、マスクごとに SPEC をクロージャへコンパイルして
+# メモ化する（外れた項目は式ごと消え、フラグと定数は畳み込まれる）。
+# 1 回の計算は 有効な項目の単価 × 発注数 と、その合計だけで済む。
+# 加算順は旧来の calculate_*（tests/legacy_formulas.py）と同じにしてあり、丸め後の値も型も一致する
+# （tests/test_formula_parity.py で確認）。
+
+FLAG_BITS = {name: 1 << i for i, name in enumerate(INCLUDE_FLAGS)}
+
+
+# ----- 原価セクションの依存グラフ（差分再計算用） -----
+# 計算順に並べたセクション名。上流が変わると下流も再計算する。
+COST_SECTIONS = SECTIONS
+
+# 入力フィールド -> それを直接使うセクション、セクション -> 上流セクション（SPEC から求める）
+FIELD_SECTIONS, SECTION_UPSTREAM = section_dependencies(SPEC)
+
+# 各セクションが出力する原価項目キー（フラグを外したときに 0 へ戻す）
+SECTION_ITEM_KEYS = {
+    group["name"]: tuple(term["key"] for term in group["terms"]) for group in SPEC["groups"]
+}
+
+
+def affected_sections(fields) -> set:
+    """変更されたフィールドから再計算が必要なセクションを求める。"""
+    dirty = set()
+    for name in fields:
+        dirty |= FIELD_SECTIONS.get(name, set())
+    for name in COST_SECTIONS:
+        if any(up in dirty for up in SECTION_UPSTREAM.get(name, ())):
+            dirty.add(name)
+    return dirty
+
+
+def flags_to_mask(form) -> int:
+    """フォームの include_* チェック状態をビットマスクに変換する。"""
+    mask = 0
+    for name, bit in FLAG_BITS.items():
+        if form.get(name):
+            mask |= bit
+    return mask
+
 
-def calculate_sales_admin_cost(form, order_quantity, total_cost):
-    include_nouhin_jinkenhi = form.get('include_nouhin_jinkenhi')
-    include_gasoline        = form.get('include_gasoline')
-
-    total_sales_admin_cost = 0
-    if include_nouhin_jinkenhi:
-        total_sales_admin_cost += 7500
-    if include_gasoline:
-        total_sales_admin_cost += 750
-
-    sales_admin_cost_total = total_sales_admin_cost / order_quantity if order_quantity else 0
-
-    sales_price = float(form.get('sales_price', 0))
-    order_quantity = int(form.get('order_quantity', 1))
-
-    include_nouhin_jinkenhi_value = 7500 if include_nouhin_jinkenhi else 0
-    include_gasoline_value = 750 if include_gasoline else 0
-
-    sales_admin_cost_ratio = (
-        (include_nouhin_jinkenhi_value + include_gasoline_value) / (sales_price * order_quantity) * 100
-    ) if sales_price > 0 and order_quantity > 0 else 0
-
-    return sales_admin_cost_total, sales_admin_cost_ratio
-
-
-def assemble_dashboard_data(
-    inp,
-    raw_dict,
-    man_dict,
-    sales_admin_cost_total,
-    sales_admin_cost_ratio
-):
-    client_name     = inp.get("client_name", "")
-    subject         = inp.get("subject", "")
-    sales_price     = inp["sales_price"]
-    order_quantity  = inp["order_quantity"]
-    product_weight  = inp["product_weight"]
-    mold_unit_price = inp["mold_unit_price"]
-    mold_count      = inp["mold_count"]
-    kiln_count      = inp["kiln_count"]
-    gas_unit_price  = inp["gas_unit_price"]
-    loss_defective  = inp["loss_defective"]
-    poly_count      = inp["poly_count"]
-    glaze_cost      = inp["glaze_cost"]
-
-    total_cost = (
-        sales_price + order_quantity + product_weight +
-        mold_unit_price + mold_count + kiln_count +
-        gas_unit_price + loss_defective
+class EstimateInput:
+    """
+    1 件分の入力値。SPEC["inputs"] の順に検証し（旧来の parse_input_data と同じ文言）、
+    有効な原価項目の 1 個あたり単価（units）も一緒に保持する。
+    constants は使う係数プロファイルの定数（Profile.key）。
+    """
+    __slots__ = (
+        'client_name', 'subject', 'sales_price', 'order_quantity',
+        'product_weight', 'mold_unit_price', 'mold_count', 'glaze_cost',
+        'poly_count', 'kiln_count', 'gas_unit_price', 'loss_defective',
+        'mask', 'constants', 'units',
     )
 
-    raw_material_cost_total = raw_dict.get("raw_material_cost_total", 0)
-    raw_material_cost_ratio = raw_dict.get("raw_material_cost_ratio", 0)
-    manufacturing_cost_total = man_dict.get("manufacturing_cost_total", 0)
-    yield_coefficient = man_dict.get("yield_coefficient", 0)
+    @classmethod
+    def from_form(cls, form, profile=DEFAULT_PROFILE) -> 'EstimateInput':
+        self = cls.__new__(cls)
+        try:
+            for name, parse in INPUT_PARSERS:
+                setattr(self, name, parse(form.get(name, '')))
+        except Exception as e:
+            raise ValueError("入力項目が不十分です: " + str(e))
 
-    production_cost_total = raw_material_cost_total + manufacturing_cost_total
-    production_plus_sales = production_cost_total + sales_admin_cost_total
+        self.mask  = flags_to_mask(form)
+        self.constants = profile.key
+        self.units = compile_cost_model(self.mask, self.constants).unit_vector(self, form)
+        return self
 
-    profit_amount = sales_price - (
-    raw_dict.get("genzairyousyoukei_coefficient", 0) +
-    man_dict.get("seizousyoukei_coefficient", 0) +
-    man_dict.get("yield_coefficient", 0) +
-    sales_admin_cost_total
-)
 
-    
-    profit_amount_total = profit_amount * order_quantity
-    profit_ratio = (profit_amount / sales_price) * 100 if sales_price else 0
-
-    manufacturing_cost_ratio = man_dict.get("manufacturing_cost_ratio", 0)
-
-    return {
-        "client_name": client_name,
-        "subject": subject,
-        "sales_price": sales_price,
-        "order_quantity": order_quantity,
-        "product_weight": product_weight,
-        "mold_unit_price": mold_unit_price,
-        "mold_count": mold_count,
-        "kiln_count": kiln_count,
-        "gas_unit_price": gas_unit_price,
-        "loss_defective": loss_defective,
-        "poly_count": poly_count,
-        "glaze_cost": glaze_cost,
-        "total_cost": total_cost,
-
-        "raw_material_cost_total": raw_material_cost_total,
-        "raw_material_cost_ratio": raw_material_cost_ratio,
-        "dohdai_cost": raw_dict.get("dohdai_cost", 0),
-        "kata_cost": raw_dict.get("kata_cost", 0),
-        "drying_fuel_cost": raw_dict.get("drying_fuel_cost", 0),
-        "bisque_fuel_cost": raw_dict.get("bisque_fuel_cost", 0),
-        "hassui_cost": raw_dict.get("hassui_cost", 0),
-        "paint_cost": raw_dict.get("paint_cost", 0),
-        "logo_copper_cost": raw_dict.get("logo_copper_cost", 0),
-        "glaze_material_cost": raw_dict.get("glaze_material_cost", 0),
-        "main_firing_gas_cost": raw_dict.get("main_firing_gas_cost", 0),
-        "transfer_sheet_cost": raw_dict.get("transfer_sheet_cost", 0),
-        "genzairyousyoukei_coefficient": raw_dict.get("genzairyousyoukei_coefficient", 0),
-
-        "chumikin_cost": man_dict.get("chumikin_cost", 0),
-        "shiagechin_cost": man_dict.get("shiagechin_cost", 0),
-        "haiimonochin_cost": man_dict.get("haiimonochin_cost", 0),
-        "seisojiken_cost": man_dict.get("seisojiken_cost", 0),
-        "soyakeire_dashi_cost": man_dict.get("soyakeire_dashi_cost", 0),
-        "soyakebarimono_cost": man_dict.get("soyakebarimono_cost", 0),
-        "doban_hari_cost": man_dict.get("doban_hari_cost", 0),
-        "hassui_kakouchin_cost": man_dict.get("hassui_kakouchin_cost", 0),
-        "shiyu_hiyou_cost": man_dict.get("shiyu_hiyou_cost", 0),
-        "shiyu_cost": man_dict.get("shiyu_cost", 0),
-        "kamairi_cost": man_dict.get("kamairi_cost", 0),
-        "kamadashi_cost": man_dict.get("kamadashi_cost", 0),
-        "hamasuri_cost": man_dict.get("hamasuri_cost", 0),
-        "kenpin_cost": man_dict.get("kenpin_cost", 0),
-        "print_kakouchin_cost": man_dict.get("print_kakouchin_cost", 0),
-        "yield_coefficient": yield_coefficient,
-        "manufacturing_cost_total": manufacturing_cost_total,
-        "manufacturing_cost_ratio": manufacturing_cost_ratio,
-        "seizousyoukei_coefficient": man_dict.get("seizousyoukei_coefficient", 0),
-
-        "sales_admin_cost_total": sales_admin_cost_total,
-        "sales_admin_cost_ratio": sales_admin_cost_ratio,
-
-        "production_cost_total": production_cost_total,
-        "production_plus_sales": production_plus_sales,
-        "profit_amount": profit_amount,
-        "profit_amount_total": profit_amount_total,
-        "profit_ratio": profit_ratio
-    }
+class CostModel(CompiledFormula):
+    """特定の include_* の組み合わせ・係数向けにコンパイルされた原価モデル。"""
+    __slots__ = ('mask', 'raw_keys', 'manufacturing_keys', 'admin_fixed')
+
+    def __init__(self, mask: int, constants: tuple = DEFAULT_PROFILE.key):
+        super().__init__(SPEC, (name for name, bit in FLAG_BITS.items() if mask & bit),
+                         dict(constants))
+        self.mask = mask
+        self.raw_keys = self.term_keys['raw_material']
+        self.manufacturing_keys = self.term_keys['manufacturing']
+        # 販売管理費の固定額はフラグだけで決まるのでコンパイル時に定数になる
+        self.admin_fixed = self.folded('admin_fixed')
+
+    # 有効な項目の 1 個あたり単価（require の入力チェックも旧来の calculate_* と同じ順・同じ文言）
+    unit_vector = CompiledFormula.units
+
+
+@lru_cache(maxsize=1024)
+def compile_cost_model(mask: int, constants: tuple = DEFAULT_PROFILE.key) -> CostModel:
+    """(マスク, 係数) ごとの CostModel をメモ化して返す。"""
+    return CostModel(mask, constants)
+
+# --------------------------------------------- #
+
+
+# ----------------- what-if スイープ（損益分岐面） ----------------- #
+# 売価 × 発注数 × ロス率 の格子上で利益を求める。基準入力は一度だけ検証し、売価 1 値ごとに
+# 発注数×ロス率 の面を VectorFormula（SPEC の列評価）でまとめて評価して
+# NDJSON で 1 行ずつ返す（全格子を保持しない）。
+
+SWEEP_AXES = ('sales_price', 'order_quantity', 'loss_defective')
+
+
+def _sweep_axis(name: str, spec) -> list:
+    """軸指定（値の配列 または {"start", "stop", "num"}）を値のリストにする。"""
+    if isinstance(spec, list):
+        values = [float(v) for v in spec]
+    elif isinstance(spec, dict):
+        num = int(spec.get('num', 2))
+        if num < 1:
+            raise ValueError(f"{name} の num は 1 以上にしてください。")
+        values = np.linspace(float(spec['start']), float(spec['stop']), num).tolist()
+    else:
+        raise ValueError(f"{name} の範囲指定が不正です。")
+    if not values:
+        raise ValueError(f"{name} の値がありません。")
+    if name == 'order_quantity':
+        values = [int(round(v)) for v in values]
+    if name in ('sales_price', 'order_quantity') and min(values) <= 0:
+        raise ValueError(f"{name} は 0 より大きい値にしてください。")
+    return values
+
+
+def parse_sweep_request(req) -> tuple[EstimateInput, dict, dict]:
+    """
+    基準入力（検証済みの EstimateInput とフォーム）と軸範囲を読み取る。
+    JSON: {"inputs": {...フォームと同じキー...}, "axes": {...}}
+    フォーム: 通常の入力項目 + axes フィールド（JSON 文字列）
+    """
+    if req.is_json:
+        payload = req.get_json(silent=True) or {}
+        form = _normalize_batch_row(payload.get('inputs') or {})
+        axes_spec = payload.get('axes') or {}
+    else:
+        form = req.form.to_dict()
+        try:
+            axes_spec = json.loads(form.pop('axes', '') or '{}')
+        except json.JSONDecodeError as e:
+            raise ValueError("axes が JSON として読めません: " + str(e))
+    if not isinstance(axes_spec, dict):
+        raise ValueError("axes はオブジェクトで指定してください。")
+
+    axes = {}
+    for name in SWEEP_AXES:
+        if name in axes_spec:
+            axes[name] = _sweep_axis(name, axes_spec[name])
+            form.setdefault(name, str(axes[name][0]))
+
+    inp = EstimateInput.from_form(form, _request_profile(form))
+    for name in SWEEP_AXES:
+        axes.setdefault(name, [getattr(inp, name)])
+
+    points = len(axes['sales_price']) * len(axes['order_quantity']) * len(axes['loss_defective'])
+    if points > SWEEP_MAX_POINTS:
+        raise ValueError(f"格子点が多すぎます（{points} 点 / 上限 {SWEEP_MAX_POINTS} 点）。")
+    return inp, form, axes
+
+
+def iter_profit_surface(inp: EstimateInput, form: dict, axes: dict):
+    """
+    sales_price ごとに、まず発注数に依存しない損益分岐数量を
+    {"break_even": {"sales_price", "break_even_quantity": ロス率軸の配列}} で 1 件、
+    続いて order_quantity ごとにロス率軸に沿った profit_amount / profit_ratio を dict で順に返す。
+    値は VectorFormula で同じ SPEC を評価したもので、丸めは /dashboard/calculate と同じ（0 桁・偶数丸め）。
+    計算できない格子点（スカラー版なら例外になる点）は None。
+    """
+    model = compile_vector_model(inp.constants)
+    quantities = axes['order_quantity']
+    q    = np.array(quantities, dtype=float)[:, None]           # (Q, 1)
+    loss = np.array(axes['loss_defective'], dtype=float)[None, :]  # (1, L)
+
+    # 売価・発注数・ロス率以外の入力と単価の項目は基準入力のまま
+    numeric = {name: getattr(inp, name) for name in model.numeric_inputs}
+    columns = {name: safe_float(form.get(name)) for name in model.field_names}
+    invalid = {}
+    for name in model.price_names:
+        values, bad = _price_column([form], name)
+        columns[name], invalid[name] = values[0], bad[0]
+    flags = {name: bool(form.get(name)) for name in model.flags}
+
+    def run(sales_price, order_quantity):
+        inputs = {**numeric, 'sales_price': sales_price, 'order_quantity': order_quantity,
+                  'loss_defective': loss}
+        return model.run(inputs, columns, flags, invalid)
+
+    # 発注数 1 個のときの 1 個あたり原価から販売管理費を除いたもの（ロス込みの変動費, (L,)）
+    st, failed = run(axes['sales_price'][0], 1.0)
+    variable_cost = np.broadcast_to(
+        st['genzairyousyoukei_coefficient'] + st['seizousyoukei_coefficient'] + st['yield_coefficient'],
+        loss.shape,
+    )[0]
+    variable_failed = np.broadcast_to(failed, loss.shape)[0]
+    admin_fixed = float(st['admin_fixed'])
+
+    for sales_price in axes['sales_price']:
+        margin = sales_price - variable_cost
+        with np.errstate(divide='ignore'):
+            break_even = np.ceil(admin_fixed / np.where(margin > 0, margin, 1.0))
+        break_even_quantity = [
+            int(b) if m > 0 and not f else None
+            for b, m, f in zip(break_even.tolist(), margin.tolist(), variable_failed.tolist())
+        ]
+        yield {"break_even": {"sales_price": sales_price, "break_even_quantity": break_even_quantity}}
+
+        st, failed = run(sales_price, q)
+        shape = np.broadcast_shapes(q.shape, loss.shape)
+        failed = np.broadcast_to(failed, shape)
+        profit_rows = np.round(np.broadcast_to(st['profit_amount'], shape), 0).tolist()
+        ratio_rows  = np.round(np.broadcast_to(st['profit_ratio'], shape), 0).tolist()
+        if failed.any():
+            for i, j in zip(*np.nonzero(failed)):
+                profit_rows[i][j] = ratio_rows[i][j] = None
+        for i, order_quantity in enumerate(quantities):
+            yield {
+                "sales_price": sales_price,
+                "order_quantity": order_quantity,
+                "profit_amount": profit_rows[i],
+                "profit_ratio": ratio_rows[i],
+            }
+
+# --------------------------------------------- #
 
 
 # --- ここからすべてを dashboard_bp で定義 ---
 
 @dashboard_bp.route('/')
 def dashboard():
-    """ダッシュボード表示"""
-    return render_template('dashboard.html')
+    """ダッシュボード表示（入力中のプレビューはブラウザが formula_spec で計算する）"""
+    return render_template(
+        'dashboard.html',
+        formula_spec=SPEC,
+        coefficient_profiles=profile_cache.browser_payload(session.get('user_id')),
+    )
+
+
+def _request_profile(form):
+    """ログイン中のユーザーと宛名から係数プロファイルを決める（メモリだけを見る）。"""
+    return profile_cache.resolve(session.get('user_id'), form.get('client_name', ''))
 
 
-def _compute_dashboard_data(form):
+def _compute_dashboard_data(form, profile=DEFAULT_PROFILE):
     """Parse input values and return calculated dashboard data."""
-    inp = parse_input_data(form)
-    
-    total_cost = (
-        inp["sales_price"] + inp["order_quantity"] + inp["product_weight"] +
-        inp["mold_unit_price"] + inp["mold_count"] + inp["kiln_count"] +
-        inp["gas_unit_price"] + inp["loss_defective"]
-    )
+    inp = EstimateInput.from_form(form, profile)
+    return compile_cost_model(inp.mask, inp.constants).evaluate(inp)
 
-    raw_dict = calculate_raw_material_costs(inp, form)
-    man_dict = calculate_manufacturing_costs(
-        inp, form, raw_dict["raw_material_cost_total"]
-    )
 
-    sales_admin_cost_total, sales_admin_cost_ratio = calculate_sales_admin_cost(
-        form, inp["order_quantity"], total_cost
+def _compute_dashboard_data_cached(form, profile=DEFAULT_PROFILE):
+    """_compute_dashboard_data の結果を calc_cache 経由で返す。"""
+    inp = EstimateInput.from_form(form, profile)
+    key = make_key(getattr(inp, name) for name in EstimateInput.__slots__)
+    data = calc_cache.get_or_compute(
+        key, lambda: compile_cost_model(inp.mask, inp.constants).evaluate(inp)
     )
-    
-    dashboard_data = assemble_dashboard_data(
-        inp, raw_dict, man_dict, sales_admin_cost_total, sales_admin_cost_ratio
+    return dict(data)
+
+
+# ----------------- 見積りの保存（ログイン時） ----------------- #
+# 有効な見積りは新しい config.ESTIMATE_KEEP_ACTIVE 件まで。
+# config.ESTIMATE_WRITE_BEHIND が正なら、同じユーザーの連続した保存を
+# その秒数ぶんまとめて最後の 1 件だけ書く（id はまだ無いので None を返す）。
+# 計算に使った係数プロファイルの版と式の版も記録する（あとで同じ計算を再現できる）。
+def _write_estimate(user_id, item):
+    data, profile_id = item
+    return get_repository().save_estimate(
+        user_id, json.dumps(data), config.ESTIMATE_KEEP_ACTIVE, profile_id, SPEC["version"]
     )
-    round_values_in_dict(dashboard_data, digits=0)
-
-    return dashboard_data
-
-
-    def _save_estimate_if_logged_in(data):
-        """Persist estimate when a user is logged in."""
-        if "user_id" not in session:
-            return None
-
-        user_id = session["user_id"]
-        conn = get_connection()
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "SELECT COUNT(*) as cnt FROM estimates WHERE user_id=%s AND status='active'",
-                (user_id,),
-            )
-            active_count = cursor.fetchone()["cnt"]
-            if active_count >= 3:
-                cursor.execute(
-                """
-                  SELECT id FROM estimates
-                  WHERE user_id=%s AND status='active'
-                  ORDER BY created_at ASC LIMIT 1
-                               """,
-                (user_id,),
-            )
-            oldest_id = cursor.fetchone()["id"]
-            cursor.execute(
-                "UPDATE estimates SET status='deleted', deleted_at=NOW() WHERE id=%s",
-                (oldest_id,),
-            )
-        cursor.execute(
-            """
-              INSERT INTO estimates (user_id, estimate_data, status, sent_at, deleted_at)
-              VALUES (%s, %s, 'active', NULL, NULL)
-                        """,
-            (user_id, json.dumps(data)),
-        )
-        estimate_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return estimate_id
+
+
+estimate_writer = (
+    CoalescingWriter(_write_estimate, config.ESTIMATE_WRITE_BEHIND, name='estimate-writer')
+    if config.ESTIMATE_WRITE_BEHIND > 0 else None
+)
+
+
+def _save_estimate_if_logged_in(data, profile=DEFAULT_PROFILE):
+    """Persist estimate when a user is logged in."""
+    if "user_id" not in session:
+        return None
+
+    user_id = session["user_id"]
+    item = (data, profile.id)
+    if estimate_writer is not None:
+        estimate_writer.submit(user_id, item)
+        return None
+    return _write_estimate(user_id, item)
 
 
 @dashboard_bp.route('/post', methods=['POST'])
 def dashboard_post():
+    profile = _request_profile(request.form)
     try:
-        dashboard_data = _compute_dashboard_data(request.form)
+        dashboard_data = _compute_dashboard_data(request.form, profile)
     except ValueError as e:
         return str(e)
 
-    estimate_id = _save_estimate_if_logged_in(dashboard_data)
+    estimate_id = _save_estimate_if_logged_in(dashboard_data, profile)
 
     session['dashboard_data'] = dashboard_data
     session['estimate_id'] = estimate_id
@@ -514,7 +509,9 @@ def dashboard_post():
 @dashboard_bp.route('/calculate', methods=['POST'])
 def calculate():
     try:
-        dashboard_data = _compute_dashboard_data(request.form)
+        dashboard_data = _compute_dashboard_data_cached(
+            request.form, _request_profile(request.form)
+        )
     except ValueError as e:
         return jsonify({"error": str(e)}), 400
 
@@ -524,3 +521,125 @@ def calculate():
     session['dashboard_data'] = dashboard_data
 
     return jsonify(dashboard_data)
+
+
+def _delta_owner() -> str:
+    """
+    差分再計算の状態の持ち主（ログイン中のユーザーと、このセッションに置いた乱数）のハッシュ。
+    状態は他ワーカーと共有するファイルにも置くので、セッションの乱数そのものは入れない。
+    """
+    if 'delta_owner' not in session:
+        session['delta_owner'] = secrets.token_urlsafe(16)
+    return make_key((session.get('user_id'), session['delta_owner']))
+
+
+@dashboard_bp.route('/calculate/delta', methods=['POST'])
+def calculate_delta():
+    """
+    差分再計算。
+    初回（_full=1）はフォーム全体を受け取り、新しい _token と全項目を返す。
+    以降は _token / _rev と変更されたフィールドだけを受け取り、依存するセクション
+    だけを再計算して値が変わった出力キーだけを返す。
+    トークンが期限切れ・_rev が一致しない・別のセッション（ユーザー）のトークンの場合は
+    409 を返すので、全体を送り直す。
+    """
+    changes = request.form.to_dict()
+    token   = changes.pop('_token', '')
+    rev     = changes.pop('_rev', '')
+    full    = changes.pop('_full', '') == '1'
+
+    owner = _delta_owner()
+    state = None if full else delta_states.get(token)
+    if not full and (state is None or state['owner'] != owner or str(state['rev']) != rev):
+        return jsonify({"error": "再同期が必要です。", "resync": True}), 409
+
+    if full:
+        token = secrets.token_urlsafe(16)
+        form, prev_data, st = changes, {}, {}
+        sections = set(COST_SECTIONS)
+    else:
+        old_form = state['form']
+        changed_fields = [k for k, v in changes.items() if old_form.get(k) != v]
+        form = {**old_form, **changes}
+        prev_data, st = state['data'], dict(state['st'])
+        sections = affected_sections(changed_fields)
+
+    try:
+        inp = EstimateInput.from_form(form, _request_profile(form))
+        if not full and make_key(inp.constants) != state['constants']:
+            # 宛名の変更などで係数プロファイルが変わったら全セクションを計算し直す
+            sections = set(COST_SECTIONS)
+        model = compile_cost_model(inp.mask, inp.constants)
+        data = model.template.copy() if full else dict(prev_data)
+        for name in sections:
+            data.update(dict.fromkeys(SECTION_ITEM_KEYS.get(name, ()), 0))
+        model.run_sections(inp, st, data, sections)
+    except (ValueError, ZeroDivisionError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    new_rev = 1 if full else state['rev'] + 1
+    delta_states.put(token, {"form": form, "rev": new_rev, "st": st, "data": data,
+                             "constants": make_key(inp.constants), "owner": owner})
+    session['dashboard_data'] = data
+
+    changed = data if full else {
+        k: v for k, v in data.items() if k not in prev_data or prev_data[k] != v
+    }
+    return jsonify({"token": token, "rev": new_rev, "full": full, "changed": changed})
+
+
+@dashboard_bp.route('/calculate/stats')
+def calculate_stats():
+    """計算キャッシュのヒット率などを返す（運用確認用。config.ADMIN_USER_IDS のユーザーだけ）。"""
+    if 'user_id' not in session:
+        return jsonify({"error": "ログインが必要です。"}), 401
+    if session['user_id'] not in config.ADMIN_USER_IDS:
+        return jsonify({"error": "権限がありません。"}), 403
+    return jsonify(calc_cache.stats())
+
+
+@dashboard_bp.route('/batch', methods=['POST'])
+def batch():
+    """
+    複数商品の一括計算。JSON（配列 / {"rows": [...]}）か CSV を受け取り、
+    行と同じ順に計算結果（エラー行は {"error": ...}）を返す。
+    """
+    try:
+        forms = read_batch_rows(request)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({"error": str(e)}), 400
+
+    # 行ごとに係数プロファイル（宛名で変わる）を決め、同じプロファイルの行をまとめて計算する
+    results = [None] * len(forms)
+    groups = {}
+    for i, form in enumerate(forms):
+        profile = _request_profile(form)
+        groups.setdefault(profile.key, (profile, []))[1].append(i)
+    for profile, rows in groups.values():
+        computed = compute_dashboard_batch([forms[i] for i in rows], profile)
+        for i, row in zip(rows, computed):
+            results[i] = row
+    return jsonify({
+        "count": len(results),
+        "error_count": sum(1 for r in results if "error" in r),
+        "results": results,
+    })
+
+
+@dashboard_bp.route('/sweep', methods=['POST'])
+def sweep():
+    """
+    what-if スイープ。1 行目に軸の値、以降は売価ごとに損益分岐数量（{"break_even": ...}）を 1 行、
+    続けて (売価, 発注数) ごとにロス率軸に沿った利益・利益率を NDJSON で流す。
+    """
+    try:
+        inp, form, axes = parse_sweep_request(request)
+    except (ValueError, ZeroDivisionError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    def generate():
+        yield json.dumps({"axes": axes}, ensure_ascii=False) + "\n"
+        for row in iter_profit_surface(inp, form, axes):
+            yield json.dumps(row) + "\n"
+
+    return Response(generate(), mimetype='application/x-ndjson')
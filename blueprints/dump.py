@@ -0,0 +1,157 @@
+# blueprints/dump.py ―― 見積り・Excel 履歴の一括ダンプ（NDJSON / CSV）
+#
+# 分析用に estimates / excel_history を丸ごと取り出す。
+# サーバー側カーソル（SSDictCursor）で 1 行ずつ読み、JSON 列（estimate_data / data_json）を
+# 列に展開しながらそのまま流すので、件数が増えてもメモリは一定。
+# 通常は自分の行だけ。config.ADMIN_USER_IDS のユーザーは ?scope=all で全ユーザー分。
+
+import csv
+import io
+import json
+from datetime import datetime
+from functools import lru_cache
+
+from flask import Blueprint, Response, jsonify, request, session, stream_with_context
+
+import config
+from blueprints.dashboard import DASHBOARD_INPUT_KEYS, INCLUDE_FLAGS, _compute_dashboard_data
+from repository import get_repository
+
+dump_bp = Blueprint('dump', __name__, url_prefix='/dump')
+
+# table -> (そのまま出す列, 展開する JSON 列, Repository のメソッド名)
+DUMP_TABLES = {
+    'estimates': (
+        ('id', 'user_id', 'status', 'created_at', 'sent_at', 'deleted_at',
+         'coefficient_profile_id', 'formula_version'),
+        'estimate_data', 'stream_estimates',
+    ),
+    'excel_history': (
+        ('id', 'user_id', 'filename', 'blob_key', 'created_at'),
+        'data_json', 'stream_history',
+    ),
+}
+EXTRA_COLUMN = 'data_extra'     # 既知の列に無いキー（古い形式の行など）は JSON のままここへ
+
+
+@lru_cache(maxsize=1)
+def data_columns() -> tuple:
+    """保存される計算結果のキー（計算結果の並び順）。"""
+    form = {key: '1' for key in DASHBOARD_INPUT_KEYS + INCLUDE_FLAGS}
+    return tuple(_compute_dashboard_data(form))
+
+
+def _scalar(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    return value
+
+
+def _parse_data(raw) -> dict:
+    if not raw:
+        return {}
+    try:
+        data = json.loads(raw)
+    except (TypeError, ValueError):
+        return {EXTRA_COLUMN: raw}
+    return data if isinstance(data, dict) else {EXTRA_COLUMN: data}
+
+
+def _flatten(row: dict, base: tuple, json_column: str) -> dict:
+    """1 行を {列: 値} にする。JSON 列のキーは基本列の後ろに並べる。"""
+    flat = {col: _scalar(row.get(col)) for col in base}
+    for key, value in _parse_data(row.get(json_column)).items():
+        if key in flat:
+            key = f"data_{key}"
+        flat[key] = value
+    return flat
+
+
+# ----------------- 出力形式 ----------------- #
+def _ndjson_chunks(rows, base, json_column):
+    buf = []
+    for row in rows:
+        buf.append(json.dumps(_flatten(row, base, json_column), ensure_ascii=False, default=str))
+        if len(buf) >= config.DUMP_CHUNK_ROWS:
+            yield "\n".join(buf) + "\n"
+            buf.clear()
+    if buf:
+        yield "\n".join(buf) + "\n"
+
+
+def _csv_chunks(rows, base, json_column):
+    """
+    列は 基本列 + 計算結果のキー + data_extra で固定。
+    固定列に無いキーは data_extra に JSON でまとめる（列がずれないように）。
+    Excel でそのまま開けるよう先頭に BOM を付ける。
+    """
+    columns = base + data_columns()
+    known = set(columns)
+    out = io.StringIO()
+    writer = csv.writer(out)
+    out.write('\ufeff')
+    writer.writerow(columns + (EXTRA_COLUMN,))
+    pending = 1
+    for row in rows:
+        flat = _flatten(row, base, json_column)
+        extra = {k: v for k, v in flat.items() if k not in known}
+        writer.writerow([flat.get(col) for col in columns]
+                        + [json.dumps(extra, ensure_ascii=False, default=str) if extra else ''])
+        pending += 1
+        if pending >= config.DUMP_CHUNK_ROWS:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+            pending = 0
+    if pending:
+        yield out.getvalue()
+
+
+DUMP_FORMATS = {
+    'ndjson': (_ndjson_chunks, 'application/x-ndjson'),
+    'csv': (_csv_chunks, 'text/csv; charset=utf-8'),
+}
+
+
+def _is_admin() -> bool:
+    return session.get('user_id') in config.ADMIN_USER_IDS
+
+
+@dump_bp.route('/<table>.<fmt>')
+def dump(table, fmt):
+    """
+    /dump/estimates.ndjson, /dump/excel_history.csv など。
+    ?scope=all で全ユーザー分（管理者のみ）。
+    """
+    if 'user_id' not in session:
+        return jsonify({"error": "ログインが必要です。"}), 401
+    if table not in DUMP_TABLES or fmt not in DUMP_FORMATS:
+        return jsonify({"error": "対象が不正です。"}), 404
+
+    if request.args.get('scope') == 'all':
+        if not _is_admin():
+            return jsonify({"error": "権限がありません。"}), 403
+        user_id = None
+    else:
+        user_id = session['user_id']
+
+    base, json_column, method = DUMP_TABLES[table]
+    chunks, mimetype = DUMP_FORMATS[fmt]
+    # 行の読み出しはレスポンスを流し始めてから（ジェネレーターなので遅延実行）
+    rows = getattr(get_repository(), method)(user_id)
+
+    def generate():
+        try:
+            yield from chunks(rows, base, json_column)
+        finally:
+            rows.close()    # 途中で切断されたら接続を捨てて残りを読まない
+
+    filename = f"{table}_{datetime.now():%Y%m%d%H%M%S}.{fmt}"
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "X-Accel-Buffering": "no",      # nginx にためさせず順に送る
+        },
+    )
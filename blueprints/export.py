@@ -1,124 +1,499 @@
 # blueprints/export.py
 # ─────────────────────────────────────────────
 # ひな形 .xlsx に計算値を差し込んでダウンロードする
-# 「結合セルだと書き込み不可」問題を set_value() で自動回避
+# ひな形キャッシュと差し込み（結合セルは set_value() で自動回避）は workbook.py
 # ─────────────────────────────────────────────
 
 from flask import Blueprint, session, send_file, redirect, url_for, flash
+from flask import request, jsonify, Response, stream_with_context
 from flask import current_app as app
-from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
 import datetime
+import hashlib
 import os
-import openpyxl
+import secrets
+import threading
+import time
+import unicodedata
+import zipfile
+from urllib.parse import quote
 import json
-from openpyxl.cell.cell import MergedCell
-from db import get_connection
+import config
+from blueprints.dashboard import _compute_dashboard_data, _request_profile
+from export_store import get_store
+from job_queue import QueueFull
+from repository import TRANSIENT_ERRORS, get_repository
+from workbook import OUTPUT_CELLS, build_from_values, build_workbook_bytes, template_cache
+from write_behind import BatchWriter, WriteBehindFull
 
 export_bp = Blueprint("export", __name__, url_prefix="/export")
 
-# === 1. ひな形パス（テンプレは static/template/ に置く） ==========
-TPL_PATH = os.path.join(
-    os.path.dirname(os.path.dirname(__file__)),  # flask-project/
-    "static", "template", "estimate_template.xlsx"
-)
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
 
 
 
 # === 保存ユーティリティ =============================================
-def _save_history(user_id: int, filename: str, data: dict):
-    """Save exported excel info for the user."""
-    conn = get_connection()
-    with conn.cursor() as cursor:
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS excel_history (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                user_id INT NOT NULL,
-                filename VARCHAR(255) NOT NULL,
-                data_json TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-            """
-        )
-        cursor.execute(
-            "INSERT INTO excel_history (user_id, filename, data_json) VALUES (%s, %s, %s)",
-            (user_id, filename, json.dumps(data)),
-        )
-    conn.commit()
-    conn.close()
+# config.HISTORY_WRITE_BEHIND なら履歴は history_writer がまとめて書く
+# （1 行ずつのコミットをやめる）。キューが溢れたときだけその場で書く。
+history_writer = None
+
+
+def _write_history_batch(rows):
+    get_repository().insert_history_batch(rows)
+
+
+@export_bp.record_once
+def _start_history_writer(state):
+    global history_writer
+    if not config.HISTORY_WRITE_BEHIND or history_writer is not None:
+        return
+    history_writer = BatchWriter(
+        _write_history_batch,
+        max_rows=config.HISTORY_BATCH_ROWS,
+        interval=config.HISTORY_FLUSH_MS / 1000,
+        max_queue=config.HISTORY_MAX_QUEUE,
+        spool_dir=config.HISTORY_SPOOL_DIR or os.path.join(state.app.instance_path, "spool"),
+        name="excel_history",
+        max_retries=config.HISTORY_MAX_RETRIES,
+        transient=TRANSIENT_ERRORS,
+    )
+    state.app.extensions["history_writer"] = history_writer
 
-# === 3. 結合セルでも安全に書き込むユーティリティ ================
-def set_value(ws, coord: str, value):
-    """
-    coord が結合セルの途中でも左上セルへ代入。
-    """
-    cell = ws[coord]
-    if isinstance(cell, MergedCell):
-        # 含まれる結合範囲を探す
-        for rng in ws.merged_cells.ranges:
-            if coord in rng:
-                ws.cell(rng.min_row, rng.min_col, value)
-                break
-    else:
-        cell.value = value
+
+def _save_history(user_id: int, filename: str, data: dict, blob_key: str | None = None):
+    """Save exported excel info for the user."""
+    row = (user_id, filename, json.dumps(data), blob_key)
+    if history_writer is not None:
+        try:
+            history_writer.submit(row)
+            return
+        except WriteBehindFull:
+            pass
+    get_repository().insert_history(*row)
 
 # === 4. ワークブック生成 =========================================
-def _build_workbook(data: dict) -> BytesIO:
-    wb = openpyxl.load_workbook(TPL_PATH)
-    ws = wb.active               # 見積書シートは 1 枚目想定
-
-    # --- 新しい出力項目 ---
-    set_value(ws, "D3", data.get("client_name", ""))
-    set_value(ws, "B5", data.get("subject", ""))
-    set_value(ws, "F1", datetime.date.today().strftime("%Y年%m月%d日"))
-
-    # ── 式再計算フラグ─────────────
-    if hasattr(wb, "calculation") and wb.calculation is not None:
-        # openpyxl ≥ 3.1
-        wb.calculation.fullCalcOnLoad = True
-    elif hasattr(wb, "calc_properties") and wb.calc_properties is not None:
-        # openpyxl 3.0 系
-        wb.calc_properties.fullCalcOnLoad = True
-    # ────────────────────────────────────────
-
-    # メモリへ保存
-    bio = BytesIO()
-    wb.save(bio)
-    bio.seek(0)
-    return bio
+def _output_values(data: dict, date: datetime.date | None = None) -> dict:
+    """差し込むセルの値。date は出力日（作り直すときは元の出力日を渡す）。"""
+    today = (date or datetime.date.today()).strftime("%Y年%m月%d日")
+    return {
+        coord: (today if key is None else data.get(key, ""))
+        for coord, key in OUTPUT_CELLS
+    }
 
 
 # === 5. ファイル名ユーティリティ ================================
 def _make_filename() -> str:
     return f"見積書_{datetime.datetime.now():%Y%m%d_%H%M%S}.xlsx"
 
+# === 保存先（内容アドレス） =====================================
+# ブックの中身は差し込む 3 セルの値とひな形だけで決まる（.xlsx のバイト列は
+# 出力時刻を含むので、ファイルそのもののハッシュでは重複が見つからない）。
+# そこで「ひな形のハッシュ + セルの値」を key にして export_store に置く。
+# セルの値には F1 の出力日も入るので、同じ見積りでもまとまるのは同じ日の出力だけ
+# （日付の違うブックは中身も違うので別の blob になる。作り直すときは元の出力日を使う）。
+def _blob_key(values: dict) -> str:
+    h = hashlib.sha256(template_cache.template_fingerprint().encode("ascii"))
+    h.update(json.dumps(values, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _store_values(values: dict, user_id) -> tuple[str, str]:
+    """blob を用意して (key, 保存先) を返す。同じ内容が既にあれば作らない。"""
+    store = get_store()
+    key = _blob_key(values)
+    if store.exists(key):
+        store.add_ref(key, user_id)
+        store.touch(key)
+        return key, store.path(key)
+    path = store.put(key, build_from_values(values).getvalue(), user_id)
+    return key, path
+
+
+def _ensure_blob(key: str, values: dict, user_id=None) -> str:
+    """追い出された blob は値から作り直す。保存先を返す。"""
+    store = get_store()
+    path = store.ensure(key, lambda: build_from_values(values).getvalue(), user_id)
+    store.touch(key)
+    return path
+
+
+def _persist_export(user_id, filename: str, data: dict) -> tuple[str, str, dict]:
+    """blob を保存し、ログイン中なら履歴を残す。(key, 保存先, セルの値) を返す。"""
+    values = _output_values(data)
+    key, path = _store_values(values, user_id)
+    if user_id is not None:
+        _save_history(user_id, filename, data, key)
+    return key, path, values
+
+
+def history_file_path(row: dict, user_id: int) -> str | None:
+    """
+    excel_history の行に対応するファイル。
+    blob_key のある行は、追い出されていれば data_json と作成日から作り直す。
+    blob_key の無い古い行は exports/<user_id>/<filename> を見る。
+    """
+    key = row.get("blob_key")
+    if not key:
+        path = os.path.join(app.root_path, "exports", str(user_id), row["filename"])
+        if os.path.exists(path):
+            return path
+    try:
+        data = json.loads(row.get("data_json") or "{}")
+    except ValueError:
+        data = {}
+    created = row.get("created_at")
+    values = _output_values(data, created.date() if created else None)
+    if key:
+        return _ensure_blob(key, values, user_id)
+    # 古い行でファイルも無い → blob として作り直し、以後はそちらを指す
+    key, path = _store_values(values, user_id)
+    get_repository().set_history_blob_key(row["id"], user_id, key)
+    return path
+
+
+# === 配信（プロキシへの委譲 / ETag / Range） ====================
+# ownership の確認までは Python で行い、ファイルの転送は
+# config.EXPORT_SENDFILE に応じてフロントのプロキシへ任せる。
+#   'x-accel'    : nginx の X-Accel-Redirect（EXPORT_ACCEL_ROOT 配下を
+#                  internal な EXPORT_ACCEL_PREFIX に対応させておく）
+#   'x-sendfile' : Apache mod_xsendfile などの X-Sendfile
+#   None         : Python から送る（Range / 304 は werkzeug が処理）
+# blob は作り直すとファイルごと置き換わるので、mtime_ns + サイズを強い ETag にする。
+def _export_etag(st) -> str:
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+
+def _content_disposition(download_name: str) -> str:
+    # werkzeug の send_file と同じ形（ASCII 以外は filename* で送る）
+    try:
+        download_name.encode("ascii")
+        return f'attachment; filename="{download_name}"'
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", download_name).encode("ascii", "ignore").decode("ascii")
+        quoted = quote(download_name, safe="!#$&+^`|~")
+        return f"attachment; filename=\"{simple}\"; filename*=UTF-8''{quoted}"
+
+
+def _proxy_header(path: str):
+    """(ヘッダー名, 値)。プロキシに任せられないときは None。"""
+    mode = config.EXPORT_SENDFILE
+    if mode == "x-sendfile":
+        return "X-Sendfile", os.path.realpath(path)
+    if mode == "x-accel":
+        root = os.path.realpath(config.EXPORT_ACCEL_ROOT or os.path.join(app.root_path, "exports"))
+        rel = os.path.relpath(os.path.realpath(path), root)
+        if rel.startswith(os.pardir):
+            return None
+        return "X-Accel-Redirect", config.EXPORT_ACCEL_PREFIX.rstrip("/") + "/" + quote(rel.replace(os.sep, "/"))
+    return None
+
+
+def send_export(path: str, download_name: str, rebuild=None):
+    """
+    保存済みの出力ファイルを返す（呼び出し側で持ち主の確認を済ませておくこと）。
+    保存先を調べてから開くまでの間に blob が追い出されたら、rebuild() -> 保存先 で
+    1 回だけ作り直す（開いてしまえば消されても送り終わるまで読める）。
+    プロキシに任せるときはプロキシが後で開くので、呼び出し側で touch して追い出されにくくしておく。
+    """
+    try:
+        return _send_export(path, download_name)
+    except FileNotFoundError:
+        if rebuild is None:
+            raise
+        return _send_export(rebuild(), download_name)
+
+
+def _send_export(path: str, download_name: str):
+    st = os.stat(path)
+    etag = _export_etag(st)
+    header = _proxy_header(path)
+    if header is None:
+        return send_file(
+            path,
+            as_attachment=True,
+            download_name=download_name,
+            mimetype=XLSX_MIMETYPE,
+            etag=etag,
+            conditional=True,
+            last_modified=st.st_mtime,
+        )
+
+    rv = app.response_class(mimetype=XLSX_MIMETYPE)
+    rv.headers["Content-Disposition"] = _content_disposition(download_name)
+    rv.set_etag(etag)
+    rv.last_modified = st.st_mtime
+    rv.cache_control.no_cache = True
+    # If-None-Match / If-Modified-Since はここで 304 にする。Range はプロキシが処理する
+    rv = rv.make_conditional(request)
+    if rv.status_code != 304:
+        rv.headers[header[0]] = header[1]
+    return rv
+
+
 # === 6. ルート：ダウンロード ===================================
 @export_bp.route("/excel")
 def download_excel():
+    """同期版（JavaScript が無効なとき用）。通常は /export/jobs を使う。"""
     data = session.get("dashboard_data")
     if not data:
         flash("先に見積りを計算してください。")
         return redirect(url_for("dashboard.dashboard"))
 
-    bio = _build_workbook(data)
     filename = _make_filename()
 
-    # -- サーバー側へユーザー単位で保存 ---------------------
-    export_dir = os.path.join(app.root_path, "exports")
-    os.makedirs(export_dir, exist_ok=True)
+    # -- サーバー側へ保存（同じ内容なら既存の blob を使う） ----
+    user_id = session.get("user_id")
+    key, path, values = _persist_export(user_id, filename, data)
+
+    return send_export(path, filename, lambda: _ensure_blob(key, values, user_id))
+
+
+# === 7. バックグラウンド出力（ジョブキュー） =====================
+# 生成・保存・履歴登録をジョブとして実行し、ルートはジョブ id をすぐ返す。
+# クライアントは状態をポーリングし、done になったらダウンロードする。
+EXPORT_JOB = "export_excel"
+
+
+def _run_export_job(payload: dict) -> dict:
+    """ジョブキューのスレッドで実行（アプリコンテキストの外）。"""
+    filename = payload["filename"]
+    key, _, values = _persist_export(payload["user_id"], filename, payload["data"])
+    return {"filename": filename, "blob_key": key, "values": values}
+
+
+@export_bp.record_once
+def _register_job(state):
+    queue = state.app.extensions.get("job_queue")
+    if queue is not None:
+        queue.register(EXPORT_JOB, _run_export_job)
+
+
+def _job_owner() -> str:
+    """ジョブの持ち主。未ログインでもセッション単位で他人のジョブは見えない。"""
     if "user_id" in session:
-        user_dir = os.path.join(export_dir, str(session["user_id"]))
-        os.makedirs(user_dir, exist_ok=True)
-        with open(os.path.join(user_dir, filename), "wb") as f:
-            f.write(bio.getbuffer())
-        _save_history(session["user_id"], filename, data)
+        return f"user:{session['user_id']}"
+    if "export_owner" not in session:
+        session["export_owner"] = secrets.token_urlsafe(16)
+    return f"anon:{session['export_owner']}"
+
+
+def _job_response(job: dict):
+    body = {"job_id": job["id"], "status": job["status"]}
+    if job["status"] == "done":
+        body["download_url"] = url_for("export.download_job", job_id=job["id"])
+    elif job["status"] == "failed":
+        body["error"] = "Excel の作成に失敗しました。"
+    return body
+
+
+@export_bp.route("/jobs", methods=["POST"])
+def create_job():
+    """
+    画面のフォームが送られてきたらサーバーで計算し直して出力する
+    （画面のプレビューはブラウザで計算しているので、セッションの結果は古いことがある）。
+    フォームが無ければセッションの最後の計算結果を使う。
+    """
+    if request.form:
+        try:
+            data = _compute_dashboard_data(request.form, _request_profile(request.form))
+        except (ValueError, ZeroDivisionError) as e:
+            return jsonify({"error": str(e)}), 400
+        session["dashboard_data"] = data
     else:
-        with open(os.path.join(export_dir, filename), "wb") as f:
-            f.write(bio.getbuffer())
-
-    return send_file(
-        bio,
-        as_attachment=True,
-        download_name=filename,
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        data = session.get("dashboard_data")
+    if not data:
+        return jsonify({"error": "先に見積りを計算してください。"}), 400
+
+    payload = {
+        "data": data,
+        "filename": _make_filename(),
+        "user_id": session.get("user_id"),
+    }
+    try:
+        job_id = app.extensions["job_queue"].submit(EXPORT_JOB, _job_owner(), payload)
+    except QueueFull:
+        return jsonify({"error": "混み合っています。しばらくしてから再度お試しください。"}), 503, {"Retry-After": "5"}
+
+    return jsonify({
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": url_for("export.job_status", job_id=job_id),
+    }), 202
+
+
+@export_bp.route("/jobs/<job_id>")
+def job_status(job_id: str):
+    job = app.extensions["job_queue"].get(job_id, _job_owner())
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません。"}), 404
+    return jsonify(_job_response(job))
+
+
+@export_bp.route("/jobs/<job_id>/download")
+def download_job(job_id: str):
+    job = app.extensions["job_queue"].get(job_id, _job_owner())
+    if job is None:
+        return jsonify({"error": "ジョブが見つかりません。"}), 404
+    if job["status"] != "done":
+        return jsonify(_job_response(job)), 409
+    result = job["result"]
+    user_id = session.get("user_id")
+    rebuild = lambda: _ensure_blob(result["blob_key"], result["values"], user_id)
+    return send_export(rebuild(), result["filename"], rebuild)
+
+
+# === 8. 一括出力（複数の見積りを ZIP で） ========================
+# 各ブックの生成は CPU 処理なのでプロセスプールで並列に作る。
+# 先行投入は「ワーカー数 × 2」件までにして、できた順に ZIP へ書いては捨てるので
+# 全件の BytesIO を同時にメモリへ持たない。
+# プールは最初の一括出力のときに作るので、その時点では書き込みスレッドや監視スレッドが
+# 動いている。fork だとロックを握ったままのスレッドの状態を子が引き継ぐことがあるため、
+# ワーカーは spawn で起動する。ワーカーの入口は workbook.build_workbook_bytes なので、子が import するのは
+# workbook.py（ひな形キャッシュ）と config だけ。起動元の app.py は子で __mp_main__ として
+# 実行し直されるが、そこでは create_app() を呼ばないので init_* やジョブの再開は動かない。
+_bulk_pool = None
+_bulk_pool_lock = threading.Lock()
+
+
+def _get_bulk_pool() -> ProcessPoolExecutor:
+    global _bulk_pool
+    with _bulk_pool_lock:
+        if _bulk_pool is None:
+            _bulk_pool = ProcessPoolExecutor(
+                max_workers=config.EXPORT_BULK_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _bulk_pool
+
+
+def _parse_id_list(values) -> list[int]:
+    ids = []
+    for v in values:
+        for part in str(v).split(","):
+            part = part.strip()
+            if part:
+                ids.append(int(part))
+    return list(dict.fromkeys(ids))
+
+
+def _bulk_request_ids():
+    """JSON {"estimates": [...], "excel_history": [...]} または同名のフォーム項目。"""
+    payload = request.get_json(silent=True)
+    if isinstance(payload, dict):
+        get = lambda k: payload.get(k) or []
+    else:
+        get = request.form.getlist
+    return _parse_id_list(get("estimates")), _parse_id_list(get("excel_history"))
+
+
+def _bulk_items(user_id: int, estimate_ids: list, history_ids: list) -> list:
+    """
+    (ZIP 内のファイル名, 差し込むセルの値) のリスト。他人の id は黙って除く。
+    出力日は今日ではなく元の作成日（履歴から作り直すときの history_file_path と同じ）。
+    """
+    repo = get_repository()
+    items, used = [], set()
+
+    def add(name, data, created):
+        stem, ext = os.path.splitext(name)
+        n = 2
+        while name in used:
+            name = f"{stem}_{n}{ext}"
+            n += 1
+        used.add(name)
+        items.append((name, _output_values(data, created.date() if created else None)))
+
+    for row in repo.estimate_data_by_ids(user_id, estimate_ids):
+        try:
+            data = json.loads(row.get("estimate_data") or "{}")
+        except ValueError:
+            data = {}
+        created = row.get("created_at")
+        stamp = f"_{created:%Y%m%d_%H%M%S}" if created else ""
+        add(f"見積書_{row['id']}{stamp}.xlsx", data, created)
+
+    for row in repo.history_data_by_ids(user_id, history_ids):
+        try:
+            data = json.loads(row.get("data_json") or "{}")
+        except ValueError:
+            data = {}
+        add(row["filename"], data, row.get("created_at"))
+    return items
+
+
+class _ZipSink:
+    """ZipFile の書き込み先。書かれたバイト列をためておき、drain() で取り出す。"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        out, self._chunks = b"".join(self._chunks), []
+        return out
+
+
+def _stream_zip(items: list):
+    """できあがった順にブックを ZIP へ追加しながら送り出す。"""
+    pool = _get_bulk_pool()
+    ahead = config.EXPORT_BULK_WORKERS * 2
+    date_time = time.localtime(time.time())[:6]
+    sink = _ZipSink()
+    pending = {}
+    queue = iter(items)
+
+    def submit_next():
+        for name, values in queue:
+            pending[pool.submit(build_workbook_bytes, values)] = name
+            return
+
+    for _ in range(ahead):
+        submit_next()
+
+    try:
+        with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as zf:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = pending.pop(future)
+                    # .xlsx 自体が圧縮済みなので無圧縮で格納する
+                    zinfo = zipfile.ZipInfo(name, date_time)
+                    zinfo.external_attr = 0o600 << 16
+                    zf.writestr(zinfo, future.result())
+                    submit_next()
+                yield sink.drain()
+        yield sink.drain()
+    finally:
+        # 途中で切断されたら未着手の分は捨てる
+        for future in pending:
+            future.cancel()
+
+
+@export_bp.route("/bulk", methods=["POST"])
+def download_bulk():
+    if "user_id" not in session:
+        return jsonify({"error": "ログインが必要です。"}), 401
+    try:
+        estimate_ids, history_ids = _bulk_request_ids()
+    except (TypeError, ValueError):
+        return jsonify({"error": "id の指定が不正です。"}), 400
+    if len(estimate_ids) + len(history_ids) > config.EXPORT_BULK_MAX_ITEMS:
+        return jsonify({"error": f"一度に出力できるのは {config.EXPORT_BULK_MAX_ITEMS} 件までです。"}), 400
+
+    items = _bulk_items(session["user_id"], estimate_ids, history_ids)
+    if not items:
+        return jsonify({"error": "出力できる見積りがありません。"}), 404
+
+    filename = f"estimates_{datetime.datetime.now():%Y%m%d_%H%M%S}.zip"
+    return Response(
+        stream_with_context(_stream_zip(items)),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
     )
@@ -0,0 +1,192 @@
+# blueprints/presets.py ―― サーバー側で管理するプリセット（製品ごとの入力値）
+#
+# presets テーブルに「フォームの全項目」と「それで計算した dashboard_data」を保存する。
+# 計算は保存時に 1 回だけ行うので、画面でプリセットを適用しても計算リクエストは要らない。
+# 一覧（GET /presets/）は名前順のページ送り + 名前の部分一致検索で、ETag 付き。
+# 追加・更新・削除は config.ADMIN_USER_IDS のユーザーだけ。
+
+import hashlib
+import json
+
+from flask import Blueprint, Response, jsonify, request, session, abort
+
+import config
+from blueprints.dashboard import _compute_dashboard_data, _normalize_batch_row, _request_profile
+from profiles import DEFAULT_PROFILE
+from repository import get_repository
+
+presets_bp = Blueprint('presets', __name__, url_prefix='/presets')
+
+# 宛名・件名は見積りごとに違うのでプリセットには持たない（適用しても画面の値のまま）
+FORM_EXCLUDE = ('client_name', 'subject')
+NAME_MAX_LENGTH = 100
+
+
+# ----------------- 一覧のカーソル ----------------- #
+# 最後に返した行の「id.名前」（名前順で次ページへ進む）
+def _encode_cursor(row) -> str:
+    return f"{row['id']}.{row['name']}"
+
+
+def _decode_cursor(cursor: str):
+    last_id, sep, name = cursor.partition('.')
+    if not sep:
+        raise ValueError(cursor)
+    return name, int(last_id)
+
+
+def _preset_json(row) -> dict:
+    form = json.loads(row['form_json'])
+    if row['data_json'] is not None:
+        data = json.loads(row['data_json'])
+    else:
+        # 移行で入れた行など、まだ計算していないものは初回だけ計算して保存する
+        try:
+            data = _compute_dashboard_data(form)
+        except (ValueError, ZeroDivisionError):
+            data = None
+        else:
+            get_repository().set_preset_data(row['id'], json.dumps(data))
+    return {"id": row['id'], "name": row['name'], "img": row['img'], "form": form, "data": data}
+
+
+def _catalog_etag(*parts) -> str:
+    count, updated = get_repository().presets_version()
+    key = "|".join(str(p) for p in (count, updated) + parts)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _cacheable(response: Response, etag: str) -> Response:
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = config.PRESET_MAX_AGE
+    return response
+
+
+@presets_bp.route('/')
+def list_presets():
+    """
+    {"presets": [{id, name, img, form, data}, ...], "next": カーソル}
+    ?q= で名前の部分一致、?after= で次ページ。カタログが変わらなければ 304。
+    """
+    q = request.args.get('q', '').strip()
+    cursor = request.args.get('after', '')
+    after = None
+    if cursor:
+        try:
+            after = _decode_cursor(cursor)
+        except ValueError:
+            abort(400)
+
+    # 中身を読む前に、カタログの版（件数 + 最終更新）だけで 304 を判定する
+    etag = _catalog_etag(q, cursor, config.PRESET_PAGE_SIZE)
+    if etag in request.if_none_match:
+        return _cacheable(Response(status=304), etag)
+
+    # 1 件多く取って次ページの有無を判定する
+    limit = config.PRESET_PAGE_SIZE
+    rows = get_repository().list_presets_page(limit + 1, query=q, after=after)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1])
+
+    response = jsonify({"presets": [_preset_json(row) for row in rows], "next": next_cursor})
+    return _cacheable(response, etag)
+
+
+@presets_bp.route('/<int:preset_id>/apply', methods=['POST'])
+def apply_preset(preset_id: int):
+    """
+    適用したプリセットの計算結果をセッションに入れる（Excel 出力が使う）。
+    保存済みの結果は既定の係数なので、係数プロファイルが割り当てられているときだけ計算し直す。
+    宛名・件名だけは画面の値を使う。
+    """
+    row = get_repository().get_preset(preset_id)
+    if row is None:
+        return jsonify({"error": "プリセットが見つかりません。"}), 404
+    preset = _preset_json(row)
+    if preset['data'] is None:
+        return jsonify({"error": "このプリセットは計算できません。"}), 409
+    data = dict(preset['data'])
+    profile = _request_profile(request.form)
+    if profile is not DEFAULT_PROFILE:
+        form = {**preset['form'], 'client_name': request.form.get('client_name', '')}
+        try:
+            data = _compute_dashboard_data(form, profile)
+        except (ValueError, ZeroDivisionError) as e:
+            return jsonify({"error": str(e)}), 409
+    data['client_name'] = request.form.get('client_name', '').strip().removesuffix('様').strip()
+    data['subject'] = request.form.get('subject', '').strip()
+    session['dashboard_data'] = data
+    return jsonify({"ok": True})
+
+
+# ----------------- 管理（追加・更新・削除） ----------------- #
+def _is_admin() -> bool:
+    return session.get('user_id') in config.ADMIN_USER_IDS
+
+
+def _normalize_preset_form(form: dict) -> dict:
+    """
+    値を文字列に揃え、include_* は 'on' か ''（false / "0" / "off" などは外した扱い）にする。
+    外したチェックボックスも '' で残す（適用時に画面のチェックを外すため）。
+    """
+    form = {str(k): v for k, v in form.items() if k not in FORM_EXCLUDE}
+    normalized = _normalize_batch_row(form)
+    return {key: normalized.get(key, '') for key in form}
+
+
+def _parse_preset_body():
+    """JSON {name, img?, form} を検証し、(name, img, form_json, data_json) を返す。"""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        raise ValueError("JSON オブジェクトを送ってください。")
+    name = str(body.get('name') or '').strip()
+    if not name or len(name) > NAME_MAX_LENGTH:
+        raise ValueError(f"name は 1〜{NAME_MAX_LENGTH} 文字で指定してください。")
+    img = body.get('img') or None
+    form = body.get('form')
+    if not isinstance(form, dict):
+        raise ValueError("form はオブジェクトで指定してください。")
+    form = _normalize_preset_form(form)
+    # 保存時に 1 回だけ計算する（計算できない入力は保存しない）
+    data = _compute_dashboard_data(form)
+    return name, img, json.dumps(form, ensure_ascii=False), json.dumps(data)
+
+
+@presets_bp.route('/', methods=['POST'])
+def create_preset():
+    if not _is_admin():
+        return jsonify({"error": "権限がありません。"}), 403
+    try:
+        name, img, form_json, data_json = _parse_preset_body()
+    except (ValueError, ZeroDivisionError) as e:
+        return jsonify({"error": str(e)}), 400
+    repo = get_repository()
+    preset_id = repo.insert_preset(name, img, form_json, data_json)
+    return jsonify(_preset_json(repo.get_preset(preset_id))), 201
+
+
+@presets_bp.route('/<int:preset_id>', methods=['PUT'])
+def update_preset(preset_id: int):
+    if not _is_admin():
+        return jsonify({"error": "権限がありません。"}), 403
+    repo = get_repository()
+    if repo.get_preset(preset_id) is None:
+        return jsonify({"error": "プリセットが見つかりません。"}), 404
+    try:
+        name, img, form_json, data_json = _parse_preset_body()
+    except (ValueError, ZeroDivisionError) as e:
+        return jsonify({"error": str(e)}), 400
+    repo.update_preset(preset_id, name, img, form_json, data_json)
+    return jsonify(_preset_json(repo.get_preset(preset_id)))
+
+
+@presets_bp.route('/<int:preset_id>', methods=['DELETE'])
+def delete_preset(preset_id: int):
+    if not _is_admin():
+        return jsonify({"error": "権限がありません。"}), 403
+    if not get_repository().delete_preset(preset_id):
+        return jsonify({"error": "プリセットが見つかりません。"}), 404
+    return '', 204
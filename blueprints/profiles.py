@@ -0,0 +1,127 @@
+# blueprints/profiles.py ―― 係数プロファイルの管理（JSON）
+#
+# プロファイルの変更は新しい版の追加だけ（古い版は見積りの再現に使うので消さない）。
+# 割り当ては「宛名 → プロファイル名」「ユーザー → プロファイル名」。
+# 変更したらこのワーカーはすぐ読み直し、他のワーカーには通知ファイルで知らせる
+# （別ホストのワーカーは DB の版の確認で拾う）。
+# 変更は config.ADMIN_USER_IDS のユーザーだけ。
+
+import json
+
+from flask import Blueprint, jsonify, request, session
+
+import config
+from profiles import (
+    BINDING_KINDS, NAME_MAX_LENGTH, client_key, profile_cache, validate_coefficients,
+)
+from repository import get_repository
+
+profiles_bp = Blueprint('profiles', __name__, url_prefix='/profiles')
+
+TARGET_MAX_LENGTH = 255
+
+
+def _is_admin() -> bool:
+    return session.get('user_id') in config.ADMIN_USER_IDS
+
+
+def _forbidden():
+    return jsonify({"error": "権限がありません。"}), 403
+
+
+@profiles_bp.route('/')
+def list_profiles():
+    """{"profiles": [最新版...], "bindings": [...], "stats": {...}}（このワーカーの写し）"""
+    if not _is_admin():
+        return _forbidden()
+    return jsonify({
+        "profiles": [p.to_json() for p in profile_cache.latest()],
+        "bindings": profile_cache.bindings(),
+        "stats": profile_cache.stats(),
+    })
+
+
+@profiles_bp.route('/versions/<int:profile_id>')
+def get_version(profile_id: int):
+    """特定の版（estimates.coefficient_profile_id から計算を再現する用）。"""
+    if not _is_admin():
+        return _forbidden()
+    profile = profile_cache.get_version(profile_id)
+    if profile is None:
+        return jsonify({"error": "プロファイルが見つかりません。"}), 404
+    return jsonify(profile.to_json())
+
+
+@profiles_bp.route('/', methods=['POST'])
+def create_version():
+    """JSON {name, coefficients: {定数名: 値}} で新しい版を追加する（同じ name なら版が上がる）。"""
+    if not _is_admin():
+        return _forbidden()
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"error": "JSON オブジェクトを送ってください。"}), 400
+    name = str(body.get('name') or '').strip()
+    if not name or len(name) > NAME_MAX_LENGTH or name == 'default':
+        return jsonify({"error": f"name は 1〜{NAME_MAX_LENGTH} 文字（default 以外）で指定してください。"}), 400
+    try:
+        coefficients = validate_coefficients(body.get('coefficients'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    profile_id = get_repository().insert_profile_version(name, json.dumps(coefficients))
+    profile_cache.notify()
+    return jsonify(profile_cache.get_version(profile_id).to_json()), 201
+
+
+def _parse_binding(body):
+    """{kind, target} を検証して (kind, 正規化した target) を返す。"""
+    if not isinstance(body, dict):
+        raise ValueError("JSON オブジェクトを送ってください。")
+    kind = body.get('kind')
+    if kind not in BINDING_KINDS:
+        raise ValueError("kind は " + " / ".join(BINDING_KINDS) + " のどれかで指定してください。")
+    target = str(body.get('target') or '')
+    if kind == 'user':
+        try:
+            target = str(int(target))
+        except ValueError:
+            raise ValueError("user の target は users.id で指定してください。")
+    else:
+        target = client_key(target)
+    if not target or len(target) > TARGET_MAX_LENGTH:
+        raise ValueError(f"target は 1〜{TARGET_MAX_LENGTH} 文字で指定してください。")
+    return kind, target
+
+
+@profiles_bp.route('/bindings', methods=['PUT'])
+def set_binding():
+    """JSON {kind: "user" | "client", target, profile} で割り当てる（既にあれば差し替え）。"""
+    if not _is_admin():
+        return _forbidden()
+    body = request.get_json(silent=True)
+    try:
+        kind, target = _parse_binding(body)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    name = str(body.get('profile') or '').strip()
+    if name not in {p.name for p in profile_cache.latest()}:
+        return jsonify({"error": "プロファイルが見つかりません。"}), 404
+
+    get_repository().set_profile_binding(kind, target, name)
+    profile_cache.notify()
+    return jsonify({"kind": kind, "target": target, "profile": name})
+
+
+@profiles_bp.route('/bindings', methods=['DELETE'])
+def delete_binding():
+    """JSON {kind, target} の割り当てを外す（以降は既定の係数 / ユーザーの割り当て）。"""
+    if not _is_admin():
+        return _forbidden()
+    try:
+        kind, target = _parse_binding(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not get_repository().delete_profile_binding(kind, target):
+        return jsonify({"error": "割り当てが見つかりません。"}), 404
+    profile_cache.notify()
+    return '', 204
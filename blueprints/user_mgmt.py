@@ -1,29 +1,171 @@
-from flask import Blueprint, render_template, redirect, url_for, session, request
-from db import get_connection, get_account_column
+from flask import (
+    Blueprint, render_template, redirect, url_for, session, request, jsonify, abort,
+    current_app as app,
+)
+import os
+import shutil
+import time
+import config
+from blueprints import export
+from blueprints.dashboard import estimate_writer
+from export_store import get_store
+from job_queue import report_progress
+from repository import get_repository
+from session_store import revoke_user_sessions
 
 user_mgmt_bp = Blueprint('user_mgmt', __name__, url_prefix='/user_mgmt')
 
+
+# ----------------- 一覧のカーソル ----------------- #
+# 検索なしは最後の id、検索ありは「id.アカウント名」（名前順で次ページへ進む）
+def _encode_cursor(row, by_name: bool) -> str:
+    if by_name:
+        return f"{row['id']}.{row['account_name']}"
+    return str(row['id'])
+
+
+def _decode_cursor(cursor: str, by_name: bool):
+    if by_name:
+        last_id, sep, name = cursor.partition('.')
+        if not sep:
+            raise ValueError(cursor)
+        return name, int(last_id)
+    return int(cursor)
+
+
 @user_mgmt_bp.route('/')
 def index():
+    """
+    ユーザー一覧（ページ送り + アカウント名の前方一致検索）。
+    ?format=json なら {"users": [...], "next": カーソル} を返す（続きの読み込み用）。
+    """
     if 'user_id' not in session:
+        if request.args.get('format') == 'json':
+            return jsonify({"error": "ログインが必要です。"}), 401
         return redirect(url_for('auth.login'))
-    conn = get_connection()
-    account_col = get_account_column()
-    with conn.cursor() as cursor:
-        cursor.execute(f"SELECT id, {account_col} FROM users ORDER BY id")
-        users = cursor.fetchall()
-        for user in users:
-            user['account_name'] = user.get(account_col)
-    conn.close()
-    return render_template('user_mgmt.html', users=users)
+
+    q = request.args.get('q', '').strip()
+    after = None
+    cursor = request.args.get('after')
+    if cursor:
+        try:
+            after = _decode_cursor(cursor, by_name=bool(q))
+        except ValueError:
+            abort(400)
+
+    # 1 件多く取って次ページの有無を判定する
+    limit = config.USER_MGMT_PAGE_SIZE
+    users = get_repository().list_users_page(limit + 1, prefix=q, after=after)
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = _encode_cursor(users[-1], by_name=bool(q))
+
+    if request.args.get('format') == 'json':
+        return jsonify({"users": users, "next": next_cursor})
+    return render_template('user_mgmt.html', users=users, q=q, next_cursor=next_cursor,
+                           purge_job=request.args.get('purge'))
+
+
+# ----------------- ユーザー削除後の後片付け（ジョブ） ----------------- #
+# users の行とセッションはその場で消し、履歴・見積り・出力ファイルはジョブで少しずつ消す。
+# ジョブは users の行を消せてから積む（消せなかったユーザーの関連データは消さない）。
+# 行を消したあとでキューが溢れていても、ジョブは queued のまま残して後で拾い直す。
+# どの段階も何度やり直しても同じ結果になるので、落ちたら最初から流し直せばよい
+# （job_queue が USER_PURGE_RESUME_AFTER 秒止まったジョブを拾い直す）。
+# 他のワーカーのキュー・spool に残っている行は、書くときに users に無いユーザーの分を
+# 捨てるので（Repository.insert_history_batch / save_estimate）、後から孤児の行は入らない。
+PURGE_JOB = 'purge_user'
+
+
+def _purge_rows(progress: dict, table: str, purge, user_id: int):
+    progress['stage'] = table
+    while True:
+        deleted = purge(user_id, config.USER_PURGE_BATCH)
+        progress[table] += deleted
+        report_progress(progress)
+        if deleted < config.USER_PURGE_BATCH:
+            return
+        time.sleep(config.USER_PURGE_PAUSE)
+
+
+def _purge_files(progress: dict, user_dir: str):
+    """exports/<user_id>/（blob_key 導入前の出力）を消す。"""
+    progress['stage'] = 'files'
+    report_progress(progress)
+    if not os.path.isdir(user_dir):
+        return
+    for entry in os.scandir(user_dir):
+        if entry.is_file(follow_symlinks=False):
+            os.remove(entry.path)
+            progress['files'] += 1
+            if progress['files'] % 100 == 0:
+                report_progress(progress)
+    shutil.rmtree(user_dir, ignore_errors=True)
+
+
+def _purge_user(payload: dict) -> dict:
+    """ジョブキューのスレッドで実行（アプリコンテキストの外）。"""
+    user_id = payload['user_id']
+    repo = get_repository()
+    progress = {"user_id": user_id, "stage": "sessions",
+                "excel_history": 0, "estimates": 0, "files": 0, "blobs": 0}
+    # 削除の時点で処理中だったリクエストが保存し直したセッションも消す
+    revoke_user_sessions(user_id)
+    # 係数プロファイルの割り当ても外す（各ワーカーは DB の版の確認で拾う）
+    repo.delete_profile_binding('user', str(user_id))
+    # 書き込み待ちの行を先に書き切る（消したあとに孤児の行が入らないように）
+    for writer in (export.history_writer, estimate_writer):
+        if writer is not None:
+            writer.flush()
+    _purge_rows(progress, 'excel_history', repo.purge_user_history, user_id)
+    _purge_rows(progress, 'estimates', repo.purge_user_estimates, user_id)
+    _purge_files(progress, payload['exports_dir'])
+    progress['stage'] = 'blobs'
+    progress['blobs'] = get_store().drop_user(user_id)
+    progress['stage'] = 'done'
+    return progress
+
+
+@user_mgmt_bp.record_once
+def _register_job(state):
+    queue = state.app.extensions.get('job_queue')
+    if queue is not None:
+        queue.register(PURGE_JOB, _purge_user, resume_after=config.USER_PURGE_RESUME_AFTER)
+
+
+def _job_owner() -> str:
+    return f"user:{session['user_id']}"
+
 
 @user_mgmt_bp.route('/delete/<int:user_id>', methods=['POST'])
 def delete_user(user_id: int):
     if 'user_id' not in session:
         return redirect(url_for('auth.login'))
-    conn = get_connection()
-    with conn.cursor() as cursor:
-        cursor.execute("DELETE FROM users WHERE id=%s", (user_id,))
-    conn.commit()
-    conn.close()
-    return redirect(url_for('user_mgmt.index'))
+    if session['user_id'] not in config.ADMIN_USER_IDS:
+        return "権限がありません。", 403
+    payload = {
+        "user_id": user_id,
+        "exports_dir": os.path.join(app.root_path, 'exports', str(user_id)),
+    }
+    # 先に users の行を消す（失敗したらジョブは積まず、何も消さない）。
+    # 行が無くなってから積むので、ジョブの実行中に「ユーザーが居る」と判断して書かれる行は無い
+    get_repository().delete_user(user_id)
+    revoke_user_sessions(user_id)
+    # もう取り消せないので、溢れていても捨てずに queued で残す（job_queue が拾い直す）
+    job_id = app.extensions['job_queue'].submit(PURGE_JOB, _job_owner(), payload, defer=True)
+    return redirect(url_for('user_mgmt.index', q=request.args.get('q') or None, purge=job_id))
+
+
+@user_mgmt_bp.route('/purge/<job_id>')
+def purge_status(job_id: str):
+    """削除ジョブの状態と途中経過（消した行数・ファイル数）。"""
+    if 'user_id' not in session:
+        return jsonify({"error": "ログインが必要です。"}), 401
+    job = app.extensions['job_queue'].get(job_id, _job_owner())
+    if job is None or job['kind'] != PURGE_JOB:
+        return jsonify({"error": "ジョブが見つかりません。"}), 404
+    body = {"job_id": job_id, "status": job['status'], "progress": job['result']}
+    if job['status'] == 'failed':
+        body['error'] = "関連データの削除に失敗しました。"
+    return jsonify(body)
@@ -0,0 +1,226 @@
+# calc_cache.py ―― 計算結果のプロセス内キャッシュ（LRU + TTL + single-flight）
+#
+# auto-calc.js は入力のたびにフォーム全体を POST するため、同じ入力の組み合わせが
+# 何度も届く。解析済みの入力から作ったキーで結果を使い回し、同じキーの同時要求は
+# 1 回の計算にまとめる。shared_path を渡すと SQLite ファイルを介して
+# 同じホストの他ワーカーとも結果を共有する。
+# 差分再計算の直近状態（StateStore）も同じ仕組みで他ワーカーと共有できる。
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_key(parts) -> str:
+    """入力値のタプルから正規化したハッシュキーを作る。"""
+    return hashlib.sha256(repr(tuple(parts)).encode('utf-8')).hexdigest()
+
+
+class _Flight:
+    """計算中のキー 1 つ分。後から来た要求はここで完了を待つ。"""
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SqliteBackend:
+    """同一ホストのワーカー間で共有する SQLite ファイル（値は JSON で保存する）。"""
+
+    PURGE_EVERY = 256
+
+    def __init__(self, path: str, table: str = 'calc_cache'):
+        self.path = path
+        self.table = table
+        self._local = threading.local()
+        self._sets = 0
+        conn = self._conn()
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str):
+        row = self._conn().execute(
+            f"SELECT value FROM {self.table} WHERE key=? AND expires>?", (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value, ttl: float):
+        conn = self._conn()
+        conn.execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, value, expires) VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time() + ttl),
+        )
+        self._sets += 1
+        if self._sets % self.PURGE_EVERY == 0:
+            conn.execute(f"DELETE FROM {self.table} WHERE expires<=?", (time.time(),))
+
+    def clear(self):
+        self._conn().execute(f"DELETE FROM {self.table}")
+
+
+class ResultCache:
+    """
+    LRU + TTL のキャッシュ。get_or_compute(key, fn) で
+    ヒットすれば保存済みの値、ミスなら fn() を 1 回だけ実行して保存する。
+    fn() の例外はキャッシュせず、待っていた要求にもそのまま送出する。
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 300, shared_path: str | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = SqliteBackend(shared_path) if shared_path else None
+        self._data: OrderedDict[str, tuple[float, object]] = OrderedDict()
+        self._inflight: dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def _get_local(self, key: str, now: float):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires <= now:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def _put_local(self, key: str, value, now: float):
+        self._data[key] = (now + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_compute(self, key: str, compute):
+        now = time.monotonic()
+        with self._lock:
+            value = self._get_local(key, now)
+            if value is not None:
+                self.hits += 1
+                return value
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        shared = False
+        try:
+            value = self.backend.get(key) if self.backend else None
+            if value is not None:
+                shared = True
+            else:
+                value = compute()
+                if self.backend:
+                    self.backend.set(key, value, self.ttl)
+            flight.value = value
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if flight.error is None:
+                    self._put_local(key, flight.value, time.monotonic())
+                    if shared:
+                        self.shared_hits += 1
+                    else:
+                        self.misses += 1
+                del self._inflight[key]
+            flight.event.set()
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+        if self.backend:
+            self.backend.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses + self.coalesced
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "shared": self.backend is not None,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "inflight": len(self._inflight),
+                "hit_ratio": (lookups - self.misses) / lookups if lookups else 0.0,
+            }
+
+
+class StateStore:
+    """
+    トークン -> 直近の計算状態 を保持する LRU + TTL の辞書（差分再計算用）。
+    shared_path を渡すと状態は SQLite ファイル（delta_state テーブル）にだけ置き、
+    同じホストのどのワーカーに要求が届いても続きを計算できる。状態は要求のたびに
+    書き換わるので、プロセス内には持たない（持つと他ワーカーの更新より古くなる）。
+    共有時の値は JSON で往復するので、タプルは入れずにリストか文字列にしておくこと。
+    """
+
+    def __init__(self, maxsize: int = 2048, ttl: float = 1800, shared_path: str | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = SqliteBackend(shared_path, table='delta_state') if shared_path else None
+        self._data: OrderedDict[str, tuple[float, object]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token: str):
+        if self.backend:
+            return self.backend.get(token)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(token)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= now:
+                del self._data[token]
+                return None
+            self._data.move_to_end(token)
+            return value
+
+    def put(self, token: str, value):
+        if self.backend:
+            self.backend.set(token, value, self.ttl)
+            return
+        with self._lock:
+            self._data[token] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(token)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
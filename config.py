@@ -1 +1,105 @@
+# config.py ―― アプリ全体の設定値（環境ごとに書き換える）
 
+# ----------------- /dashboard/calculate 結果キャッシュ ----------------- #
+CALC_CACHE_MAXSIZE     = 4096        # プロセス内 LRU の最大件数
+CALC_CACHE_TTL         = 300         # 秒
+# 複数ワーカーで共有する場合は SQLite ファイルのパスを指定（None なら共有しない）
+CALC_CACHE_SHARED_PATH = None
+
+# ----------------- 差分再計算（/dashboard/calculate/delta） ----------------- #
+DELTA_STATE_MAXSIZE    = 2048        # 保持するトークン数
+DELTA_STATE_TTL        = 1800        # 秒（最後の更新から）
+# 複数ワーカーで状態を共有する場合は SQLite ファイルのパスを指定（None ならプロセス内だけ。
+# その場合は同じセッションの要求が同じワーカーに届くようロードバランサで sticky にすること）
+DELTA_STATE_SHARED_PATH = None
+
+# ----------------- サーバー側セッション ----------------- #
+# 'sqlite' / 'file' でサーバー側に保存（Cookie は ID のみ）。None なら Flask 標準の Cookie セッション
+SESSION_BACKEND        = 'sqlite'
+SESSION_PATH           = None        # None なら instance/ 配下（sessions.sqlite3 / sessions/）
+SESSION_IDLE_TIMEOUT   = 8 * 3600    # 最後の利用からの有効期限（秒）
+SESSION_FRONT_MAXSIZE  = 1024        # プロセス内 LRU の件数
+SESSION_SWEEP_INTERVAL = 600         # 期限切れ掃除の間隔（秒）。0 なら掃除スレッドを起動しない
+
+# ----------------- DB コネクションプール ----------------- #
+DB_POOL_MAXSIZE        = 10          # 1 プロセスあたりの最大接続数
+DB_POOL_TIMEOUT        = 5           # 空き待ちの上限（秒）
+DB_POOL_MAX_LIFETIME   = 3600        # この秒数を超えた接続は作り直す
+DB_POOL_PING_AFTER     = 5           # この秒数以上アイドルだった接続は貸出時に ping
+
+# ----------------- スキーマ移行（migrations.py） ----------------- #
+DB_AUTO_MIGRATE        = False       # True なら起動時に未適用の移行を流す
+DB_SCHEMA_CHECK        = True        # 起動時にスキーマの版を確認し、古ければ起動を止める
+
+# ----------------- Excel 出力（blueprints/export.py） ----------------- #
+EXPORT_FAST_PATH       = True        # ひな形 zip の XML を直接差し替えて出力（False なら毎回 openpyxl）
+EXPORT_BULK_WORKERS    = 4           # 一括出力（/export/bulk）のプロセス数
+EXPORT_BULK_MAX_ITEMS  = 200         # 一括出力 1 回あたりの上限件数
+
+# ----------------- ジョブキュー（job_queue.py） ----------------- #
+JOB_QUEUE_PATH         = None        # None なら instance/jobs.sqlite3
+JOB_WORKERS            = 2           # 1 プロセスあたりの同時実行数
+JOB_MAX_QUEUE          = 32          # 1 プロセスあたりの待ち + 実行中の上限（超えたら 503）
+JOB_RETENTION          = 86400       # 終わったジョブの記録を残す秒数
+JOB_STALE_AFTER        = 3600        # 起動時、これより古い queued / running は failed にする
+
+# ----------------- 出力ファイルの保存先（export_store.py） ----------------- #
+EXPORT_STORE_DIR       = None        # None なら exports/blobs/
+EXPORT_USER_QUOTA      = 200 * 1024 * 1024       # ユーザーごとの上限（バイト）。0 なら無制限
+EXPORT_GLOBAL_QUOTA    = 5 * 1024 * 1024 * 1024  # 全体の上限（バイト）。0 なら無制限
+
+# ----------------- 見積り履歴（/estimate/history） ----------------- #
+HISTORY_PAGE_SIZE      = 50          # 1 ページの件数
+
+# ----------------- 出力ファイルの配信 ----------------- #
+# 'x-accel'（nginx）/ 'x-sendfile'（Apache など）ならファイル転送をプロキシに任せる。None なら Python から送る
+EXPORT_SENDFILE        = None
+EXPORT_ACCEL_ROOT      = None        # X-Accel-Redirect で渡すディレクトリ（None なら exports/）
+EXPORT_ACCEL_PREFIX    = '/_protected/exports/'  # 上のディレクトリに対応する nginx の internal location
+
+# ----------------- 見積りの保存（/dashboard/post） ----------------- #
+ESTIMATE_KEEP_ACTIVE   = 3           # ユーザーごとに有効（active）で残す件数
+ESTIMATE_WRITE_BEHIND  = 0           # 秒。正なら連続した保存をまとめて最後の 1 件だけ書く（0 なら同期）
+
+# ----------------- excel_history の書き込み（write-behind） ----------------- #
+HISTORY_WRITE_BEHIND   = True        # False なら出力のたびにその場で INSERT
+HISTORY_BATCH_ROWS     = 100         # この行数たまったら書く
+HISTORY_FLUSH_MS       = 200         # たまらなくてもこの間隔（ミリ秒）で書く
+HISTORY_MAX_QUEUE      = 5000        # キューの上限（溢れたらその場で INSERT）
+HISTORY_SPOOL_DIR      = None        # 未書き込み行の退避先（None なら instance/spool/）
+HISTORY_MAX_RETRIES    = 3           # 接続断以外の失敗がこの回数続いたバッチは行を分け、書けない行は spool の .dead へ
+
+# ----------------- 一括ダンプ（/dump） ----------------- #
+ADMIN_USER_IDS         = ()          # 全ユーザー分（?scope=all）をダンプできる users.id
+DB_STREAM_NET_WRITE_TIMEOUT = 600    # 秒。サーバー側カーソルで読む間の net_write_timeout（0 なら変更しない）
+DUMP_CHUNK_ROWS        = 500         # この行数ごとにまとめてクライアントへ送る
+
+# ----------------- パスワードハッシュ（password_hasher.py） ----------------- #
+PASSWORD_HASH_ROUNDS   = 12          # bcrypt のコスト。上げるとログイン成功時に古いハッシュを作り直す
+PASSWORD_HASH_WORKERS  = 2           # 1 プロセスあたりの同時計算数
+PASSWORD_HASH_MAX_PENDING = 16       # 計算中 + 待ちの上限
+PASSWORD_HASH_WAIT     = 2.0         # 枠の空きを待つ上限（秒）。超えたら 503
+PASSWORD_HASH_TIMEOUT  = 5.0         # 枠待ち + キュー待ち + 計算の上限（秒）。超えたら 503
+LOGIN_MAX_FAILURES     = 5           # この回数続けて失敗したアカウントは（0 なら制限しない）
+LOGIN_FAILURE_WINDOW   = 900         # この秒数の間に数えた失敗で
+LOGIN_LOCKOUT          = 300         # 最後の失敗からこの秒数ロックする
+
+# ----------------- ユーザー管理（/user_mgmt） ----------------- #
+USER_MGMT_PAGE_SIZE    = 50          # 1 ページ（JSON では 1 回の読み込み）の件数
+USER_PURGE_BATCH       = 1000        # ユーザー削除後、関連行を 1 文で消す行数
+USER_PURGE_PAUSE       = 0.05        # 秒。バッチの間に空ける（他のトランザクションを先に通す）
+USER_PURGE_RESUME_AFTER = 300        # 秒。途中経過がこれだけ止まっている削除ジョブは拾い直す
+
+# ----------------- 静的ファイル（assets.py） ----------------- #
+ASSET_MAX_AGE          = 365 * 86400 # ハッシュ付きファイルのキャッシュ期間（秒）。immutable も付ける
+ASSET_THUMB_SIZES      = (80, 160)   # img/ のサムネイル（正方形, px）。プリセットの表示サイズとその 2 倍
+ASSET_THUMB_QUALITY    = 80          # AVIF / WebP の品質
+
+# ----------------- プリセット（/presets） ----------------- #
+PRESET_PAGE_SIZE       = 24          # 1 回に読み込む件数
+PRESET_MAX_AGE         = 60          # 秒。この間はブラウザが再検証せずに使う（以降は ETag で確認）
+
+# ----------------- 係数プロファイル（profiles.py） ----------------- #
+PROFILE_NOTIFY_PATH    = None        # 変更の通知ファイル（None なら instance/coefficient_profiles.notify）
+PROFILE_NOTIFY_CHECK   = 1.0         # 秒。通知ファイルの mtime を確かめる間隔（同じホストの変更はこれで拾う）
+PROFILE_POLL_INTERVAL  = 30          # 秒。DB の版を確かめる間隔（他ホストの変更用。0 なら確かめない）
@@ -1,10 +1,20 @@
+import threading
+import time
+
+from flask import g, has_app_context
 import pymysql
-from pymysql.cursors import DictCursor
+from pymysql.constants.SERVER_STATUS import SERVER_STATUS_IN_TRANS
+from pymysql.cursors import DictCursor, SSDictCursor
+
+import config
 
 # Cache of the column name used for the account identifier
 ACCOUNT_COLUMN = None
+# Cache of the users table columns (introspected once)
+USERS_COLUMNS = None
 
-def get_connection():
+
+def _connect():
     return pymysql.connect(
         host='localhost',
         user='flaskuser',
@@ -15,31 +25,269 @@ def get_connection():
     )
 
 
+class PoolTimeout(RuntimeError):
+    """Raised when no pooled connection becomes free within the timeout."""
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of pymysql connections.
+
+    Connections are health-checked (ping) on checkout when they have been
+    idle for more than ``ping_after`` seconds and are recycled once they are
+    older than ``max_lifetime`` seconds.
+    """
+
+    def __init__(self, factory, maxsize: int, timeout: float,
+                 max_lifetime: float, ping_after: float):
+        self.factory = factory
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.ping_after = ping_after
+        self._idle = []                 # [(conn, created_at, released_at)]
+        self._created = {}              # id(conn) -> created_at
+        self._cond = threading.Condition()
+        self.in_use = 0
+        self.opened = 0
+        self.recycled = 0
+        self.health_failures = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+
+    def _size(self) -> int:
+        return self.in_use + len(self._idle)
+
+    def _discard(self, conn):
+        self._created.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """Check out a raw connection (blocks up to ``timeout`` seconds)."""
+        deadline = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, created_at, released_at = self._idle.pop()
+                    self.in_use += 1
+                    break
+                if self._size() < self.maxsize:
+                    conn = None
+                    self.in_use += 1
+                    break
+                if deadline is None:
+                    deadline = time.monotonic() + self.timeout
+                    self.waits += 1
+                    wait_started = time.monotonic()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    self.wait_time += time.monotonic() - wait_started
+                    raise PoolTimeout('database connection pool exhausted')
+                self._cond.wait(remaining)
+            if deadline is not None:
+                self.wait_time += time.monotonic() - wait_started
+            self.checkouts += 1
+
+        try:
+            now = time.monotonic()
+            if conn is not None and now - created_at > self.max_lifetime:
+                self._discard(conn)
+                self.recycled += 1
+                conn = None
+            if conn is not None and now - released_at > self.ping_after:
+                try:
+                    conn.ping(reconnect=False)
+                except Exception:
+                    self._discard(conn)
+                    self.health_failures += 1
+                    conn = None
+            if conn is None:
+                conn = self.factory()
+                self._created[id(conn)] = time.monotonic()
+                self.opened += 1
+        except BaseException:
+            with self._cond:
+                self.in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def release(self, conn, discard: bool = False):
+        """Return a connection; an open transaction is rolled back first."""
+        if not discard:
+            try:
+                if conn.server_status & SERVER_STATUS_IN_TRANS:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        with self._cond:
+            self.in_use -= 1
+            if discard or not conn.open:
+                self._discard(conn)
+            else:
+                created_at = self._created.get(id(conn), time.monotonic())
+                self._idle.append((conn, created_at, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "maxsize": self.maxsize,
+                "in_use": self.in_use,
+                "idle": len(self._idle),
+                "opened": self.opened,
+                "recycled": self.recycled,
+                "health_failures": self.health_failures,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_time": round(self.wait_time, 6),
+                "timeouts": self.timeouts,
+            }
+
+
+class PooledConnection:
+    """
+    Proxy around a pooled connection. ``close()`` gives the connection back
+    to the pool; for the per-request connection it is a no-op and the
+    connection is returned at app-context teardown instead.
+    """
+
+    def __init__(self, pool: ConnectionPool, conn, request_scoped: bool = False):
+        self._pool = pool
+        self._conn = conn
+        self._request_scoped = request_scoped
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise pymysql.err.InterfaceError('connection already returned to the pool')
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._request_scoped or self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        self._pool.release(conn)
+
+    def _return(self, discard: bool = False):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn, discard=discard)
+
+
+pool = ConnectionPool(
+    _connect,
+    maxsize=config.DB_POOL_MAXSIZE,
+    timeout=config.DB_POOL_TIMEOUT,
+    max_lifetime=config.DB_POOL_MAX_LIFETIME,
+    ping_after=config.DB_POOL_PING_AFTER,
+)
+
+
+def get_connection():
+    """
+    Return a pooled connection.
+
+    Inside an app context every call shares one connection per request
+    (stored on ``flask.g``); calling ``close()`` on it is harmless.
+    Outside a request (background threads) a connection is checked out and
+    goes back to the pool on ``close()``.
+    """
+    if has_app_context():
+        conn = g.get('_db_conn')
+        if conn is None:
+            conn = g._db_conn = PooledConnection(pool, pool.acquire(), request_scoped=True)
+        return conn
+    return PooledConnection(pool, pool.acquire())
+
+
+def stream_query(sql: str, params=()):
+    """
+    Yield rows one by one through an unbuffered ``SSDictCursor``.
+
+    Memory stays constant regardless of the result size. The connection is
+    checked out separately from the per-request one, because an unbuffered
+    result blocks every other query on its connection until it is read to
+    the end. If the generator is closed early (client disconnect), the
+    connection is discarded instead of draining the remaining rows.
+    """
+    conn = pool.acquire()
+    finished = False
+    try:
+        if config.DB_STREAM_NET_WRITE_TIMEOUT:
+            with conn.cursor() as cursor:
+                # a slow client must not make the server abort the result
+                cursor.execute("SET SESSION net_write_timeout = %s",
+                               (config.DB_STREAM_NET_WRITE_TIMEOUT,))
+        cursor = conn.cursor(SSDictCursor)
+        cursor.execute(sql, params)
+        while True:
+            row = cursor.fetchone()
+            if row is None:
+                break
+            yield row
+        cursor.close()
+        finished = True
+    finally:
+        pool.release(conn, discard=not finished)
+
+
+def release_request_connection(exc=None):
+    """Teardown hook: return the request's connection to the pool."""
+    conn = g.pop('_db_conn', None)
+    if conn is not None:
+        conn._return(discard=isinstance(exc, pymysql.err.OperationalError))
+
+
+def pool_stats() -> dict:
+    return pool.stats()
+
+
+def init_db(app):
+    """Register the per-request connection teardown on the app."""
+    app.teardown_appcontext(release_request_connection)
+
+
+def get_users_columns() -> tuple:
+    """Return the column names of the users table (introspected once)."""
+    global USERS_COLUMNS
+    if USERS_COLUMNS is None:
+        conn = get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT column_name AS name FROM information_schema.columns
+                    WHERE table_schema = DATABASE() AND table_name = 'users'
+                    ORDER BY ordinal_position
+                    """
+                )
+                USERS_COLUMNS = tuple(row['name'] for row in cursor.fetchall())
+        finally:
+            conn.close()
+    return USERS_COLUMNS
+
+
 def get_account_column() -> str:
     """Return the column name used to identify accounts in the users table."""
     global ACCOUNT_COLUMN
     if ACCOUNT_COLUMN:
         return ACCOUNT_COLUMN
 
-    conn = get_connection()
-    try:
-        with conn.cursor() as cursor:
-            for candidate in ('account_name', 'username', 'email'):
-                cursor.execute("SHOW COLUMNS FROM users LIKE %s", (candidate,))
-                if cursor.fetchone():
-
-
-                    
-                    ACCOUNT_COLUMN = candidate
-                    break
-            if not ACCOUNT_COLUMN:
-                cursor.execute("SHOW COLUMNS FROM users")
-                cols = [row['Field'] for row in cursor.fetchall()]
-                raise RuntimeError(
-                    'users table must contain account_name, username or email column. '
-                    f"Available columns: {', '.join(cols)}"
-                )
-    finally:
-        conn.close()
+    cols = get_users_columns()
+    for candidate in ('account_name', 'username', 'email'):
+        if candidate in cols:
+            ACCOUNT_COLUMN = candidate
+            break
+    else:
+        raise RuntimeError(
+            'users table must contain account_name, username or email column. '
+            f"Available columns: {', '.join(cols)}"
+        )
 
     return ACCOUNT_COLUMN
@@ -4,46 +4,69 @@ from flask import (
     render_template,
     redirect,
     url_for,
-    send_file,
+    request,
+    jsonify,
+    abort,
 )
-from flask import current_app as app
+import datetime
 import json
-import os
-from db import get_connection
+import config
+from blueprints.export import history_file_path, send_export
+from repository import get_repository
 
 
 estimate_blueprint = Blueprint('estimate', __name__)
 
 
+# ----------------- 履歴一覧のカーソル ----------------- #
+# 最後に表示した行の (created_at, id) を「YYYYmmddHHMMSS.id」にして次ページへ渡す
+def _encode_cursor(row) -> str:
+    return f"{row['created_at']:%Y%m%d%H%M%S}.{row['id']}"
+
+
+def _decode_cursor(cursor: str):
+    stamp, _, last_id = cursor.partition('.')
+    return datetime.datetime.strptime(stamp, '%Y%m%d%H%M%S'), int(last_id)
+
+
 @estimate_blueprint.route('/history', endpoint='history')
 def history():
     if 'user_id' not in session:
         return redirect(url_for('auth.login'))
     user_id = session['user_id']
-    conn = get_connection()
-    with conn.cursor() as cursor:
-        cursor.execute(
-            '''CREATE TABLE IF NOT EXISTS excel_history (
-                   id INT AUTO_INCREMENT PRIMARY KEY,
-                   user_id INT NOT NULL,
-                   filename VARCHAR(255) NOT NULL,
-                   data_json TEXT,
-                   created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-               )'''
-        )
-        cursor.execute(
-            'SELECT id, filename, data_json, created_at FROM excel_history WHERE user_id=%s ORDER BY created_at DESC',
-            (user_id,)
-        )
-        history_list = cursor.fetchall()
-    conn.close()
 
-    for row in history_list:
+    after = None
+    cursor = request.args.get('after')
+    if cursor:
         try:
-            row['data'] = json.loads(row.get('data_json', '{}'))
-        except Exception:
-            row['data'] = {}
-    return render_template('history.html', history_list=history_list)
+            after = _decode_cursor(cursor)
+        except ValueError:
+            abort(400)
+
+    # 1 件多く取って次ページの有無を判定する
+    limit = config.HISTORY_PAGE_SIZE
+    history_list = get_repository().list_history_page(user_id, limit + 1, after)
+    next_cursor = None
+    if len(history_list) > limit:
+        history_list = history_list[:limit]
+        next_cursor = _encode_cursor(history_list[-1])
+
+    return render_template('history.html', history_list=history_list, next_cursor=next_cursor)
+
+
+@estimate_blueprint.route('/history/<int:history_id>', endpoint='history_detail')
+def history_detail(history_id: int):
+    """1 件分の入力・計算結果（一覧で「詳細」を開いたときに読む）。"""
+    if 'user_id' not in session:
+        return jsonify({"error": "ログインが必要です。"}), 401
+    row = get_repository().get_history_data(history_id, session['user_id'])
+    if not row:
+        return jsonify({"error": "履歴が見つかりません。"}), 404
+    try:
+        data = json.loads(row.get('data_json') or '{}')
+    except ValueError:
+        data = {}
+    return jsonify(data)
 
 
 @estimate_blueprint.route('/download/<int:file_id>', endpoint='download_excel')
@@ -51,22 +74,9 @@ def download_excel(file_id: int):
     if 'user_id' not in session:
         return redirect(url_for('auth.login'))
     user_id = session['user_id']
-    conn = get_connection()
-    with conn.cursor() as cursor:
-        cursor.execute(
-            'SELECT filename FROM excel_history WHERE id=%s AND user_id=%s',
-            (file_id, user_id)
-        )
-        row = cursor.fetchone()
-    conn.close()
+    row = get_repository().get_history_file(file_id, user_id)
     if not row:
         return 'ファイルが見つかりません。'
-    filepath = os.path.join(app.root_path, 'exports', str(user_id), row['filename'])
-    if not os.path.exists(filepath):
-        return 'ファイルが見つかりません。'
-    return send_file(
-        filepath,
-        as_attachment=True,
-        download_name=row['filename'],
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    )
+    # ファイルが消えていても data_json から作り直される
+    filepath = history_file_path(row, user_id)
+    return send_export(filepath, row['filename'], lambda: history_file_path(row, user_id))
@@ -0,0 +1,191 @@
+# export_store.py ―― 出力した Excel の保存先（内容アドレス + 容量上限）
+#
+# 同じ内容の見積書を何度も書き出さないよう、ファイルは内容のハッシュを名前にして
+# <root>/<ab>/<cd>/<hash>.xlsx に 1 つだけ置く。excel_history は blob_key でこれを指す。
+# 各 blob のサイズ・最終ダウンロード時刻と「どのユーザーが参照しているか」は
+# <root>/index.sqlite3 に持ち、ユーザー単位と全体の容量上限を超えたら
+# 最後にダウンロードされたのが古いものから消す。
+# 消えた blob は履歴の data_json から作り直せるので、消しても情報は失われない。
+
+import os
+import sqlite3
+import threading
+import time
+
+import config
+
+
+class BlobStore:
+    def __init__(self, root: str, user_quota: int, global_quota: int):
+        self.root = root
+        self.user_quota = user_quota
+        self.global_quota = global_quota
+        self._local = threading.local()
+        os.makedirs(root, exist_ok=True)
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            " key TEXT PRIMARY KEY, size INTEGER NOT NULL,"
+            " last_access REAL NOT NULL, present INTEGER NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS refs ("
+            " user_id INTEGER NOT NULL, key TEXT NOT NULL, PRIMARY KEY (user_id, key))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_access ON blobs (present, last_access)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_refs_key ON refs (key)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.root, 'index.sqlite3'),
+                                   timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key[2:4], f"{key}.xlsx")
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def put(self, key: str, data: bytes, user_id=None) -> str:
+        """
+        blob を保存して保存先を返す。同じ key が既にあれば書き込みは省く。
+        user_id があれば参照を記録し、容量上限を超えていれば古いものを消す。
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        self._record(key, len(data), user_id)
+        self.enforce_quota(user_id, keep=key)
+        return path
+
+    def ensure(self, key: str, build, user_id=None) -> str:
+        """blob が無ければ build() -> bytes で作り直して置く。"""
+        if self.exists(key):
+            return self.path(key)
+        return self.put(key, build(), user_id)
+
+    def add_ref(self, key: str, user_id):
+        if user_id is not None:
+            self._conn().execute(
+                "INSERT OR IGNORE INTO refs (user_id, key) VALUES (?, ?)", (user_id, key)
+            )
+
+    def touch(self, key: str):
+        """ダウンロードされたら最終アクセス時刻を更新する（追い出しの順番に使う）。"""
+        self._conn().execute("UPDATE blobs SET last_access=? WHERE key=?", (time.time(), key))
+
+    def _record(self, key: str, size: int, user_id):
+        conn = self._conn()
+        conn.execute(
+            "INSERT INTO blobs (key, size, last_access, present) VALUES (?, ?, ?, 1)"
+            " ON CONFLICT(key) DO UPDATE SET size=excluded.size,"
+            " last_access=excluded.last_access, present=1",
+            (key, size, time.time()),
+        )
+        self.add_ref(key, user_id)
+
+    def drop_user(self, user_id) -> int:
+        """
+        user_id の参照を外し、ほかのどのユーザーからも参照されなくなった blob を消す。
+        消した数を返す（未ログインの出力が同じ blob を指していても、必要になれば作り直される）。
+        """
+        conn = self._conn()
+        keys = [row[0] for row in conn.execute("SELECT key FROM refs WHERE user_id=?", (user_id,))]
+        conn.execute("DELETE FROM refs WHERE user_id=?", (user_id,))
+        removed = 0
+        for key in keys:
+            if conn.execute("SELECT 1 FROM refs WHERE key=? LIMIT 1", (key,)).fetchone():
+                continue
+            try:
+                os.remove(self.path(key))
+                removed += 1
+            except FileNotFoundError:
+                pass
+            conn.execute("UPDATE blobs SET present=0 WHERE key=?", (key,))
+        return removed
+
+    # --- 容量上限 ---
+    def usage(self, user_id=None) -> int:
+        if user_id is None:
+            row = self._conn().execute(
+                "SELECT COALESCE(SUM(size), 0) FROM blobs WHERE present=1"
+            ).fetchone()
+        else:
+            row = self._conn().execute(
+                "SELECT COALESCE(SUM(b.size), 0) FROM blobs b JOIN refs r ON r.key=b.key"
+                " WHERE r.user_id=? AND b.present=1",
+                (user_id,),
+            ).fetchone()
+        return row[0]
+
+    def _evict(self, candidates, over: int, keep: str | None) -> int:
+        freed = 0
+        for key, size in candidates:
+            if freed >= over:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            self._conn().execute("UPDATE blobs SET present=0 WHERE key=?", (key,))
+            freed += size
+        return freed
+
+    def enforce_quota(self, user_id=None, keep: str | None = None):
+        """ユーザー単位 → 全体 の順に、上限を超えた分を古いものから消す。"""
+        conn = self._conn()
+        if user_id is not None and self.user_quota:
+            over = self.usage(user_id) - self.user_quota
+            if over > 0:
+                rows = conn.execute(
+                    "SELECT b.key, b.size FROM blobs b JOIN refs r ON r.key=b.key"
+                    " WHERE r.user_id=? AND b.present=1 ORDER BY b.last_access",
+                    (user_id,),
+                ).fetchall()
+                self._evict(rows, over, keep)
+        if self.global_quota:
+            over = self.usage() - self.global_quota
+            if over > 0:
+                rows = conn.execute(
+                    "SELECT key, size FROM blobs WHERE present=1 ORDER BY last_access"
+                ).fetchall()
+                self._evict(rows, over, keep)
+
+    def stats(self) -> dict:
+        row = self._conn().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs WHERE present=1"
+        ).fetchone()
+        return {"blobs": row[0], "bytes": row[1], "global_quota": self.global_quota}
+
+
+_store = None
+
+
+def get_store() -> BlobStore:
+    if _store is None:
+        raise RuntimeError('export store is not initialised; call init_export_store(app)')
+    return _store
+
+
+def init_export_store(app):
+    """config.EXPORT_STORE_DIR（未指定なら exports/blobs/）に保存先を用意する。"""
+    global _store
+    root = config.EXPORT_STORE_DIR or os.path.join(app.root_path, 'exports', 'blobs')
+    _store = BlobStore(
+        root,
+        user_quota=config.EXPORT_USER_QUOTA,
+        global_quota=config.EXPORT_GLOBAL_QUOTA,
+    )
+    app.extensions['export_store'] = _store
+    return _store
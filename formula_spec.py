@@ -0,0 +1,851 @@
+# formula_spec.py ―― 原価計算の係数と式（宣言的な式グラフ）
+#
+# 係数と式はここに 1 回だけ書く。
+# ・サーバーは compile で include_* の組み合わせごとに Python のクロージャへ変換して評価する
+#   （blueprints/dashboard.py の CostModel。フラグと定数はコンパイル時に畳み込む）
+# ・同じ SPEC を JSON のままダッシュボードに埋め込み、static/js/formula.js が同じ規則で評価する。
+#   入力中のプレビューはブラウザだけで計算し、/dashboard/post と Excel 出力はサーバーで計算し直す
+# ・/dashboard/batch と /dashboard/sweep は VectorFormula で同じ SPEC を NumPy の列として評価する
+# 式・係数・出力の並びを変えたら SPEC["version"] を上げる。
+#
+# 旧来の calculate_* / バッチ計算 / formula.js との突き合わせは tests/test_formula_parity.py。
+#
+# 式は数値か、先頭が演算子の配列:
+#   ["const", 名前]          CONSTANTS の値
+#   ["in", 名前]             検証済みの入力値（SPEC["inputs"]）
+#   ["field", 名前]          フォームの任意項目。空・数値でなければ 0.0（safe_float）   ※単価の式だけ
+#   ["price", 名前]          フォームの単価項目。空なら 0、数値でなければエラー       ※単価の式だけ
+#   ["flag", 名前]           include_* がチェックされているか（コンパイル時に確定）
+#   ["ref", 名前]            先に計算したノードの値                                   ※ノードの式だけ
+#   ["unit"]                 その項目の単価                                           ※群の cost だけ
+#   ["units", 群] ["costs", 群]   群の有効な項目の 単価 / 金額 の合計（並び順に足す）
+#   ["+", a, b, ...] ["-", a, b] ["*", a, b, ...] ["/", a, b]   左から順に計算（0 除算はエラー）
+#   ["safe_div", a, b]       b <= 0 なら 0.0
+#   ["if", 条件, a, b]  [">", a, b] ほか比較  ["and", a, b] ["or", a, b]
+#   ["require", 条件, メッセージ, 式]   条件が偽なら入力エラー（ValueError）
+# 出力（SPEC["outputs"]）はノード名・項目名・入力名の並びで、float だけ 0 桁に丸める（偶数丸め）。
+
+import hashlib
+import json
+import operator
+
+import numpy as np
+
+SPEC = {
+    "version": 1,
+    "constants": {
+        "DOHDAI_COEFFICIENT":      0.042,
+        "DRYING_FUEL_COEFFICIENT": 0.025,
+        "BISQUE_FUEL_COEFFICIENT": 0.04,
+        "HASSUI_COEFFICIENT":      0.04,
+        "PAINT_COEFFICIENT":       0.05,
+        "FIRING_GAS_CONSTANT":     370,
+        "MOLD_DIVISOR":            100,
+        "HOURLY_WAGE":             3000,
+        "NOUHIN_JINKENHI_CHARGE":  7500,    # 納品（直納）の人件費（1 回あたり）
+        "GASOLINE_CHARGE":         750,     # ガソリン代（1 回あたり）
+    },
+    # (名前, 型)。検証はこの順に行い、最初に失敗した項目のエラーを返す
+    "inputs": [
+        ["client_name", "name"],
+        ["subject", "text"],
+        ["sales_price", "float"],
+        ["order_quantity", "int"],
+        ["product_weight", "float"],
+        ["mold_unit_price", "float"],
+        ["mold_count", "int"],
+        ["glaze_cost", "float"],
+        ["poly_count", "int"],
+        ["kiln_count", "int"],
+        ["gas_unit_price", "float"],
+        ["loss_defective", "float"],
+    ],
+    # 計算順のセクション。差分再計算（/dashboard/calculate/delta）の単位でもある
+    "sections": ["inputs", "raw_material", "manufacturing", "yield", "sales_admin", "profit"],
+    # 原価項目の群。各項目の金額は cost（単価 × 発注数）で、フラグが外れていれば 0
+    "groups": [
+        {
+            "name": "raw_material",
+            "cost": ["*", ["unit"], ["in", "order_quantity"]],
+            "terms": [
+                {"key": "dohdai_cost", "flag": "include_dohdai",
+                 "unit": ["*", ["in", "product_weight"], ["const", "DOHDAI_COEFFICIENT"]]},
+                {"key": "kata_cost", "flag": "include_kata",
+                 "unit": ["require", [">", ["in", "mold_count"], 0], "使用型の数出し数が0以下です。",
+                          ["/", ["/", ["in", "mold_unit_price"], ["in", "mold_count"]],
+                           ["const", "MOLD_DIVISOR"]]]},
+                {"key": "drying_fuel_cost", "flag": "include_drying_fuel",
+                 "unit": ["*", ["in", "product_weight"], ["const", "DRYING_FUEL_COEFFICIENT"]]},
+                {"key": "bisque_fuel_cost", "flag": "include_bisque_fuel",
+                 "unit": ["*", ["in", "product_weight"], ["const", "BISQUE_FUEL_COEFFICIENT"]]},
+                {"key": "hassui_cost", "flag": "include_hassui",
+                 "unit": ["*", ["in", "product_weight"], ["const", "HASSUI_COEFFICIENT"]]},
+                {"key": "paint_cost", "flag": "include_paint",
+                 "unit": ["*", ["in", "product_weight"], ["const", "PAINT_COEFFICIENT"]]},
+                {"key": "logo_copper_cost", "flag": "include_logo_copper",
+                 "unit": ["price", "copper_unit_price"]},
+                {"key": "glaze_material_cost", "flag": "include_glaze_material",
+                 "unit": ["require", [">", ["in", "poly_count"], 0], "ポリの枚数が0以下です。",
+                          ["/", ["in", "glaze_cost"], ["in", "poly_count"]]]},
+                {"key": "main_firing_gas_cost", "flag": "include_main_firing_gas",
+                 "unit": ["require", [">", ["in", "kiln_count"], 0], "窯入数が0以下です。",
+                          ["/", ["*", ["in", "gas_unit_price"], ["const", "FIRING_GAS_CONSTANT"]],
+                           ["in", "kiln_count"]]]},
+                {"key": "transfer_sheet_cost", "flag": "include_transfer_sheet",
+                 "unit": ["price", "transfer_sheet_unit_price"]},
+            ],
+        },
+        {
+            "name": "manufacturing",
+            "cost": ["*", ["unit"], ["in", "order_quantity"]],
+            "terms": [
+                {"key": "chumikin_cost", "flag": "include_chumikin",
+                 "unit": ["field", "chumikin_unit"]},
+                {"key": "shiagechin_cost", "flag": "include_shiagechin",
+                 "unit": ["field", "shiagechin_unit"]},
+                {"key": "haiimonochin_cost", "flag": "include_haiimonochin",
+                 "unit": ["safe_div", ["in", "mold_unit_price"], ["field", "sawaimono_work"]]},
+                {"key": "seisojiken_cost", "flag": "include_seisojiken",
+                 "unit": ["safe_div", ["const", "HOURLY_WAGE"], ["field", "seisojiken_work"]]},
+                {"key": "soyakeire_dashi_cost", "flag": "include_soyakeire_dashi",
+                 "unit": ["safe_div", ["const", "HOURLY_WAGE"], ["field", "soyakeire_work"]]},
+                {"key": "soyakebarimono_cost", "flag": "include_soyakebarimono",
+                 "unit": ["safe_div", ["const", "HOURLY_WAGE"], ["field", "soyakebarimono_work"]]},
+                {"key": "doban_hari_cost", "flag": "include_doban_hari",
+                 "unit": ["field", "doban_hari_unit"]},
+                {"key": "hassui_kakouchin_cost", "flag": "include_hassui_kakouchin",
+                 "unit": ["safe_div", ["const", "HOURLY_WAGE"], ["field", "hassui_kakouchin_work"]]},
+                {"key": "shiyu_hiyou_cost", "flag": "include_shiyu_hiyou",
+                 "unit": ["field", "shiyu_hiyou_unit"]},
+                {"key": "shiyu_cost", "flag": "include_shiyu_cost",
+                 "unit": ["safe_div", ["const", "HOURLY_WAGE"], ["field", "shiyu_work"]]},
+                {"key": "kamairi_cost", "flag": "include_kamairi",
+                 "unit": ["/", ["*", ["const", "HOURLY_WAGE"], ["field", "kamairi_time"]], ["in", "kiln_count"]]},
+                {"key": "kamadashi_cost", "flag": "include_kamadashi",
+                 "unit": ["/", ["*", ["const", "HOURLY_WAGE"], ["field", "kamadashi_time"]], ["in", "kiln_count"]]},
+                {"key": "hamasuri_cost", "flag": "include_hamasuri",
+                 "unit": ["/", ["*", ["const", "HOURLY_WAGE"], ["field", "hamasuri_time"]], ["in", "kiln_count"]]},
+                {"key": "kenpin_cost", "flag": "include_kenpin",
+                 "unit": ["/", ["*", ["const", "HOURLY_WAGE"], ["field", "kenpin_time"]], ["in", "kiln_count"]]},
+                {"key": "print_kakouchin_cost", "flag": "include_print_kakouchin",
+                 "unit": ["field", "print_kakouchin_unit"]},
+            ],
+        },
+    ],
+    # (名前, セクション, 式)。セクションの順に並べる
+    "nodes": [
+        ["total_cost", "inputs",
+         ["+", ["in", "sales_price"], ["in", "order_quantity"], ["in", "product_weight"],
+          ["in", "mold_unit_price"], ["in", "mold_count"], ["in", "kiln_count"],
+          ["in", "gas_unit_price"], ["in", "loss_defective"]]],
+
+        ["genzairyousyoukei_coefficient", "raw_material", ["units", "raw_material"]],
+        ["raw_material_cost_total", "raw_material", ["costs", "raw_material"]],
+        # 1＋ロスの意味は、「ロス分も含めた実際にかかる材料費」
+        ["raw_material_cost_ratio", "raw_material",
+         ["*", ["/", ["*", ["ref", "genzairyousyoukei_coefficient"], ["+", 1, ["in", "loss_defective"]]],
+                ["in", "sales_price"]], 100]],
+
+        ["seizousyoukei_total", "manufacturing", ["costs", "manufacturing"]],
+        ["seizousyoukei_coefficient", "manufacturing",
+         ["if", ["!=", ["in", "order_quantity"], 0],
+          ["/", ["ref", "seizousyoukei_total"], ["in", "order_quantity"]], 0]],
+
+        ["yield_coefficient", "yield",
+         ["*", ["+", ["ref", "seizousyoukei_coefficient"],
+                ["/", ["ref", "raw_material_cost_total"], ["in", "order_quantity"]]],
+          ["in", "loss_defective"]]],
+        ["manufacturing_cost_total", "yield",
+         ["+", ["ref", "seizousyoukei_total"], ["*", ["ref", "yield_coefficient"], ["in", "order_quantity"]]]],
+        ["manufacturing_cost_ratio", "yield",
+         ["if", ["!=", ["in", "sales_price"], 0],
+          ["*", ["/", ["+", ["ref", "seizousyoukei_coefficient"], ["ref", "yield_coefficient"]],
+                 ["in", "sales_price"]], 100], 0]],
+
+        ["admin_fixed", "sales_admin",
+         ["+", ["if", ["flag", "include_nouhin_jinkenhi"], ["const", "NOUHIN_JINKENHI_CHARGE"], 0],
+               ["if", ["flag", "include_gasoline"], ["const", "GASOLINE_CHARGE"], 0]]],
+        ["sales_admin_cost_total", "sales_admin",
+         ["if", ["!=", ["in", "order_quantity"], 0],
+          ["/", ["ref", "admin_fixed"], ["in", "order_quantity"]], 0]],
+        ["sales_admin_cost_ratio", "sales_admin",
+         ["if", ["and", [">", ["in", "sales_price"], 0], [">", ["in", "order_quantity"], 0]],
+          ["*", ["/", ["ref", "admin_fixed"], ["*", ["in", "sales_price"], ["in", "order_quantity"]]], 100], 0]],
+
+        ["production_cost_total", "profit",
+         ["+", ["ref", "raw_material_cost_total"], ["ref", "manufacturing_cost_total"]]],
+        ["production_plus_sales", "profit",
+         ["+", ["ref", "production_cost_total"], ["ref", "sales_admin_cost_total"]]],
+        ["profit_amount", "profit",
+         ["-", ["in", "sales_price"],
+          ["+", ["ref", "genzairyousyoukei_coefficient"], ["ref", "seizousyoukei_coefficient"],
+           ["ref", "yield_coefficient"], ["ref", "sales_admin_cost_total"]]]],
+        ["profit_amount_total", "profit", ["*", ["ref", "profit_amount"], ["in", "order_quantity"]]],
+        ["profit_ratio", "profit",
+         ["if", ["!=", ["in", "sales_price"], 0],
+          ["*", ["/", ["ref", "profit_amount"], ["in", "sales_price"]], 100], 0]],
+    ],
+    # dashboard_data のキーと並び順
+    "outputs": [
+        "client_name", "subject", "sales_price", "order_quantity", "product_weight",
+        "mold_unit_price", "mold_count", "kiln_count", "gas_unit_price",
+        "loss_defective", "poly_count", "glaze_cost", "total_cost",
+        "raw_material_cost_total", "raw_material_cost_ratio",
+        "dohdai_cost", "kata_cost", "drying_fuel_cost", "bisque_fuel_cost", "hassui_cost",
+        "paint_cost", "logo_copper_cost", "glaze_material_cost", "main_firing_gas_cost",
+        "transfer_sheet_cost", "genzairyousyoukei_coefficient",
+        "chumikin_cost", "shiagechin_cost", "haiimonochin_cost", "seisojiken_cost",
+        "soyakeire_dashi_cost", "soyakebarimono_cost", "doban_hari_cost",
+        "hassui_kakouchin_cost", "shiyu_hiyou_cost", "shiyu_cost", "kamairi_cost",
+        "kamadashi_cost", "hamasuri_cost", "kenpin_cost", "print_kakouchin_cost",
+        "yield_coefficient", "manufacturing_cost_total", "manufacturing_cost_ratio",
+        "seizousyoukei_coefficient", "sales_admin_cost_total", "sales_admin_cost_ratio",
+        "production_cost_total", "production_plus_sales",
+        "profit_amount", "profit_amount_total", "profit_ratio",
+    ],
+}
+
+CONSTANTS = SPEC["constants"]
+SECTIONS = tuple(SPEC["sections"])
+
+# 内容から作った版（ETag やキャッシュキー用）。version の上げ忘れも検知できる
+SPEC_DIGEST = hashlib.sha256(
+    json.dumps(SPEC, sort_keys=True, ensure_ascii=False).encode('utf-8')
+).hexdigest()[:16]
+
+
+# ----------------- 入力の解析 ----------------- #
+def safe_float(val: str | None) -> float:
+    """
+    '', None や空白文字列を 0.0 に変換して float を返す。
+    数値化できない文字列も 0.0 にフォールバックする。
+    """
+    try:
+        return float(val) if val not in (None, '', ' ') else 0.0
+    except ValueError:
+        return 0.0
+
+
+def safe_div(numerator: float, denominator: float) -> float:
+    """
+    denominator<=0 の場合 0.0 を返す（0除算回避）。
+    """
+    return numerator / denominator if denominator > 0 else 0.0
+
+
+_PARSERS = {
+    # Excel テンプレートに既に「様」があるため、入力で重複しないよう末尾の「様」を除外
+    'name':  lambda v: v.strip().removesuffix('様').strip(),
+    'text':  lambda v: v.strip(),
+    'int':   lambda v: int(v.strip()),
+    'float': lambda v: float(v.strip()),
+}
+
+# (名前, 解析関数) の並び。失敗すると ValueError / AttributeError をそのまま送出する
+INPUT_PARSERS = tuple((name, _PARSERS[kind]) for name, kind in SPEC["inputs"])
+
+
+# ----------------- コンパイル ----------------- #
+class SpecError(ValueError):
+    """SPEC の書き方が誤っている（未定義の名前・使えない場所での演算子など）。"""
+
+
+class _Const:
+    """コンパイル時に値が確定した式。"""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+def _lift(c):
+    """_Const を関数にする。関数は (inp, x) を受け取る（x は単価ならフォーム、ノードなら st）。"""
+    if isinstance(c, _Const):
+        value = c.value
+        return lambda inp, x: value
+    return c
+
+
+_ARITH = {'+': operator.add, '-': operator.sub, '*': operator.mul, '/': operator.truediv}
+_COMPARE = {
+    '>': operator.gt, '>=': operator.ge, '<': operator.lt,
+    '<=': operator.le, '==': operator.eq, '!=': operator.ne,
+}
+
+
+def _binary(op, a, b):
+    if isinstance(a, _Const) and isinstance(b, _Const):
+        return _Const(op(a.value, b.value))
+    if isinstance(b, _Const):
+        fa, vb = a, b.value
+        return lambda inp, x: op(fa(inp, x), vb)
+    if isinstance(a, _Const):
+        va, fb = a.value, b
+        return lambda inp, x: op(va, fb(inp, x))
+    return lambda inp, x: op(a(inp, x), b(inp, x))
+
+
+class _Scope:
+    """式 1 つをコンパイルするときの文脈。"""
+    __slots__ = ('where', 'flags', 'constants', 'nodes', 'groups', 'unit_index')
+
+    def __init__(self, where, flags, constants, nodes=None, groups=None, unit_index=None):
+        self.where = where              # 'unit' / 'cost' / 'node'
+        self.flags = flags
+        self.constants = constants
+        self.nodes = nodes              # 名前 -> _Const（畳み込めたノード）または None
+        self.groups = groups            # 群名 -> (有効な項目の units 上の位置, キー)
+        self.unit_index = unit_index
+
+
+def _compile(expr, scope: _Scope):
+    if isinstance(expr, bool) or not isinstance(expr, (int, float, list)):
+        raise SpecError(f"不正な式: {expr!r}")
+    if not isinstance(expr, list):
+        return _Const(expr)
+    op, *args = expr
+
+    if op == 'const':
+        if args[0] not in scope.constants:
+            raise SpecError(f"未定義の定数: {args[0]}")
+        return _Const(scope.constants[args[0]])
+    if op == 'in':
+        get = operator.attrgetter(args[0])
+        return lambda inp, x: get(inp)
+    if op == 'flag':
+        return _Const(args[0] in scope.flags)
+    if op in ('field', 'price'):
+        if scope.where != 'unit':
+            raise SpecError(f"{op} は単価の式でしか使えません")
+        name = args[0]
+        if op == 'field':
+            return lambda inp, form: safe_float(form.get(name))
+        return lambda inp, form: float(form.get(name, '0') or 0)
+    if op == 'unit':
+        if scope.where != 'cost':
+            raise SpecError("unit は群の cost でしか使えません")
+        i = scope.unit_index
+        return lambda inp, st: inp.units[i]
+    if op == 'ref':
+        if scope.where != 'node' or args[0] not in scope.nodes:
+            raise SpecError(f"ref できないノード: {args[0]}")
+        folded = scope.nodes[args[0]]
+        if folded is not None:
+            return folded
+        name = args[0]
+        return lambda inp, st: st[name]
+    if op in ('units', 'costs'):
+        if scope.where != 'node' or args[0] not in scope.groups:
+            raise SpecError(f"{op} できない群: {args[0]}")
+        positions, keys = scope.groups[args[0]]
+        if not positions:
+            return _Const(0)
+        if op == 'units':
+            lo, hi = positions[0], positions[-1] + 1
+            return lambda inp, st: sum(inp.units[lo:hi])
+        return lambda inp, st: sum([st[k] for k in keys])
+
+    if op == 'require':
+        cond, message, body = _compile(args[0], scope), args[1], _compile(args[2], scope)
+        if isinstance(cond, _Const):
+            if cond.value:
+                return body
+
+            def fail(inp, x):
+                raise ValueError(message)
+            return fail
+        fc, fb = cond, _lift(body)
+
+        def checked(inp, x):
+            if not fc(inp, x):
+                raise ValueError(message)
+            return fb(inp, x)
+        return checked
+
+    parts = [_compile(a, scope) for a in args]
+    if op in _ARITH:
+        if len(parts) < 2 or (op in ('-', '/') and len(parts) != 2):
+            raise SpecError(f"{op} の引数の数が不正です")
+        result = parts[0]
+        for part in parts[1:]:
+            result = _binary(_ARITH[op], result, part)
+        return result
+    if op in _COMPARE:
+        return _binary(_COMPARE[op], *parts)
+    if op == 'safe_div':
+        return _binary(safe_div, *parts)
+    if op in ('and', 'or'):
+        a, b = parts
+        if isinstance(a, _Const):
+            if (op == 'and') != bool(a.value):
+                return a
+            return b
+        fa, fb = a, _lift(b)
+        if op == 'and':
+            return lambda inp, x: fa(inp, x) and fb(inp, x)
+        return lambda inp, x: fa(inp, x) or fb(inp, x)
+    if op == 'if':
+        cond, a, b = parts
+        if isinstance(cond, _Const):
+            return a if cond.value else b
+        fc, fa, fb = cond, _lift(a), _lift(b)
+        return lambda inp, x: fa(inp, x) if fc(inp, x) else fb(inp, x)
+    raise SpecError(f"未知の演算子: {op}")
+
+
+def _round0(val):
+    """float だけ 0 桁に丸める（round_values_in_dict と同じ扱い）。"""
+    return round(val, 0) if isinstance(val, float) else val
+
+
+class CompiledFormula:
+    """
+    SPEC を、チェック済みの include_* の集合（flags）向けにコンパイルしたもの。
+    constants を渡すと spec["constants"] の値を上書きする（係数プロファイル）。
+    inp は SPEC["inputs"] の名前を属性に持ち、units（unit_vector の戻り値）を保持するオブジェクト。
+    """
+    __slots__ = ('term_keys', 'template', '_unit_fns', '_steps', '_outputs', '_folded')
+
+    def __init__(self, spec: dict, flags, constants: dict | None = None):
+        flags = frozenset(flags)
+        constants = {**spec["constants"], **(constants or {})}
+        input_names = {name for name, _ in spec["inputs"]}
+        sections = spec["sections"]
+
+        unit_fns, steps, groups, self.term_keys = [], [], {}, {}
+        term_sections = {}
+        for group in spec["groups"]:
+            section = group["name"]
+            if section not in sections:
+                raise SpecError(f"未定義のセクション: {section}")
+            positions, keys = [], []
+            for term in group["terms"]:
+                term_sections[term["key"]] = section
+                if term["flag"] not in flags:
+                    continue
+                i = len(unit_fns)
+                unit_fns.append(_lift(_compile(term["unit"], _Scope('unit', flags, constants))))
+                cost = _lift(_compile(group["cost"], _Scope('cost', flags, constants, unit_index=i)))
+                steps.append((section, term["key"], cost))
+                positions.append(i)
+                keys.append(term["key"])
+            groups[section] = (positions, tuple(keys))
+            self.term_keys[section] = tuple(keys)
+
+        # ノードは順に畳み込み、定数にならなかったものだけを実行時の手順に残す
+        nodes = {key: None for _, keys in groups.values() for key in keys}
+        node_sections = dict(term_sections)
+        self._folded = {}
+        for name, section, expr in spec["nodes"]:
+            if section not in sections:
+                raise SpecError(f"未定義のセクション: {section}")
+            compiled = _compile(expr, _Scope('node', flags, constants, nodes, groups))
+            node_sections[name] = section
+            if isinstance(compiled, _Const):
+                nodes[name] = compiled
+                self._folded[name] = compiled.value
+            else:
+                nodes[name] = None
+            steps.append((section, name, _lift(compiled)))
+        # セクション順に安定ソート（群の項目はそのセクションの先頭で計算する）
+        steps.sort(key=lambda step: sections.index(step[0]))
+
+        outputs = []
+        for key in spec["outputs"]:
+            if key in node_sections:
+                if key in nodes:
+                    outputs.append((node_sections[key], key, None))
+                else:                                   # フラグが外れた項目は 0 のまま
+                    outputs.append((node_sections[key], key, _Const(0)))
+            elif key in input_names:
+                outputs.append((sections[0], key, operator.attrgetter(key)))
+            else:
+                raise SpecError(f"未定義の出力: {key}")
+
+        self._unit_fns = tuple(unit_fns)
+        self._steps = tuple(steps)
+        self._outputs = tuple(outputs)
+        self.template = dict.fromkeys(spec["outputs"], 0)
+
+    def folded(self, name: str):
+        """コンパイル時に定数へ畳み込めたノードの値（畳み込めなければ KeyError）。"""
+        return self._folded[name]
+
+    def units(self, inp, form) -> tuple:
+        """有効な項目の 1 個あたり単価を並び順に返す（require の検査もここで行う）。"""
+        return tuple(fn(inp, form) for fn in self._unit_fns)
+
+    def evaluate(self, inp) -> dict:
+        """丸め済みの dashboard_data を返す。"""
+        data = self.template.copy()
+        self.run_sections(inp, {}, data, SECTIONS)
+        return data
+
+    def run_sections(self, inp, st: dict, data: dict, sections) -> None:
+        """
+        指定したセクションだけを計算順に再計算する。
+        st は丸め前の中間値、data は丸め済みの出力で、どちらも上書きされる。
+        """
+        for section, name, fn in self._steps:
+            if section in sections:
+                st[name] = fn(inp, st)
+        for section, key, source in self._outputs:
+            if section not in sections:
+                continue
+            if source is None:
+                data[key] = _round0(st[key])
+            elif isinstance(source, _Const):
+                data[key] = source.value
+            else:
+                data[key] = _round0(source(inp))
+
+
+def divisor_constants(spec: dict = SPEC) -> set:
+    """割る数として使われている定数の名前（係数プロファイルで 0 にできないもの）。"""
+    found = set()
+
+    def walk(expr):
+        if not isinstance(expr, list):
+            return
+        op, *args = expr
+        if op in ('/', 'safe_div'):
+            for arg in args[1:]:
+                if isinstance(arg, list) and arg[:1] == ['const']:
+                    found.add(arg[1])
+        for arg in args:
+            walk(arg)
+
+    for group in spec["groups"]:
+        walk(group["cost"])
+        for term in group["terms"]:
+            walk(term["unit"])
+    for _, _, expr in spec["nodes"]:
+        walk(expr)
+    return found
+
+
+def spec_flags(spec: dict = SPEC) -> tuple:
+    """フォームの include_* の名前（群の項目の並び → ノードで使う順）。"""
+    names = [term["flag"] for group in spec["groups"] for term in group["terms"]]
+
+    def walk(expr):
+        if not isinstance(expr, list):
+            return
+        op, *args = expr
+        if op == 'flag':
+            names.append(args[0])
+            return
+        for arg in args:
+            walk(arg)
+
+    for _, _, expr in spec["nodes"]:
+        walk(expr)
+    return tuple(dict.fromkeys(names))
+
+
+# ----------------- 列でまとめて評価（バッチ計算・what-if スイープ） ----------------- #
+# 同じ SPEC を NumPy の配列で評価する。値は入力名 -> 配列（互いにブロードキャストできる形）で渡し、
+# include_* もコンパイル時に畳み込まず、フラグ名 -> bool 配列として行ごとに効かせる
+# （フラグの組み合わせが行ごとに違っても 1 回で計算できる）。
+# スカラー版で例外（require の条件・0 除算・単価の読み取り）になる要素は failed に立てる。
+# if / and / or / require の実行されない側の要素は数えないので、失敗する要素はスカラー版と同じ。
+# 加算の順序もスカラー版と同じで、外れた項目は 0.0 を足すだけなので値もそのまま一致する。
+class _VectorContext:
+    __slots__ = ('inputs', 'columns', 'invalid', 'flags', 'units', 'st', 'failed', 'shape')
+
+    def fail(self, where):
+        self.failed |= np.broadcast_to(where, self.shape)
+
+
+def _vlift(c):
+    """_Const を関数にする。関数は (ctx, active) を受け取る（active は実行される要素）。"""
+    if isinstance(c, _Const):
+        value = c.value
+        return lambda ctx, active: value
+    return c
+
+
+def _vdivide(ctx, active, a, b):
+    ctx.fail(np.logical_and(active, np.equal(b, 0)))
+    return np.divide(a, b)
+
+
+def _vsafe_div(ctx, active, a, b):
+    positive = np.greater(b, 0)
+    return np.where(positive, np.divide(a, np.where(positive, b, 1.0)), 0.0)
+
+
+_VECTOR_ARITH = {
+    '+': lambda ctx, active, a, b: a + b,
+    '-': lambda ctx, active, a, b: a - b,
+    '*': lambda ctx, active, a, b: a * b,
+    '/': _vdivide,
+}
+
+
+def _vbinary(op, a, b):
+    if isinstance(a, _Const) and isinstance(b, _Const):
+        return _binary(_ARITH.get(op) or _COMPARE.get(op) or safe_div, a, b)
+    if op in _COMPARE:
+        cmp = _COMPARE[op]
+        fn = lambda ctx, active, x, y: cmp(x, y)
+    else:
+        fn = _VECTOR_ARITH.get(op, _vsafe_div)
+    fa, fb = _vlift(a), _vlift(b)
+    return lambda ctx, active: fn(ctx, active, fa(ctx, active), fb(ctx, active))
+
+
+def _vcompile(expr, scope: _Scope):
+    if isinstance(expr, bool) or not isinstance(expr, (int, float, list)):
+        raise SpecError(f"不正な式: {expr!r}")
+    if not isinstance(expr, list):
+        return _Const(expr)
+    op, *args = expr
+
+    if op == 'const':
+        if args[0] not in scope.constants:
+            raise SpecError(f"未定義の定数: {args[0]}")
+        return _Const(scope.constants[args[0]])
+    if op == 'in':
+        name = args[0]
+        return lambda ctx, active: ctx.inputs[name]
+    if op == 'flag':
+        name = args[0]
+        return lambda ctx, active: ctx.flags[name]
+    if op in ('field', 'price'):
+        if scope.where != 'unit':
+            raise SpecError(f"{op} は単価の式でしか使えません")
+        name = args[0]
+        if op == 'field':
+            return lambda ctx, active: ctx.columns[name]
+
+        def price(ctx, active):
+            invalid = ctx.invalid.get(name)
+            if invalid is not None:
+                ctx.fail(np.logical_and(active, invalid))
+            return ctx.columns[name]
+        return price
+    if op == 'unit':
+        if scope.where != 'cost':
+            raise SpecError("unit は群の cost でしか使えません")
+        i = scope.unit_index
+        return lambda ctx, active: ctx.units[i]
+    if op == 'ref':
+        if scope.where != 'node' or args[0] not in scope.nodes:
+            raise SpecError(f"ref できないノード: {args[0]}")
+        folded = scope.nodes[args[0]]
+        if folded is not None:
+            return folded
+        name = args[0]
+        return lambda ctx, active: ctx.st[name]
+    if op in ('units', 'costs'):
+        if scope.where != 'node' or args[0] not in scope.groups:
+            raise SpecError(f"{op} できない群: {args[0]}")
+        positions, keys = scope.groups[args[0]]
+        if not positions:
+            return _Const(0)
+        if op == 'units':
+            lo, hi = positions[0], positions[-1] + 1
+            return lambda ctx, active: sum(ctx.units[lo:hi])
+        return lambda ctx, active: sum([ctx.st[k] for k in keys])
+
+    if op == 'require':
+        cond, body = _vcompile(args[0], scope), _vcompile(args[2], scope)
+        if isinstance(cond, _Const):
+            if cond.value:
+                return body
+
+            def fail(ctx, active):
+                ctx.fail(active)
+                return 0.0
+            return fail
+        fc, fb = cond, _vlift(body)
+
+        def checked(ctx, active):
+            ok = fc(ctx, active)
+            ctx.fail(np.logical_and(active, np.logical_not(ok)))
+            return fb(ctx, np.logical_and(active, ok))
+        return checked
+
+    parts = [_vcompile(a, scope) for a in args]
+    if op in _ARITH:
+        if len(parts) < 2 or (op in ('-', '/') and len(parts) != 2):
+            raise SpecError(f"{op} の引数の数が不正です")
+        result = parts[0]
+        for part in parts[1:]:
+            result = _vbinary(op, result, part)
+        return result
+    if op in _COMPARE or op == 'safe_div':
+        return _vbinary(op, *parts)
+    if op in ('and', 'or'):
+        a, b = parts
+        if isinstance(a, _Const):
+            if (op == 'and') != bool(a.value):
+                return a
+            return b
+        fa, fb = a, _vlift(b)
+        if op == 'and':
+            def both(ctx, active):
+                x = fa(ctx, active)
+                return np.logical_and(x, fb(ctx, np.logical_and(active, x)))
+            return both
+
+        def either(ctx, active):
+            x = fa(ctx, active)
+            return np.logical_or(x, fb(ctx, np.logical_and(active, np.logical_not(x))))
+        return either
+    if op == 'if':
+        cond, a, b = parts
+        if isinstance(cond, _Const):
+            return a if cond.value else b
+        fc, fa, fb = cond, _vlift(a), _vlift(b)
+
+        def choose(ctx, active):
+            c = fc(ctx, active)
+            return np.where(c, fa(ctx, np.logical_and(active, c)),
+                            fb(ctx, np.logical_and(active, np.logical_not(c))))
+        return choose
+    raise SpecError(f"未知の演算子: {op}")
+
+
+class VectorFormula:
+    """
+    SPEC を列でまとめて評価する版（include_* は実行時の bool 配列）。
+    constants を渡すと spec["constants"] の値を上書きする（係数プロファイル）。
+    """
+    __slots__ = ('flags', 'field_names', 'price_names', 'numeric_inputs', 'outputs',
+                 '_unit_fns', '_steps')
+
+    def __init__(self, spec: dict, constants: dict | None = None):
+        constants = {**spec["constants"], **(constants or {})}
+        sections = spec["sections"]
+        self.flags = spec_flags(spec)
+        self.numeric_inputs = tuple(name for name, kind in spec["inputs"] if kind in ('int', 'float'))
+
+        unit_fns, steps, groups, term_sections = [], [], {}, {}
+        fields, prices = set(), set()
+        for group in spec["groups"]:
+            section = group["name"]
+            if section not in sections:
+                raise SpecError(f"未定義のセクション: {section}")
+            positions, keys = [], []
+            for term in group["terms"]:
+                i = len(unit_fns)
+                refs = _references(term["unit"], {})
+                fields |= refs.get('field', set())
+                prices |= refs.get('price', set())
+                unit_fns.append((term["flag"], _vlift(_vcompile(term["unit"], _Scope('unit', None, constants)))))
+                cost = _vcompile(group["cost"], _Scope('cost', None, constants, unit_index=i))
+                steps.append((section, term["key"], _vlift(cost), term["flag"]))
+                positions.append(i)
+                keys.append(term["key"])
+                term_sections[term["key"]] = section
+            groups[section] = (positions, tuple(keys))
+
+        nodes = {key: None for key in term_sections}
+        for name, section, expr in spec["nodes"]:
+            if section not in sections:
+                raise SpecError(f"未定義のセクション: {section}")
+            compiled = _vcompile(expr, _Scope('node', None, constants, nodes, groups))
+            nodes[name] = compiled if isinstance(compiled, _Const) else None
+            steps.append((section, name, _vlift(compiled), None))
+        steps.sort(key=lambda step: sections.index(step[0]))
+
+        input_names = {name for name, _ in spec["inputs"]}
+        for key in spec["outputs"]:
+            if key not in nodes and key not in input_names:
+                raise SpecError(f"未定義の出力: {key}")
+        # (出力キー, 項目のフラグ または None)。入力値の出力は呼び出し側で 1 行ずつ詰める
+        term_flags = {term["key"]: term["flag"] for group in spec["groups"] for term in group["terms"]}
+        self.outputs = tuple((key, term_flags.get(key)) for key in spec["outputs"] if key in nodes)
+        self.field_names = tuple(sorted(fields))
+        self.price_names = tuple(sorted(prices))
+        self._unit_fns = tuple(unit_fns)
+        self._steps = tuple(steps)
+
+    def run(self, inputs: dict, columns: dict, flags: dict, invalid: dict | None = None):
+        """
+        inputs は数値の入力名 -> 配列、columns は単価の項目名 -> 配列（field は safe_float 済み、
+        price は読めなかった要素を invalid に立てる）、flags は include_* -> bool 配列。
+        (ノード・項目名 -> 丸める前の値, スカラー版なら例外になる要素の bool 配列) を返す。
+        """
+        ctx = _VectorContext()
+        ctx.inputs = {name: np.asarray(inputs[name], dtype=float) for name in self.numeric_inputs}
+        ctx.columns = columns
+        ctx.invalid = invalid or {}
+        ctx.flags = {name: np.asarray(flags.get(name, False), dtype=bool) for name in self.flags}
+        ctx.shape = np.broadcast_shapes(
+            *(np.shape(v) for v in ctx.inputs.values()),
+            *(np.shape(v) for v in columns.values()),
+            *(np.shape(v) for v in ctx.flags.values()),
+        )
+        ctx.failed = np.zeros(ctx.shape, dtype=bool)
+        ctx.st = {}
+        with np.errstate(all='ignore'):
+            units = []
+            for flag, fn in self._unit_fns:
+                on = ctx.flags[flag]
+                units.append(np.where(on, fn(ctx, on), 0.0))
+            ctx.units = units
+            for _, name, fn, flag in self._steps:
+                value = fn(ctx, True)
+                ctx.st[name] = value if flag is None else np.where(ctx.flags[flag], value, 0.0)
+        return ctx.st, ctx.failed
+
+
+# ----------------- 依存関係（差分再計算用） ----------------- #
+def _references(expr, found: dict):
+    """式が参照する名前を種類ごとに集める。"""
+    if not isinstance(expr, list):
+        return found
+    op, *args = expr
+    if op in ('in', 'field', 'price', 'flag', 'ref', 'units', 'costs'):
+        found.setdefault(op, set()).add(args[0])
+        return found
+    if op == 'require':
+        args = (args[0], args[2])       # メッセージは除く
+    for arg in args:
+        _references(arg, found)
+    return found
+
+
+def section_dependencies(spec: dict = SPEC) -> tuple[dict, dict]:
+    """
+    (入力フィールド -> それを直接使うセクションの集合, セクション -> 上流セクション) を返す。
+    フラグは、その項目が属する群のセクションに効く。
+    """
+    field_sections, upstream = {}, {}
+    node_sections = {}
+
+    def depends(section, names):
+        for name in names:
+            field_sections.setdefault(name, set()).add(section)
+
+    for group in spec["groups"]:
+        section = group["name"]
+        refs = _references(group["cost"], {})
+        for term in group["terms"]:
+            node_sections[term["key"]] = section
+            _references(term["unit"], refs)
+            depends(section, (term["flag"],))
+        for kind in ('in', 'field', 'price', 'flag'):
+            depends(section, refs.get(kind, ()))
+
+    for name, section, expr in spec["nodes"]:
+        refs = _references(expr, {})
+        for kind in ('in', 'field', 'price', 'flag'):
+            depends(section, refs.get(kind, ()))
+        ups = {node_sections[r] for r in refs.get('ref', ())}
+        ups |= refs.get('units', set()) | refs.get('costs', set())
+        ups.discard(section)
+        if ups:
+            upstream.setdefault(section, set()).update(ups)
+        node_sections[name] = section
+
+    input_names = {name for name, _ in spec["inputs"]}
+    depends(spec["sections"][0], (k for k in spec["outputs"] if k in input_names))
+    upstream = {
+        section: tuple(s for s in spec["sections"] if s in ups)
+        for section, ups in upstream.items()
+    }
+    return field_sections, upstream
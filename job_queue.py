@@ -0,0 +1,260 @@
+# job_queue.py ―― リクエストの外で動かすローカルなジョブキュー
+#
+# Excel 出力のように「ファイル書き込み + DB 保存」を伴う処理をリクエスト処理から
+# 切り離し、ワーカーを /dashboard/calculate などの応答に空けておくためのもの。
+# ジョブの状態は SQLite に保存するので、別ワーカーに来たポーリングにも答えられる。
+# 同時実行数とキューの深さには上限があり、溢れたら QueueFull を投げる。
+# 長いジョブは report_progress() で途中経過を残せる。resume_after を付けて登録した種類は、
+# 途中経過が resume_after 秒以上更新されていない（プロセスが落ちた）ものを拾い直して再実行する。
+# 取り消せない操作の後始末のように、溢れても捨てられないジョブは defer=True で積むと、
+# その場では実行せずに queued の行だけ残し、次に拾い直すときに実行する。
+
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+_current = threading.local()    # 実行中のジョブ（report_progress 用）
+
+
+class QueueFull(RuntimeError):
+    """キューの深さが上限に達している。"""
+
+
+# ----------------- 保存先 ----------------- #
+class SqliteJobStore:
+    """jobs テーブル 1 つに状態・入力・結果を持つ。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, kind TEXT NOT NULL, owner TEXT NOT NULL,"
+            " status TEXT NOT NULL, payload TEXT NOT NULL, result TEXT, error TEXT,"
+            " created REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_updated ON jobs (updated)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def create(self, job_id: str, kind: str, owner: str, payload: dict, updated: float | None = None):
+        """updated を古くしておくと、次の claim_resumable で拾われる（defer 用）。"""
+        now = time.time()
+        self._conn().execute(
+            "INSERT INTO jobs (id, kind, owner, status, payload, created, updated)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, owner, QUEUED, json.dumps(payload), now,
+             now if updated is None else updated),
+        )
+
+    def update(self, job_id: str, status: str, result=None, error: str | None = None):
+        self._conn().execute(
+            "UPDATE jobs SET status=?, result=?, error=?, updated=? WHERE id=?",
+            (status, None if result is None else json.dumps(result), error, time.time(), job_id),
+        )
+
+    def get(self, job_id: str) -> dict | None:
+        row = self._conn().execute(
+            "SELECT id, kind, owner, status, result, error, created, updated FROM jobs WHERE id=?",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    def claim_resumable(self, kind: str, before: float) -> list:
+        """
+        before より前から止まっている kind のジョブを queued に戻して (id, payload) を返す。
+        複数プロセスが同時に拾っても、updated を条件にした UPDATE で 1 つだけが取る。
+        """
+        conn = self._conn()
+        rows = conn.execute(
+            "SELECT id, payload, updated FROM jobs WHERE kind=? AND updated<?"
+            " AND (status IN (?, ?) OR (status=? AND error='interrupted'))",
+            (kind, before, QUEUED, RUNNING, FAILED),
+        ).fetchall()
+        claimed = []
+        for row in rows:
+            won = conn.execute(
+                "UPDATE jobs SET status=?, error=NULL, updated=? WHERE id=? AND updated=?",
+                (QUEUED, time.time(), row['id'], row['updated']),
+            ).rowcount
+            if won:
+                claimed.append((row['id'], json.loads(row['payload'])))
+        return claimed
+
+    def fail_stale(self, before: float) -> int:
+        """before より前から queued / running のまま（落ちたプロセスの分）を failed にする。"""
+        return self._conn().execute(
+            "UPDATE jobs SET status=?, error='interrupted', updated=?"
+            " WHERE status IN (?, ?) AND updated<?",
+            (FAILED, time.time(), QUEUED, RUNNING, before),
+        ).rowcount
+
+    def sweep(self, before: float) -> int:
+        return self._conn().execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND updated<?", (DONE, FAILED, before)
+        ).rowcount
+
+
+# ----------------- キュー ----------------- #
+class JobQueue:
+    """
+    スレッドプールでジョブを実行する。
+    handlers に登録した関数 handler(payload) -> result(dict) を kind ごとに呼ぶ。
+    """
+
+    def __init__(self, store: SqliteJobStore, workers: int, max_queue: int,
+                 retention: float = 86400):
+        self.store = store
+        self.max_queue = max_queue
+        self.retention = retention
+        self.handlers = {}
+        self.resume_after = {}      # kind -> 秒（再開できる種類だけ）
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        self._pending = 0           # このプロセスで queued + running の件数
+        self._last_sweep = 0.0
+
+    def register(self, kind: str, handler, resume_after: float | None = None):
+        """
+        resume_after を渡すと、その秒数以上止まっている同じ種類のジョブを今すぐと、
+        以後 resume_after 秒ごとに拾い直す（handler は何度実行しても同じ結果になること）。
+        """
+        self.handlers[kind] = handler
+        if resume_after:
+            self.resume_after[kind] = resume_after
+            self._resume_periodically(kind)
+
+    def _resume_periodically(self, kind: str):
+        self.resume(kind)
+        timer = threading.Timer(self.resume_after[kind], self._resume_periodically, args=(kind,))
+        timer.daemon = True
+        timer.start()
+
+    def resume(self, kind: str) -> int:
+        """止まっているジョブを拾い直して実行に回す（キューの上限は見ない）。"""
+        try:
+            claimed = self.store.claim_resumable(kind, time.time() - self.resume_after[kind])
+        except sqlite3.Error:
+            return 0
+        for job_id, payload in claimed:
+            with self._lock:
+                self._pending += 1
+            self._executor.submit(self._run, job_id, self.handlers[kind], payload)
+        return len(claimed)
+
+    def submit(self, kind: str, owner: str, payload: dict, defer: bool = False) -> str:
+        """
+        defer=True（resume_after 付きで登録した種類だけ）なら、溢れていても QueueFull にせず
+        queued の行だけ残す。実行は次に拾い直すとき（resume_after 秒以内）。
+        """
+        handler = self.handlers[kind]
+        with self._lock:
+            full = self._pending >= self.max_queue
+            if not full:
+                self._pending += 1
+        if full:
+            if not (defer and kind in self.resume_after):
+                raise QueueFull('job queue is full')
+            job_id = secrets.token_urlsafe(16)
+            self.store.create(job_id, kind, owner, payload, updated=0.0)
+            return job_id
+        try:
+            job_id = secrets.token_urlsafe(16)
+            self.store.create(job_id, kind, owner, payload)
+            self._executor.submit(self._run, job_id, handler, payload)
+        except BaseException:
+            with self._lock:
+                self._pending -= 1
+            raise
+        self._maybe_sweep()
+        return job_id
+
+    def _run(self, job_id: str, handler, payload: dict):
+        _current.job = (self.store, job_id)
+        try:
+            self.store.update(job_id, RUNNING)
+            result = handler(payload)
+            self.store.update(job_id, DONE, result=result)
+        except Exception as e:   # noqa: BLE001  （失敗はジョブの状態として返す）
+            try:
+                self.store.update(job_id, FAILED, error=f"{type(e).__name__}: {e}")
+            except Exception:    # noqa: BLE001
+                pass
+        finally:
+            _current.job = None
+            with self._lock:
+                self._pending -= 1
+
+    def get(self, job_id: str, owner: str) -> dict | None:
+        """owner が一致するジョブだけを返す。"""
+        job = self.store.get(job_id)
+        if job is None or job['owner'] != owner:
+            return None
+        return job
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"pending": self._pending, "max_queue": self.max_queue}
+
+    def _maybe_sweep(self):
+        now = time.time()
+        if now - self._last_sweep < 600:
+            return
+        self._last_sweep = now
+        try:
+            self.store.sweep(now - self.retention)
+        except sqlite3.Error:
+            pass
+        for kind in self.resume_after:
+            self.resume(kind)
+
+
+def report_progress(progress: dict):
+    """実行中のジョブの途中経過を保存する（状態の問い合わせで見える / 再開の目安になる）。"""
+    job = getattr(_current, 'job', None)
+    if job is not None:
+        store, job_id = job
+        store.update(job_id, RUNNING, result=progress)
+
+
+def init_job_queue(app):
+    """
+    ジョブキューを作って app.extensions['job_queue'] に置く。
+    起動時に、前回のプロセスが終わらせられなかったジョブを failed にしておく。
+    """
+    path = config.JOB_QUEUE_PATH
+    if not path:
+        os.makedirs(app.instance_path, exist_ok=True)
+        path = os.path.join(app.instance_path, 'jobs.sqlite3')
+    store = SqliteJobStore(path)
+    store.fail_stale(time.time() - config.JOB_STALE_AFTER)
+
+    queue = JobQueue(
+        store,
+        workers=config.JOB_WORKERS,
+        max_queue=config.JOB_MAX_QUEUE,
+        retention=config.JOB_RETENTION,
+    )
+    app.extensions['job_queue'] = queue
+    return queue
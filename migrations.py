@@ -0,0 +1,321 @@
+# migrations.py ―― バージョン付きスキーマ移行
+#
+# テーブル作成やインデックス追加はデプロイ時（または起動時）に 1 回だけ流し、
+# リクエスト処理中には DDL を実行しない。適用済みの版は schema_migrations に記録する。
+#
+#   python migrations.py          未適用の移行をすべて適用
+#   python migrations.py --check  未適用があれば終了コード 1
+
+import json
+import sys
+
+import pymysql
+
+import config
+from db import get_connection, get_account_column
+
+
+def _index_exists(cursor, table: str, index: str) -> bool:
+    cursor.execute(
+        """
+        SELECT 1 FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        LIMIT 1
+        """,
+        (table, index),
+    )
+    return cursor.fetchone() is not None
+
+
+def _column_exists(cursor, table: str, column: str) -> bool:
+    cursor.execute(
+        """
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        LIMIT 1
+        """,
+        (table, column),
+    )
+    return cursor.fetchone() is not None
+
+
+def _column_leads_index(cursor, table: str, column: str) -> bool:
+    """column を先頭列に持つインデックス（UNIQUE を含む）があるか。"""
+    cursor.execute(
+        """
+        SELECT 1 FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s
+          AND column_name = %s AND seq_in_index = 1
+        LIMIT 1
+        """,
+        (table, column),
+    )
+    return cursor.fetchone() is not None
+
+
+def _create_index(cursor, table: str, index: str, columns: str):
+    # MySQL には CREATE INDEX IF NOT EXISTS が無いので事前に確認する
+    if not _index_exists(cursor, table, index):
+        cursor.execute(f"CREATE INDEX {index} ON {table} ({columns})")
+
+
+# === 移行の定義（版番号は増やす一方、適用済みのものは書き換えない） ===
+def _m1_excel_history(cursor):
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS excel_history (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NOT NULL,
+            filename VARCHAR(255) NOT NULL,
+            data_json TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+
+
+def _m2_estimates(cursor):
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS estimates (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT NOT NULL,
+            estimate_data TEXT,
+            status VARCHAR(16) NOT NULL DEFAULT 'active',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            sent_at DATETIME NULL,
+            deleted_at DATETIME NULL
+        )
+        """
+    )
+
+
+def _m3_history_indexes(cursor):
+    # 履歴一覧（user_id で絞って created_at 降順）
+    _create_index(cursor, 'excel_history', 'idx_excel_history_user_created',
+                  'user_id, created_at')
+    # 「有効な見積りは 3 件まで」のローテーション
+    _create_index(cursor, 'estimates', 'idx_estimates_user_status_created',
+                  'user_id, status, created_at')
+
+
+def _m4_history_blob_key(cursor):
+    # 出力ファイルは内容ハッシュ（export_store）で保存し、履歴はその key を指す
+    if not _column_exists(cursor, 'excel_history', 'blob_key'):
+        cursor.execute("ALTER TABLE excel_history ADD COLUMN blob_key CHAR(64) NULL")
+
+
+def _m5_users_account_index(cursor):
+    # ユーザー管理の前方一致検索（LIKE 'xxx%'）と名前順のページ送り。
+    # アカウント列は環境によって名前が違う（get_account_column）。UNIQUE 制約などで
+    # 既にその列が先頭のインデックスがあればそれを使う
+    column = get_account_column()
+    if not _column_leads_index(cursor, 'users', column):
+        cursor.execute(f"CREATE INDEX idx_users_account ON users (`{column}`)")
+
+
+# 今までの fixed-presets.js の 2 件。フォームは全項目（チェック・単価はページの初期値）
+_SEED_FORM_DEFAULTS = {
+    'include_dohdai': 'on', 'include_kata': 'on', 'include_drying_fuel': 'on',
+    'include_bisque_fuel': 'on', 'include_hassui': 'on', 'include_paint': '',
+    'include_logo_copper': '', 'copper_unit_price': '10',
+    'include_glaze_material': 'on', 'include_main_firing_gas': 'on',
+    'include_transfer_sheet': '', 'transfer_sheet_unit_price': '10',
+    'include_chumikin': 'on', 'chumikin_unit': '10',
+    'include_shiagechin': 'on', 'shiagechin_unit': '10',
+    'include_haiimonochin': 'on', 'haiimonochin_unit': '10',
+    'include_seisojiken': '', 'seisojiken_unit': '10',
+    'include_soyakeire_dashi': 'on', 'soyakeire_dashi_unit': '10',
+    'include_soyakebarimono': 'on', 'soyakebarimono_unit': '10',
+    'include_doban_hari': '', 'doban_hari_unit': '10',
+    'include_hassui_kakouchin': '', 'hassui_kakouchin_unit': '10',
+    'include_shiyu_hiyou': 'on', 'shiyu_hiyou_unit': '10', 'include_shiyu_cost': '',
+    'include_kamairi': 'on', 'include_kamadashi': 'on', 'include_hamasuri': 'on',
+    'include_kenpin': 'on', 'include_print_kakouchin': 'on', 'print_kakouchin_unit': '10',
+    'include_nouhin_jinkenhi': '', 'include_gasoline': '',
+}
+_SEED_PRESETS = (
+    ("MMD六角皿S", "img/mmd_s.png", {
+        'sales_price': '380', 'order_quantity': '1000', 'product_weight': '200',
+        'mold_unit_price': '2500', 'mold_count': '2', 'glaze_cost': '8500',
+        'poly_count': '650', 'kiln_count': '1760', 'gas_unit_price': '140',
+        'loss_defective': '0.1', 'sawaimono_work': '700', 'seisojiken_work': '200',
+        'soyakeire_work': '250', 'soyakebarimono_work': '300',
+        'hassui_kakouchin_work': '200', 'shiyu_work': '100', 'kamairi_time': '8',
+        'kamadashi_time': '4', 'hamasuri_time': '3', 'kenpin_time': '6',
+    }),
+    ("ネンド様フェイブ", "img/nendosama_fave.png", {
+        'sales_price': '450', 'order_quantity': '1000', 'product_weight': '7',
+        'mold_unit_price': '3500', 'mold_count': '10', 'glaze_cost': '8500',
+        'poly_count': '5000', 'kiln_count': '52800', 'gas_unit_price': '140',
+        'loss_defective': '0.15', 'sawaimono_work': '800', 'seisojiken_work': '200',
+        'soyakeire_work': '300', 'soyakebarimono_work': '400',
+        'hassui_kakouchin_work': '200', 'shiyu_work': '200', 'kamairi_time': '8',
+        'kamadashi_time': '4', 'hamasuri_time': '3', 'kenpin_time': '6',
+    }),
+)
+
+
+def _m6_presets(cursor):
+    # プリセットはサーバー側で管理する。data_json は保存時に計算した dashboard_data
+    # （NULL なら初回の読み出しで計算して埋める）。updated_at はカタログの ETag に使う
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS presets (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            img VARCHAR(255) NULL,
+            form_json TEXT NOT NULL,
+            data_json TEXT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME(6) NOT NULL
+                DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+            INDEX idx_presets_name (name)
+        )
+        """
+    )
+    cursor.execute("SELECT COUNT(*) AS n FROM presets")
+    if cursor.fetchone()['n'] == 0:
+        cursor.executemany(
+            "INSERT INTO presets (name, img, form_json) VALUES (%s, %s, %s)",
+            [(name, img, json.dumps({**_SEED_FORM_DEFAULTS, **values}, ensure_ascii=False))
+             for name, img, values in _SEED_PRESETS],
+        )
+
+
+def _m7_coefficient_profiles(cursor):
+    # 係数プロファイル。版は追記のみ（変更は新しい version の行を足す）で、
+    # 見積りは計算に使った版の id と式の版（formula_spec.SPEC["version"]）を記録する
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS coefficient_profiles (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            version INT NOT NULL,
+            coefficients_json TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY uq_coefficient_profiles_name_version (name, version)
+        )
+        """
+    )
+    # kind は 'user'（target は users.id）か 'client'（target は宛名）。
+    # updated_at は各ワーカーが変更を検知する版に使う
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS coefficient_profile_bindings (
+            kind VARCHAR(16) NOT NULL,
+            target VARCHAR(255) NOT NULL,
+            profile_name VARCHAR(100) NOT NULL,
+            updated_at DATETIME(6) NOT NULL
+                DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+            PRIMARY KEY (kind, target)
+        )
+        """
+    )
+    if not _column_exists(cursor, 'estimates', 'coefficient_profile_id'):
+        cursor.execute("ALTER TABLE estimates ADD COLUMN coefficient_profile_id INT NULL")
+    if not _column_exists(cursor, 'estimates', 'formula_version'):
+        cursor.execute("ALTER TABLE estimates ADD COLUMN formula_version INT NULL")
+
+
+MIGRATIONS = (
+    (1, 'create excel_history', _m1_excel_history),
+    (2, 'create estimates', _m2_estimates),
+    (3, 'composite indexes for history and estimate rotation', _m3_history_indexes),
+    (4, 'excel_history.blob_key for content-addressed exports', _m4_history_blob_key),
+    (5, 'index on the users account column for search', _m5_users_account_index),
+    (6, 'server-side preset catalog', _m6_presets),
+    (7, 'versioned coefficient profiles', _m7_coefficient_profiles),
+)
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _ensure_version_table(cursor):
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            description VARCHAR(255) NOT NULL,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+
+
+def current_version(cursor) -> int:
+    """適用済みの最新版。schema_migrations が無ければ 0。"""
+    try:
+        cursor.execute("SELECT MAX(version) AS v FROM schema_migrations")
+    except pymysql.err.ProgrammingError:
+        return 0
+    row = cursor.fetchone()
+    return (row and row['v']) or 0
+
+
+def migrate(verbose: bool = False) -> list[int]:
+    """未適用の移行を順に適用し、適用した版番号のリストを返す。"""
+    applied = []
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            _ensure_version_table(cursor)
+            # 複数ワーカーが同時に起動しても 1 回だけ流れるようにロックする
+            cursor.execute("SELECT GET_LOCK('schema_migrations', 30) AS ok")
+            if not cursor.fetchone()['ok']:
+                raise RuntimeError('could not acquire the schema migration lock')
+            try:
+                version = current_version(cursor)
+                for number, description, apply in MIGRATIONS:
+                    if number <= version:
+                        continue
+                    if verbose:
+                        print(f"applying {number}: {description}")
+                    apply(cursor)
+                    cursor.execute(
+                        "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                        (number, description),
+                    )
+                    conn.commit()
+                    applied.append(number)
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK('schema_migrations')")
+    finally:
+        conn.close()
+    return applied
+
+
+def check_schema():
+    """スキーマが最新でなければ RuntimeError（起動時の早期失敗用）。"""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            version = current_version(cursor)
+    finally:
+        conn.close()
+    if version < LATEST_VERSION:
+        raise RuntimeError(
+            f"database schema is at version {version}, expected {LATEST_VERSION}. "
+            "Run `python migrations.py` before starting the app."
+        )
+
+
+def init_schema(app):
+    """起動時の処理。config に従って自動適用 または 版のチェックだけを行う。"""
+    if config.DB_AUTO_MIGRATE:
+        migrate()
+    elif config.DB_SCHEMA_CHECK:
+        check_schema()
+
+
+if __name__ == '__main__':
+    if '--check' in sys.argv[1:]:
+        try:
+            check_schema()
+        except RuntimeError as e:
+            print(e)
+            sys.exit(1)
+        print('schema is up to date')
+    else:
+        done = migrate(verbose=True)
+        print(f"applied {len(done)} migration(s); schema at version {LATEST_VERSION}")
@@ -0,0 +1,200 @@
+# password_hasher.py ―― パスワードのハッシュ計算をリクエスト処理から切り離す
+#
+# bcrypt はわざと遅い CPU 処理なので、始業時のようにログインが集中すると
+# リクエストワーカーが全部ハッシュ計算で埋まってしまう。
+# ・計算は専用のスレッドプールで行う（bcrypt は計算中 GIL を手放すので並列に進む）
+# ・実行中 + 待ちの件数に上限を設け、空かなければ待たずに HasherBusy（→ 503）
+# ・枠待ち・キュー待ち・計算を合わせて timeout 秒を超えたら、待ちを取り消して HasherBusy（→ 503）
+# ・アカウントごとに失敗回数を数え、続けて失敗したら一定時間ハッシュ計算自体をしない
+# ・ログイン成功時、コストが今の設定より低いハッシュは裏で作り直して保存する
+#
+# 検証のスループットは python tests/bench_password_hasher.py で計測する（/login をテストクライアントで叩く）。
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from passlib.hash import bcrypt_sha256
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class HasherBusy(RuntimeError):
+    """ハッシュ計算の枠が埋まっていて待っても空かなかった、または時間内に終わらなかった。"""
+
+
+class PasswordHasher:
+    def __init__(self, workers: int, max_pending: int, wait: float, rounds: int, timeout: float):
+        self.scheme = bcrypt_sha256.using(rounds=rounds)
+        self.wait = wait
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hasher')
+        self._lock = threading.Lock()
+        # metrics
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.upgraded = 0
+        self.total_wait_ms = 0.0
+        self.total_run_ms = 0.0
+
+    def _call(self, fn, *args):
+        started = time.perf_counter()
+        if not self._slots.acquire(timeout=self.wait):
+            with self._lock:
+                self.rejected += 1
+            raise HasherBusy('password hasher is busy')
+        try:
+            future = self._executor.submit(self._timed, fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # 枠は計算が終わった（または取り消した）ときに返す。時間切れで先に戻っても、
+        # 計算中のものは終わるまで「実行中」として数える
+        future.add_done_callback(lambda _: self._slots.release())
+        remaining = self.timeout - (time.perf_counter() - started)
+        try:
+            result, run_started, run_ms = future.result(timeout=max(remaining, 0.0))
+        except FutureTimeout:
+            future.cancel()         # まだキューで待っていれば計算しない
+            with self._lock:
+                self.timed_out += 1
+            raise HasherBusy('password hasher timed out')
+        with self._lock:
+            self.completed += 1
+            self.total_wait_ms += (run_started - started) * 1000     # 枠待ち + キュー待ち
+            self.total_run_ms += run_ms
+        return result
+
+    @staticmethod
+    def _timed(fn, *args):
+        started = time.perf_counter()
+        result = fn(*args)
+        return result, started, (time.perf_counter() - started) * 1000
+
+    def hash(self, password: str) -> str:
+        return self._call(self.scheme.hash, password)
+
+    def verify(self, password: str, password_hash: str) -> bool:
+        try:
+            return self._call(self.scheme.verify, password, password_hash)
+        except ValueError:      # 壊れた / 未対応形式のハッシュ
+            return False
+
+    def needs_update(self, password_hash: str) -> bool:
+        try:
+            return self.scheme.needs_update(password_hash)
+        except ValueError:
+            return False
+
+    def upgrade_later(self, password: str, save):
+        """
+        今のコストでハッシュを作り直し save(new_hash) を呼ぶ（応答は待たせない）。
+        枠が空いていなければ今回は見送る（次のログインでまた試す）。
+        """
+        if not self._slots.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                save(self.scheme.hash(password))
+                with self._lock:
+                    self.upgraded += 1
+            except Exception:   # noqa: BLE001  （作り直しの失敗でログインは失敗させない）
+                logger.exception('password hash upgrade failed')
+            finally:
+                self._slots.release()
+
+        self._executor.submit(run)
+
+    def stats(self) -> dict:
+        with self._lock:
+            done = self.completed
+            return {
+                "max_pending": self.max_pending,
+                "completed": done,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "upgraded": self.upgraded,
+                "avg_wait_ms": round(self.total_wait_ms / done, 3) if done else 0.0,
+                "avg_run_ms": round(self.total_run_ms / done, 3) if done else 0.0,
+            }
+
+
+# ----------------- アカウントごとの試行制限 ----------------- #
+class LoginThrottle:
+    """
+    window 秒以内に max_failures 回失敗したアカウントは、最後の失敗から lockout 秒間ロックする。
+    プロセス内だけで数える（ワーカーが複数なら上限はワーカー数倍まで緩む）。
+    """
+
+    def __init__(self, max_failures: int, window: float, lockout: float, maxsize: int = 10000):
+        self.max_failures = max_failures
+        self.window = window
+        self.lockout = lockout
+        self.maxsize = maxsize
+        self._failures = {}         # key -> (count, first_failure, last_failure)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(account_name: str) -> str:
+        return account_name.strip().lower()
+
+    def retry_after(self, account_name: str) -> int:
+        """ロック中なら残り秒数、そうでなければ 0。"""
+        if not self.max_failures:
+            return 0
+        now = time.time()
+        with self._lock:
+            entry = self._failures.get(self._key(account_name))
+        if entry is None:
+            return 0
+        count, _, last = entry
+        if count >= self.max_failures and now < last + self.lockout:
+            return int(last + self.lockout - now) + 1
+        return 0
+
+    def fail(self, account_name: str):
+        if not self.max_failures:
+            return
+        now = time.time()
+        key = self._key(account_name)
+        with self._lock:
+            count, first, _ = self._failures.get(key, (0, now, now))
+            if now - first > self.window:
+                count, first = 0, now
+            self._failures[key] = (count + 1, first, now)
+            if len(self._failures) > self.maxsize:
+                self._sweep(now)
+
+    def succeed(self, account_name: str):
+        with self._lock:
+            self._failures.pop(self._key(account_name), None)
+
+    def _sweep(self, now: float):
+        horizon = max(self.window, self.lockout)
+        for key in [k for k, (_, _, last) in self._failures.items() if now - last > horizon]:
+            del self._failures[key]
+        # それでも溢れていれば古いものから捨てる
+        while len(self._failures) > self.maxsize:
+            del self._failures[next(iter(self._failures))]
+
+
+hasher = PasswordHasher(
+    workers=config.PASSWORD_HASH_WORKERS,
+    max_pending=config.PASSWORD_HASH_MAX_PENDING,
+    wait=config.PASSWORD_HASH_WAIT,
+    rounds=config.PASSWORD_HASH_ROUNDS,
+    timeout=config.PASSWORD_HASH_TIMEOUT,
+)
+login_throttle = LoginThrottle(
+    max_failures=config.LOGIN_MAX_FAILURES,
+    window=config.LOGIN_FAILURE_WINDOW,
+    lockout=config.LOGIN_LOCKOUT,
+)
+
@@ -0,0 +1,254 @@
+# profiles.py ―― 係数プロファイル（取引先・ユーザーごとの定数の上書き）
+#
+# formula_spec.SPEC["constants"]（土代係数・時給など）を、名前付きのプロファイルで上書きする。
+# プロファイルは coefficient_profiles に版ごとに追記し（変更 = 新しい version の行）、
+# どれを使うかは coefficient_profile_bindings の「宛名 → プロファイル名」
+# 「ユーザー → プロファイル名」で決める（宛名の割り当てが優先、どちらも無ければ既定の係数）。
+#
+# 計算のたびに DB は読まない。各ワーカーは最新版と割り当ての写しをメモリに持ち、
+# バックグラウンドのスレッドが
+#   ・通知ファイル（同じホストのワーカーが変更したときに触る）の mtime を短い間隔で
+#   ・DB の版（最新の版 id・割り当ての件数と最終更新）を長めの間隔で
+# 確かめて、変わっていたときだけ読み直す。写しは 1 つのタプルを差し替えるだけなので、
+# 読む側はロックを取らない。
+
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+import config
+from formula_spec import CONSTANTS, INPUT_PARSERS, SPEC, divisor_constants
+from repository import get_repository
+
+logger = logging.getLogger(__name__)
+
+BINDING_KINDS = ('user', 'client')
+NAME_MAX_LENGTH = 100
+DIVISOR_CONSTANTS = frozenset(divisor_constants(SPEC))
+_parse_client_name = dict(INPUT_PARSERS)['client_name']
+
+
+class Profile:
+    """1 つの版。constants は既定の係数に上書き分を重ねたもの（全定数を持つ）。"""
+    __slots__ = ('id', 'name', 'version', 'overrides', 'constants', 'key')
+
+    def __init__(self, profile_id, name: str, version: int, overrides: dict):
+        self.id = profile_id
+        self.name = name
+        self.version = version
+        # 式から消えた定数の上書きは無視する
+        self.overrides = {k: v for k, v in overrides.items() if k in CONSTANTS}
+        self.constants = {**CONSTANTS, **self.overrides}
+        # コンパイル済みモデル・計算キャッシュのキー（同じ係数なら版が違っても共有）
+        self.key = tuple(sorted(self.constants.items()))
+
+    @classmethod
+    def from_row(cls, row) -> 'Profile':
+        return cls(row['id'], row['name'], row['version'], json.loads(row['coefficients_json']))
+
+    def to_json(self) -> dict:
+        return {"id": self.id, "name": self.name, "version": self.version,
+                "overrides": self.overrides, "constants": self.constants}
+
+
+DEFAULT_PROFILE = Profile(None, 'default', 0, {})
+
+
+def client_key(client_name) -> str:
+    """宛名の割り当てのキー（フォームの client_name と同じ正規化）。"""
+    return _parse_client_name(client_name or '')
+
+
+def validate_coefficients(coefficients) -> dict:
+    """上書きする定数を検証して返す（未知の名前・負・非有限・割る数の 0 は ValueError）。"""
+    if not isinstance(coefficients, dict) or not coefficients:
+        raise ValueError("coefficients は定数名 -> 値のオブジェクトで指定してください。")
+    result = {}
+    for name, value in coefficients.items():
+        if name not in CONSTANTS:
+            raise ValueError(f"未知の定数です: {name}")
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"{name} は数値で指定してください。")
+        if not math.isfinite(value) or value < 0:
+            raise ValueError(f"{name} は 0 以上の数値で指定してください。")
+        if name in DIVISOR_CONSTANTS and value == 0:
+            raise ValueError(f"{name} は割る数なので 0 にはできません。")
+        result[name] = value
+    return result
+
+
+class ProfileCache:
+    """最新版と割り当ての写し。resolve() はメモリだけを見る。"""
+
+    def __init__(self):
+        self.notify_path = None
+        # (name -> Profile, user_id -> name, 宛名 -> name)
+        self._state = ({}, {}, {})
+        self._stamp = None
+        self._notify_mtime = None
+        self._lock = threading.Lock()       # 読み直しを 1 本にする（読む側は取らない）
+        self._by_id = {}                    # 古い版も含む id -> Profile（再現用。読んだものだけ）
+        self._thread = None
+        # metrics
+        self.reloads = 0
+        self.failures = 0
+        self.last_reload = None
+
+    # --- 参照（計算のたびに呼ばれる） ---
+    def resolve(self, user_id, client_name='') -> Profile:
+        """宛名の割り当て → ユーザーの割り当て → 既定の係数 の順に決める。"""
+        profiles, users, clients = self._state
+        name = clients.get(client_key(client_name)) if client_name else None
+        if name not in profiles:
+            name = users.get(user_id)
+        return profiles.get(name, DEFAULT_PROFILE)
+
+    def browser_payload(self, user_id) -> dict | None:
+        """
+        画面に埋め込む分。本人に割り当てたプロファイルの定数と、宛名の割り当てがあるかどうかだけ
+        （宛名とプロファイルの対応・他のプロファイルの係数は出さず、宛名はサーバーで解決する）。
+        未ログインなら None。
+        """
+        if user_id is None:
+            return None
+        profiles, users, clients = self._state
+        profile = profiles.get(users.get(user_id))
+        return {
+            "user": None if profile is None else {
+                "id": profile.id, "version": profile.version, "constants": profile.constants,
+            },
+            "client_bindings": bool(clients),
+        }
+
+    def latest(self) -> list:
+        return sorted(self._state[0].values(), key=lambda p: p.name)
+
+    def bindings(self) -> list:
+        """[{kind, target, profile}, ...]（ユーザー → 宛名の順）。"""
+        _, users, clients = self._state
+        return (
+            [{"kind": "user", "target": str(k), "profile": v} for k, v in sorted(users.items())]
+            + [{"kind": "client", "target": k, "profile": v} for k, v in sorted(clients.items())]
+        )
+
+    def get_version(self, profile_id: int) -> Profile | None:
+        """特定の版（古い版も）。見積りの再現用なので、無ければ DB から読む。"""
+        profile = self._by_id.get(profile_id)
+        if profile is None:
+            row = get_repository().get_profile(profile_id)
+            if row is None:
+                return None
+            profile = self._by_id.setdefault(profile_id, Profile.from_row(row))
+        return profile
+
+    # --- 読み直し ---
+    def reload(self):
+        """DB から最新版と割り当てを読み直す。版は先に読む（読む間の変更は次回拾う）。"""
+        with self._lock:
+            repo = get_repository()
+            stamp = repo.profiles_stamp()
+            profiles = {}
+            for row in repo.list_latest_profiles():
+                profile = self._by_id.get(row['id']) or Profile.from_row(row)
+                self._by_id[profile.id] = profile
+                profiles[profile.name] = profile
+            users, clients = {}, {}
+            for row in repo.list_profile_bindings():
+                if row['kind'] == 'user':
+                    try:
+                        users[int(row['target'])] = row['profile_name']
+                    except ValueError:
+                        continue
+                elif row['kind'] == 'client':
+                    clients[row['target']] = row['profile_name']
+            self._state = (profiles, users, clients)
+            self._stamp = stamp
+            self.reloads += 1
+            self.last_reload = time.time()
+
+    def notify(self):
+        """変更したワーカーが呼ぶ。自分はすぐ読み直し、同じホストの他のワーカーには通知ファイルで知らせる。"""
+        self.reload()
+        if self.notify_path:
+            with open(self.notify_path, 'a'):
+                pass
+            os.utime(self.notify_path, None)
+            self._notify_mtime = self._read_notify_mtime()
+
+    def _read_notify_mtime(self):
+        try:
+            return os.stat(self.notify_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def check(self, poll_db: bool) -> bool:
+        """通知ファイル（と poll_db なら DB の版）を見て、変わっていれば読み直す。"""
+        changed = False
+        if self.notify_path:
+            mtime = self._read_notify_mtime()
+            if mtime != self._notify_mtime:
+                self._notify_mtime = mtime
+                changed = True
+        if not changed and poll_db:
+            changed = get_repository().profiles_stamp() != self._stamp
+        if changed:
+            self.reload()
+        return changed
+
+    def start(self, notify_path: str | None, check_interval: float, poll_interval: float):
+        """読み込んでから監視を始める。"""
+        self.notify_path = notify_path
+        self._notify_mtime = self._read_notify_mtime() if notify_path else None
+        self.reload()
+
+        def run():
+            last_poll = time.monotonic()
+            while True:
+                time.sleep(check_interval)
+                now = time.monotonic()
+                poll_db = poll_interval > 0 and now - last_poll >= poll_interval
+                if poll_db:
+                    last_poll = now
+                try:
+                    self.check(poll_db)
+                except Exception:   # noqa: BLE001  （失敗しても写しはそのまま使い続ける）
+                    logger.exception('coefficient profile reload failed')
+                    with self._lock:
+                        self.failures += 1
+
+        self._thread = threading.Thread(target=run, name='profile-watcher', daemon=True)
+        self._thread.start()
+
+    def stats(self) -> dict:
+        profiles, users, clients = self._state
+        return {
+            "profiles": len(profiles),
+            "user_bindings": len(users),
+            "client_bindings": len(clients),
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "last_reload": self.last_reload,
+        }
+
+
+profile_cache = ProfileCache()
+
+
+def init_profiles(app):
+    """
+    起動時に 1 回読み、変更の監視を始める。
+    通知ファイルは config.PROFILE_NOTIFY_PATH（未指定なら instance/coefficient_profiles.notify）。
+    DB を使わない構成（スキーマ確認も自動移行もしない）では既定の係数だけで動く。
+    """
+    if not (config.DB_SCHEMA_CHECK or config.DB_AUTO_MIGRATE):
+        return profile_cache
+    notify_path = config.PROFILE_NOTIFY_PATH or os.path.join(
+        app.instance_path, 'coefficient_profiles.notify'
+    )
+    os.makedirs(os.path.dirname(notify_path), exist_ok=True)
+    profile_cache.start(notify_path, config.PROFILE_NOTIFY_CHECK, config.PROFILE_POLL_INTERVAL)
+    app.extensions['profile_cache'] = profile_cache
+    return profile_cache
@@ -0,0 +1,515 @@
+# repository.py ―― データアクセス層（SQL はすべてここに集める）
+#
+# 起動時に users のカラム構成を 1 回だけ調べ、アカウント列を埋め込んだ SQL を
+# まとめて組み立てておく。SELECT * は使わず、必要な列だけを取得する。
+# 実行は Driver インターフェース越しなので、テストでは差し替えられる。
+
+import pymysql
+
+import config
+from db import PoolTimeout, get_connection, get_account_column, get_users_columns, stream_query
+
+# デッドロック（1213）・ロック待ちタイムアウト（1205）は取り直せば通るので再試行する
+_RETRYABLE_ERRORS = (1213, 1205)
+
+# 接続断・ロック待ち・プールの枯渇など、時間をおけば通る失敗
+# （write-behind はこれだけ回数の制限なしに再試行し、それ以外は行を分けて切り離す）
+TRANSIENT_ERRORS = (pymysql.err.OperationalError, pymysql.err.InterfaceError, PoolTimeout)
+
+
+class PyMySQLDriver:
+    """
+    db.get_connection() を使うドライバ。
+    pymysql はサーバー側プリペアドステートメントを持たないため、
+    文は Repository 側で 1 度だけ組み立てて値だけをクライアント側でバインドする。
+    同じインターフェースを満たせばプリペアド対応のドライバに差し替えられる。
+    """
+
+    def __init__(self, connect=get_connection, stream_query=stream_query):
+        self.connect = connect
+        self.stream_query = stream_query
+
+    def query_one(self, sql: str, params=()):
+        conn = self.connect()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, params)
+                return cursor.fetchone()
+        finally:
+            conn.close()
+
+    def query_all(self, sql: str, params=()) -> list:
+        conn = self.connect()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, params)
+                return list(cursor.fetchall())
+        finally:
+            conn.close()
+
+    def stream(self, sql: str, params=()):
+        """サーバー側カーソルで 1 行ずつ返す（大量行のダンプ用）。"""
+        return self.stream_query(sql, params)
+
+    def execute(self, sql: str, params=()) -> int:
+        """更新系を実行してコミットし、lastrowid を返す。"""
+        conn = self.connect()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, params)
+                lastrowid = cursor.lastrowid
+            conn.commit()
+            return lastrowid
+        finally:
+            conn.close()
+
+    def execute_rowcount(self, sql: str, params=()) -> int:
+        """更新系を実行してコミットし、影響を受けた行数を返す。"""
+        conn = self.connect()
+        try:
+            with conn.cursor() as cursor:
+                count = cursor.execute(sql, params)
+            conn.commit()
+            return count
+        finally:
+            conn.close()
+
+    def execute_many(self, sql: str, rows) -> int:
+        """executemany で複数行を 1 回のコミットで書き、件数を返す。"""
+        conn = self.connect()
+        try:
+            with conn.cursor() as cursor:
+                count = cursor.executemany(sql, rows)
+            conn.commit()
+            return count
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def execute_transaction(self, steps, retries: int = 2) -> list:
+        """
+        [(sql, params), ...] を 1 つのトランザクションで実行してコミットする。
+        各文の lastrowid を返す。デッドロックなどは retries 回まで最初からやり直す。
+        """
+        conn = self.connect()
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    ids = []
+                    with conn.cursor() as cursor:
+                        for sql, params in steps:
+                            cursor.execute(sql, params)
+                            ids.append(cursor.lastrowid)
+                    conn.commit()
+                    return ids
+                except pymysql.err.OperationalError as e:
+                    conn.rollback()
+                    if e.args[0] not in _RETRYABLE_ERRORS or attempt == retries:
+                        raise
+                except Exception:
+                    conn.rollback()
+                    raise
+        finally:
+            conn.close()
+
+
+def _quote(identifier: str) -> str:
+    return '`' + identifier.replace('`', '``') + '`'
+
+
+# 履歴一覧に出す data_json の項目
+HISTORY_SUMMARY_FIELDS = ('sales_price', 'order_quantity')
+
+
+def _like_escape(value: str) -> str:
+    """LIKE のパターン中で % _ \\ をそのままの文字として扱う。"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _like_prefix(value: str) -> str:
+    return _like_escape(value) + '%'
+
+
+def _in_clause(values) -> str:
+    return "(" + ", ".join(["%s"] * len(values)) + ")"
+
+
+class Repository:
+    """イントロスペクション結果から組み立てた SQL の集合と、その実行。"""
+
+    def __init__(self, driver, account_column: str):
+        self.driver = driver
+        self.account_column = account_column
+        acc = _quote(account_column)
+
+        # --- users ---
+        self.sql_user_for_login = (
+            f"SELECT id, {acc} AS account_name, password_hash FROM users WHERE {acc}=%s LIMIT 1"
+        )
+        self.sql_account_exists = f"SELECT id FROM users WHERE {acc}=%s LIMIT 1"
+        self.sql_insert_user    = f"INSERT INTO users ({acc}, password_hash) VALUES (%s, %s)"
+        self.sql_update_password_hash = "UPDATE users SET password_hash=%s WHERE id=%s"
+        # ユーザー管理の一覧。検索なしは id 順、前方一致検索は (アカウント名, id) 順で
+        # キーセットのページ送り。どちらもインデックス（主キー / idx_users_account）に乗る。
+        users_page = f"SELECT id, {acc} AS account_name FROM users{{where}} ORDER BY {{order}} LIMIT %s"
+        self.sql_users_page_first = users_page.format(where="", order="id")
+        self.sql_users_page_after = users_page.format(where=" WHERE id > %s", order="id")
+        self.sql_users_search_first = users_page.format(
+            where=f" WHERE {acc} LIKE %s", order=f"{acc}, id"
+        )
+        self.sql_users_search_after = users_page.format(
+            where=f" WHERE {acc} LIKE %s AND ({acc} > %s OR ({acc} = %s AND id > %s))",
+            order=f"{acc}, id",
+        )
+        self.sql_delete_user    = "DELETE FROM users WHERE id=%s"
+        # IN (...) のプレースホルダ数は件数に合わせて末尾に付ける
+        self.sql_existing_user_ids = "SELECT id FROM users WHERE id IN "
+        # 削除したユーザーの行は少しずつ消す（1 文あたりのロックを短く保つ）
+        self.sql_purge_history   = "DELETE FROM excel_history WHERE user_id=%s LIMIT %s"
+        self.sql_purge_estimates = "DELETE FROM estimates WHERE user_id=%s LIMIT %s"
+
+        # --- presets ---
+        # カタログは (name, id) 順のキーセットでページ送り。件数は数百程度なので
+        # 検索は部分一致（LIKE '%xx%'）で、並びだけ idx_presets_name に乗せる。
+        presets_page = (
+            "SELECT id, name, img, form_json, data_json FROM presets{where} "
+            "ORDER BY name, id LIMIT %s"
+        )
+        after = "(name > %s OR (name = %s AND id > %s))"
+        self.sql_presets_page = {
+            (False, False): presets_page.format(where=""),
+            (False, True): presets_page.format(where=f" WHERE {after}"),
+            (True, False): presets_page.format(where=" WHERE name LIKE %s"),
+            (True, True): presets_page.format(where=f" WHERE name LIKE %s AND {after}"),
+        }
+        self.sql_presets_version = (
+            "SELECT COUNT(*) AS count, MAX(updated_at) AS updated FROM presets"
+        )
+        self.sql_preset = "SELECT id, name, img, form_json, data_json FROM presets WHERE id=%s"
+        self.sql_insert_preset = (
+            "INSERT INTO presets (name, img, form_json, data_json) VALUES (%s, %s, %s, %s)"
+        )
+        self.sql_update_preset = (
+            "UPDATE presets SET name=%s, img=%s, form_json=%s, data_json=%s WHERE id=%s"
+        )
+        self.sql_set_preset_data = "UPDATE presets SET data_json=%s WHERE id=%s"
+        self.sql_delete_preset = "DELETE FROM presets WHERE id=%s"
+
+        # --- coefficient_profiles ---
+        # 版は追記のみ。新しい版は「同じ name の最大 version + 1」を 1 文で挿入する
+        # （並行しても UNIQUE (name, version) で重複はエラーになる）。
+        self.sql_latest_profiles = (
+            "SELECT p.id, p.name, p.version, p.coefficients_json FROM coefficient_profiles p"
+            " JOIN (SELECT name, MAX(version) AS version FROM coefficient_profiles GROUP BY name) m"
+            " ON m.name = p.name AND m.version = p.version ORDER BY p.name"
+        )
+        self.sql_profile = (
+            "SELECT id, name, version, coefficients_json FROM coefficient_profiles WHERE id=%s"
+        )
+        self.sql_insert_profile = (
+            "INSERT INTO coefficient_profiles (name, version, coefficients_json)"
+            " SELECT %s, COALESCE(MAX(version), 0) + 1, %s FROM coefficient_profiles WHERE name=%s"
+        )
+        self.sql_profile_bindings = (
+            "SELECT kind, target, profile_name FROM coefficient_profile_bindings ORDER BY kind, target"
+        )
+        self.sql_set_profile_binding = (
+            "INSERT INTO coefficient_profile_bindings (kind, target, profile_name) VALUES (%s, %s, %s)"
+            " ON DUPLICATE KEY UPDATE profile_name=VALUES(profile_name)"
+        )
+        self.sql_delete_profile_binding = (
+            "DELETE FROM coefficient_profile_bindings WHERE kind=%s AND target=%s"
+        )
+        # 各ワーカーが定期的に読む版（主キーと件数だけなので軽い）
+        self.sql_profiles_stamp = (
+            "SELECT (SELECT MAX(id) FROM coefficient_profiles) AS last_profile,"
+            " (SELECT COUNT(*) FROM coefficient_profile_bindings) AS bindings,"
+            " (SELECT MAX(updated_at) FROM coefficient_profile_bindings) AS bindings_updated"
+        )
+
+        # --- excel_history ---
+        # 一覧は表示に使う項目だけを SQL 側で取り出す（data_json 全体は返さない）。
+        # (created_at, id) のキーセットで次ページへ進む。並びは
+        # idx_excel_history_user_created (user_id, created_at) + 主キー id に乗る。
+        summary = ", ".join(
+            f"IF(JSON_VALID(data_json),"
+            f" NULLIF(JSON_UNQUOTE(JSON_EXTRACT(data_json, '$.{field}')), 'null'), NULL)"
+            f" AS {field}"
+            for field in HISTORY_SUMMARY_FIELDS
+        )
+        page = (
+            f"SELECT id, filename, created_at, {summary} FROM excel_history "
+            "WHERE user_id=%s{after} ORDER BY created_at DESC, id DESC LIMIT %s"
+        )
+        self.sql_history_page_first = page.format(after="")
+        self.sql_history_page_after = page.format(
+            after=" AND (created_at < %s OR (created_at = %s AND id < %s))"
+        )
+        self.sql_set_history_blob_key = (
+            "UPDATE excel_history SET blob_key=%s WHERE id=%s AND user_id=%s"
+        )
+        self.sql_history_data = (
+            "SELECT id, filename, data_json, created_at FROM excel_history "
+            "WHERE id=%s AND user_id=%s"
+        )
+        self.sql_history_file = (
+            "SELECT id, filename, blob_key, data_json, created_at FROM excel_history "
+            "WHERE id=%s AND user_id=%s"
+        )
+        self.sql_insert_history = (
+            "INSERT INTO excel_history (user_id, filename, data_json, blob_key) "
+            "VALUES (%s, %s, %s, %s)"
+        )
+        # IN (...) のプレースホルダ数は件数に合わせて末尾に付ける
+        self.sql_history_data_by_ids = (
+            "SELECT id, filename, data_json, created_at FROM excel_history WHERE user_id=%s AND id IN "
+        )
+
+        self.sql_dump_history = (
+            "SELECT id, user_id, filename, blob_key, created_at, data_json FROM excel_history"
+            "{where} ORDER BY id"
+        )
+
+        # --- estimates ---
+        # 「有効な見積りは新しい N 件まで」: 挿入のあと、新しい順で N 件目より後ろを
+        # まとめて deleted にする。COUNT → 最古を SELECT → UPDATE と分けないので、
+        # 同じユーザーの保存が並行しても最後に走った UPDATE が N 件に揃える。
+        # 並びは idx_estimates_user_status_created (user_id, status, created_at) + id に乗る。
+        # 削除済みのユーザー（他ワーカーの書き残しなど）の見積りは挿入しない
+        self.sql_insert_estimate = (
+            "INSERT INTO estimates (user_id, estimate_data, status, coefficient_profile_id, formula_version)"
+            " SELECT id, %s, 'active', %s, %s FROM users WHERE id=%s"
+        )
+        self.sql_rotate_estimates = (
+            "UPDATE estimates e JOIN ("
+            " SELECT id FROM estimates WHERE user_id=%s AND status='active'"
+            " ORDER BY created_at DESC, id DESC LIMIT 18446744073709551615 OFFSET %s"
+            ") old ON old.id = e.id "
+            "SET e.status='deleted', e.deleted_at=NOW()"
+        )
+        self.sql_dump_estimates = (
+            "SELECT id, user_id, status, created_at, sent_at, deleted_at,"
+            " coefficient_profile_id, formula_version, estimate_data FROM estimates"
+            "{where} ORDER BY id"
+        )
+        self.sql_estimate_data_by_ids = (
+            "SELECT id, estimate_data, created_at FROM estimates WHERE user_id=%s AND id IN "
+        )
+
+    # --- users ---
+    def find_user_for_login(self, account_name: str):
+        """id / account_name / password_hash だけを返す。"""
+        return self.driver.query_one(self.sql_user_for_login, (account_name,))
+
+    def account_exists(self, account_name: str) -> bool:
+        return self.driver.query_one(self.sql_account_exists, (account_name,)) is not None
+
+    def create_user(self, account_name: str, password_hash: str) -> int:
+        return self.driver.execute(self.sql_insert_user, (account_name, password_hash))
+
+    def update_password_hash(self, user_id: int, password_hash: str):
+        self.driver.execute(self.sql_update_password_hash, (password_hash, user_id))
+
+    def list_users_page(self, limit: int, prefix: str = '', after=None) -> list:
+        """
+        最大 limit 件の id / account_name。
+        prefix があればアカウント名の前方一致で (account_name, id) 順、after=(account_name, id)。
+        なければ id 順、after=id。
+        """
+        if not prefix:
+            if after is None:
+                return self.driver.query_all(self.sql_users_page_first, (limit,))
+            return self.driver.query_all(self.sql_users_page_after, (after, limit))
+
+        pattern = _like_prefix(prefix)
+        if after is None:
+            return self.driver.query_all(self.sql_users_search_first, (pattern, limit))
+        name, last_id = after
+        return self.driver.query_all(
+            self.sql_users_search_after, (pattern, name, name, last_id, limit)
+        )
+
+    def delete_user(self, user_id: int):
+        self.driver.execute(self.sql_delete_user, (user_id,))
+
+    def existing_user_ids(self, user_ids) -> set:
+        """user_ids のうち users に残っている id。"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        rows = self.driver.query_all(
+            self.sql_existing_user_ids + _in_clause(user_ids), tuple(user_ids)
+        )
+        return {row['id'] for row in rows}
+
+    def purge_user_history(self, user_id: int, limit: int) -> int:
+        """user_id の excel_history を最大 limit 行消し、消した行数を返す。"""
+        return self.driver.execute_rowcount(self.sql_purge_history, (user_id, limit))
+
+    def purge_user_estimates(self, user_id: int, limit: int) -> int:
+        """user_id の estimates を最大 limit 行消し、消した行数を返す。"""
+        return self.driver.execute_rowcount(self.sql_purge_estimates, (user_id, limit))
+
+    # --- presets ---
+    def list_presets_page(self, limit: int, query: str = '', after=None) -> list:
+        """名前順に最大 limit 件。query は名前の部分一致、after=(name, id)。"""
+        params = []
+        if query:
+            params.append('%' + _like_escape(query) + '%')
+        if after is not None:
+            name, last_id = after
+            params += [name, name, last_id]
+        params.append(limit)
+        sql = self.sql_presets_page[(bool(query), after is not None)]
+        return self.driver.query_all(sql, tuple(params))
+
+    def presets_version(self):
+        """(件数, 最終更新時刻)。追加・更新・削除のどれでも変わる。"""
+        row = self.driver.query_one(self.sql_presets_version)
+        return row['count'], row['updated']
+
+    def get_preset(self, preset_id: int):
+        return self.driver.query_one(self.sql_preset, (preset_id,))
+
+    def insert_preset(self, name: str, img, form_json: str, data_json: str) -> int:
+        return self.driver.execute(self.sql_insert_preset, (name, img, form_json, data_json))
+
+    def update_preset(self, preset_id: int, name: str, img, form_json: str, data_json: str):
+        self.driver.execute(self.sql_update_preset, (name, img, form_json, data_json, preset_id))
+
+    def set_preset_data(self, preset_id: int, data_json: str):
+        self.driver.execute(self.sql_set_preset_data, (data_json, preset_id))
+
+    def delete_preset(self, preset_id: int) -> bool:
+        return self.driver.execute_rowcount(self.sql_delete_preset, (preset_id,)) > 0
+
+    # --- coefficient_profiles ---
+    def list_latest_profiles(self) -> list:
+        """name ごとの最新版（id / name / version / coefficients_json）。"""
+        return self.driver.query_all(self.sql_latest_profiles)
+
+    def get_profile(self, profile_id: int):
+        """特定の版（見積りの再現用。古い版も返す）。"""
+        return self.driver.query_one(self.sql_profile, (profile_id,))
+
+    def insert_profile_version(self, name: str, coefficients_json: str) -> int:
+        return self.driver.execute(self.sql_insert_profile, (name, coefficients_json, name))
+
+    def list_profile_bindings(self) -> list:
+        return self.driver.query_all(self.sql_profile_bindings)
+
+    def set_profile_binding(self, kind: str, target: str, profile_name: str):
+        self.driver.execute(self.sql_set_profile_binding, (kind, target, profile_name))
+
+    def delete_profile_binding(self, kind: str, target: str) -> bool:
+        return self.driver.execute_rowcount(self.sql_delete_profile_binding, (kind, target)) > 0
+
+    def profiles_stamp(self) -> tuple:
+        """(最新の版 id, 割り当て件数, 割り当ての最終更新)。どの変更でも変わる。"""
+        row = self.driver.query_one(self.sql_profiles_stamp)
+        return row['last_profile'], row['bindings'], row['bindings_updated']
+
+    # --- excel_history ---
+    def list_history_page(self, user_id: int, limit: int, after=None) -> list:
+        """
+        新しい順に最大 limit 件。after=(created_at, id) ならその行より後ろから。
+        各行は id / filename / created_at と HISTORY_SUMMARY_FIELDS の値。
+        """
+        if after is None:
+            return self.driver.query_all(self.sql_history_page_first, (user_id, limit))
+        created_at, last_id = after
+        return self.driver.query_all(
+            self.sql_history_page_after, (user_id, created_at, created_at, last_id, limit)
+        )
+
+    def set_history_blob_key(self, history_id: int, user_id: int, blob_key: str):
+        self.driver.execute(self.sql_set_history_blob_key, (blob_key, history_id, user_id))
+
+    def get_history_data(self, history_id: int, user_id: int):
+        """1 件分の data_json（詳細を開いたときだけ読む）。"""
+        return self.driver.query_one(self.sql_history_data, (history_id, user_id))
+
+    def get_history_file(self, file_id: int, user_id: int):
+        return self.driver.query_one(self.sql_history_file, (file_id, user_id))
+
+    def insert_history(self, user_id: int, filename: str, data_json: str,
+                       blob_key: str | None = None) -> int:
+        return self.driver.execute(
+            self.sql_insert_history, (user_id, filename, data_json, blob_key)
+        )
+
+    def insert_history_batch(self, rows) -> int:
+        """
+        [(user_id, filename, data_json, blob_key), ...] をまとめて書く。
+        削除済みユーザーの行（他ワーカーのキュー・spool に残っていた分）は捨てる。
+        """
+        live = self.existing_user_ids({row[0] for row in rows})
+        rows = [row for row in rows if row[0] in live]
+        if not rows:
+            return 0
+        return self.driver.execute_many(self.sql_insert_history, rows)
+
+    def history_data_by_ids(self, user_id: int, ids: list) -> list:
+        """指定 id のうち本人の履歴だけを返す（並びは id 昇順）。"""
+        if not ids:
+            return []
+        return self.driver.query_all(
+            self.sql_history_data_by_ids + _in_clause(ids) + " ORDER BY id",
+            (user_id, *ids),
+        )
+
+    def stream_history(self, user_id: int | None = None):
+        """全件（user_id 指定ならそのユーザー分）を id 順に 1 行ずつ返す。"""
+        return self._stream_dump(self.sql_dump_history, user_id)
+
+    # --- estimates ---
+    def stream_estimates(self, user_id: int | None = None):
+        """全件（user_id 指定ならそのユーザー分）を id 順に 1 行ずつ返す。"""
+        return self._stream_dump(self.sql_dump_estimates, user_id)
+
+    def _stream_dump(self, sql: str, user_id):
+        if user_id is None:
+            return self.driver.stream(sql.format(where=""))
+        return self.driver.stream(sql.format(where=" WHERE user_id=%s"), (user_id,))
+
+    def save_estimate(self, user_id: int, estimate_data: str, keep: int,
+                      profile_id: int | None = None, formula_version: int | None = None) -> int:
+        """
+        見積りを追加し、有効なものを新しい keep 件に絞る（1 トランザクション・2 文）。
+        profile_id / formula_version は計算に使った係数プロファイルの版と式の版
+        （既定の係数なら profile_id は None）。ユーザーが削除済みなら何も書かず None。
+        """
+        estimate_id, _ = self.driver.execute_transaction([
+            (self.sql_insert_estimate, (estimate_data, profile_id, formula_version, user_id)),
+            (self.sql_rotate_estimates, (user_id, keep)),
+        ])
+        return estimate_id or None
+
+    def estimate_data_by_ids(self, user_id: int, ids: list) -> list:
+        """指定 id のうち本人の見積りだけを返す（並びは id 昇順）。"""
+        if not ids:
+            return []
+        return self.driver.query_all(
+            self.sql_estimate_data_by_ids + _in_clause(ids) + " ORDER BY id",
+            (user_id, *ids),
+        )
+
+
+_repository = None
+
+
+def get_repository() -> Repository:
+    """初回呼び出し時にスキーマを調べて Repository を組み立てる。"""
+    global _repository
+    if _repository is None:
+        get_users_columns()
+        _repository = Repository(PyMySQLDriver(), get_account_column())
+    return _repository
+
+
+def init_repository(app):
+    """起動時にイントロスペクションと SQL の組み立てを済ませておく。"""
+    if config.DB_SCHEMA_CHECK or config.DB_AUTO_MIGRATE:
+        get_repository()
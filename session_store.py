@@ -0,0 +1,374 @@
+# session_store.py ―― サーバー側セッション（Cookie には不透明な ID だけを載せる）
+#
+# Flask 標準の署名付き Cookie セッションだと dashboard_data（約 50 項目）が
+# 全リクエストのヘッダーに乗り、毎回 JSON 化と HMAC 計算が走る。
+# ここではセッション本体を SQLite か ファイル に置き、Cookie には ID だけを入れる。
+# 各ワーカーはプロセス内 LRU を前段に持ち、保存先の版数（version）が変わって
+# いなければ本体の読み込み・デコードを省く。期限切れはバックグラウンドで掃除する。
+
+import json
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request
+from flask.sessions import SecureCookieSession, SessionInterface, session_json_serializer
+
+import config
+
+_SID_RE = re.compile(r'^[A-Za-z0-9_-]{43}$')
+
+
+def _new_sid() -> str:
+    return secrets.token_urlsafe(32)
+
+
+class ServerSideSession(SecureCookieSession):
+    """保存先の ID を持つセッション。clear() されたら ID を振り直す。"""
+
+    def __init__(self, initial=None, sid: str | None = None, version=None, expires=None):
+        super().__init__(initial)
+        self.new = sid is None
+        self.sid = sid or _new_sid()
+        self.version = version
+        self.expires = expires
+        self.regenerate = False
+
+    def clear(self):
+        # ログイン時などの clear() で ID を変える（セッション固定化対策）
+        super().clear()
+        self.regenerate = True
+
+
+# ----------------- 保存先 ----------------- #
+class SqliteSessionBackend:
+    """SQLite ファイル 1 つにまとめて保存する。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " sid TEXT PRIMARY KEY, data TEXT NOT NULL,"
+            " version INTEGER NOT NULL, expires REAL NOT NULL, user_id INTEGER)"
+        )
+        # user_id 列が無い古いファイルには足す（ユーザー削除時にまとめて消すため）
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
+        if 'user_id' not in columns:
+            conn.execute("ALTER TABLE sessions ADD COLUMN user_id INTEGER")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions (user_id)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def head(self, sid: str):
+        """(version, expires) だけを返す。無ければ None。"""
+        return self._conn().execute(
+            "SELECT version, expires FROM sessions WHERE sid=?", (sid,)
+        ).fetchone()
+
+    def load(self, sid: str):
+        """(data, version, expires) を返す。無ければ None。"""
+        return self._conn().execute(
+            "SELECT data, version, expires FROM sessions WHERE sid=?", (sid,)
+        ).fetchone()
+
+    def save(self, sid: str, data: str, expires: float, user_id=None) -> int:
+        version = time.time_ns()
+        self._conn().execute(
+            "INSERT OR REPLACE INTO sessions (sid, data, version, expires, user_id)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (sid, data, version, expires, user_id),
+        )
+        return version
+
+    def touch(self, sid: str, expires: float):
+        self._conn().execute("UPDATE sessions SET expires=? WHERE sid=?", (expires, sid))
+
+    def delete(self, sid: str):
+        self._conn().execute("DELETE FROM sessions WHERE sid=?", (sid,))
+
+    def delete_user(self, user_id: int) -> int:
+        return self._conn().execute("DELETE FROM sessions WHERE user_id=?", (user_id,)).rowcount
+
+    def sweep(self, now: float) -> int:
+        return self._conn().execute("DELETE FROM sessions WHERE expires<=?", (now,)).rowcount
+
+
+class FileSessionBackend:
+    """
+    1 セッション 1 ファイル（<dir>/<sid 先頭 2 文字>/<sid>）。
+    ファイルの mtime を有効期限として使い、mtime_ns を版数にする。
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, sid: str) -> str:
+        return os.path.join(self.directory, sid[:2], sid)
+
+    def head(self, sid: str):
+        try:
+            st = os.stat(self._path(sid))
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_mtime
+
+    def load(self, sid: str):
+        path = self._path(sid)
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = f.read()
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return data, st.st_mtime_ns, st.st_mtime
+
+    def save(self, sid: str, data: str, expires: float, user_id=None) -> int:
+        path = self._path(sid)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.utime(tmp, (expires, expires))
+        os.replace(tmp, path)
+        return os.stat(path).st_mtime_ns
+
+    def touch(self, sid: str, expires: float):
+        try:
+            os.utime(self._path(sid), (expires, expires))
+        except FileNotFoundError:
+            pass
+
+    def delete(self, sid: str):
+        try:
+            os.remove(self._path(sid))
+        except FileNotFoundError:
+            pass
+
+    def _files(self):
+        for shard in os.scandir(self.directory):
+            if shard.is_dir():
+                yield from os.scandir(shard.path)
+
+    def delete_user(self, user_id: int) -> int:
+        """全ファイルを読んで user_id のものを消す（ユーザー削除のときだけなので走査でよい）。"""
+        removed = 0
+        for entry in self._files():
+            if entry.name.endswith('.tmp'):
+                continue
+            try:
+                with open(entry.path, encoding='utf-8') as f:
+                    data = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            if isinstance(data, dict) and data.get('user_id') == user_id:
+                self.delete(entry.name)
+                removed += 1
+        return removed
+
+    def sweep(self, now: float) -> int:
+        removed = 0
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                try:
+                    if entry.stat().st_mtime <= now:
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+
+# ----------------- SessionInterface ----------------- #
+class ServerSideSessionInterface(SessionInterface):
+    """保存先 + プロセス内 LRU を使う Flask 用 SessionInterface。"""
+
+    serializer = session_json_serializer
+    session_class = ServerSideSession
+
+    def __init__(self, backend, idle_timeout: float, front_maxsize: int = 1024):
+        self.backend = backend
+        self.idle_timeout = idle_timeout
+        self.front_maxsize = front_maxsize
+        self._front: OrderedDict[str, tuple[int, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    # --- プロセス内 LRU ---
+    def _front_get(self, sid: str, version):
+        with self._lock:
+            entry = self._front.get(sid)
+            if entry is None or entry[0] != version:
+                return None
+            self._front.move_to_end(sid)
+            return entry[1]
+
+    def _front_put(self, sid: str, version, data: dict):
+        with self._lock:
+            self._front[sid] = (version, data)
+            self._front.move_to_end(sid)
+            while len(self._front) > self.front_maxsize:
+                self._front.popitem(last=False)
+
+    def _front_drop(self, sid: str):
+        with self._lock:
+            self._front.pop(sid, None)
+
+    def revoke_user(self, user_id: int) -> int:
+        """
+        user_id のセッションをすべて消す（ユーザー削除時）。
+        他のワーカーの LRU は open_session の版の確認で外れる。
+        """
+        removed = self.backend.delete_user(user_id)
+        with self._lock:
+            for sid in [sid for sid, (_, data) in self._front.items()
+                        if data.get('user_id') == user_id]:
+                del self._front[sid]
+        return removed
+
+    # --- Flask から呼ばれる ---
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid or not _SID_RE.match(sid):
+            return self.session_class()
+
+        head = self.backend.head(sid)
+        if head is None or head[1] <= time.time():
+            self._front_drop(sid)
+            return self.session_class()
+        version, expires = head
+
+        data = self._front_get(sid, version)
+        if data is None:
+            row = self.backend.load(sid)
+            if row is None:
+                return self.session_class()
+            payload, version, expires = row
+            try:
+                data = self.serializer.loads(payload)
+            except ValueError:
+                return self.session_class()
+            self._front_put(sid, version, data)
+
+        return self.session_class(dict(data), sid=sid, version=version, expires=expires)
+
+    def save_session(self, app, session, response):
+        name     = self.get_cookie_name(app)
+        domain   = self.get_cookie_domain(app)
+        path     = self.get_cookie_path(app)
+        secure   = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if session.regenerate and not session.new:
+            self.backend.delete(session.sid)
+            self._front_drop(session.sid)
+            session.sid = _new_sid()
+            session.new = True
+
+        if not session:
+            if not session.new:
+                self.backend.delete(session.sid)
+                self._front_drop(session.sid)
+            if session.modified and name in request.cookies:
+                response.delete_cookie(
+                    name, domain=domain, path=path,
+                    secure=secure, samesite=samesite, httponly=httponly,
+                )
+            return
+
+        now = time.time()
+        expires = now + self.idle_timeout
+        if session.modified or session.new:
+            data = dict(session)
+            version = self.backend.save(
+                session.sid, self.serializer.dumps(data), expires, data.get('user_id')
+            )
+            self._front_put(session.sid, version, data)
+        elif session.expires is not None and session.expires - now < self.idle_timeout / 2:
+            # 期限の半分を過ぎたら延長（毎回は書かない）
+            self.backend.touch(session.sid, expires)
+            self._front_drop(session.sid)
+
+        if session.new or (session.permanent and app.config['SESSION_REFRESH_EACH_REQUEST']):
+            response.set_cookie(
+                name, session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=httponly, domain=domain, path=path,
+                secure=secure, samesite=samesite,
+            )
+
+
+_interface = None
+
+
+def revoke_user_sessions(user_id: int) -> int:
+    """
+    user_id のサーバー側セッションを消し、消した件数を返す。
+    Cookie セッション（SESSION_BACKEND=None）は取り消せないので 0。
+    """
+    if _interface is None:
+        return 0
+    return _interface.revoke_user(user_id)
+
+
+# ----------------- 期限切れの掃除 ----------------- #
+def _start_sweeper(backend, interval: float):
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                backend.sweep(time.time())
+            except Exception:   # noqa: BLE001  （掃除の失敗で落とさない）
+                pass
+
+    thread = threading.Thread(target=run, name='session-sweeper', daemon=True)
+    thread.start()
+    return thread
+
+
+def init_session_store(app):
+    """
+    config.SESSION_BACKEND が 'sqlite' / 'file' ならサーバー側セッションに切り替える。
+    None のときは Flask 標準の Cookie セッションのまま。
+    """
+    kind = config.SESSION_BACKEND
+    global _interface
+    if not kind:
+        return None
+
+    path = config.SESSION_PATH
+    if kind == 'sqlite':
+        os.makedirs(app.instance_path, exist_ok=True)
+        backend = SqliteSessionBackend(path or os.path.join(app.instance_path, 'sessions.sqlite3'))
+    elif kind == 'file':
+        backend = FileSessionBackend(path or os.path.join(app.instance_path, 'sessions'))
+    else:
+        raise RuntimeError(f"unknown SESSION_BACKEND: {kind}")
+
+    app.session_interface = _interface = ServerSideSessionInterface(
+        backend,
+        idle_timeout=config.SESSION_IDLE_TIMEOUT,
+        front_maxsize=config.SESSION_FRONT_MAXSIZE,
+    )
+    if config.SESSION_SWEEP_INTERVAL:
+        _start_sweeper(backend, config.SESSION_SWEEP_INTERVAL)
+    return app.session_interface
@@ -6,116 +6,223 @@ document.addEventListener('DOMContentLoaded', function(){
       return x.toString().replace(/\B(?=(\d{3})+(?!\d))/g, ",");
   }
 
+  // 式グラフ（formula_spec.SPEC）。読み込めればプレビューはブラウザだけで計算する
+  const specEl = document.getElementById('formula-spec');
+  const spec = (window.CostFormula && specEl) ? JSON.parse(specEl.textContent) : null;
+
+  // 係数プロファイル（profiles.py）。埋め込まれるのは本人に割り当てた定数と宛名の割り当ての有無だけ
+  // （null は未ログイン）。宛名で決まる係数はサーバーでしか分からないので、そのときは差分再計算に任せる
+  const profilesEl = document.getElementById('coefficient-profiles');
+  const profiles = profilesEl ? JSON.parse(profilesEl.textContent) : null;
+  let localFormula = null;
+
+  function needsServer(values) {
+    const client = String(values.client_name || '').trim().replace(/様$/, '').trim();
+    return client !== '' && (profiles === null || profiles.client_bindings);
+  }
+
+  function formulaFor(values) {
+    if (!spec || needsServer(values)) return null;
+    if (!localFormula) {
+      localFormula = CostFormula.load(profiles && profiles.user
+        ? Object.assign({}, spec, { constants: profiles.user.constants })
+        : spec);
+    }
+    return localFormula;
+  }
+
+  // 差分再計算（/dashboard/calculate/delta）の状態。ブラウザで計算できない入力のときだけ使う
+  let token = null;     // サーバー側に保持された計算状態のトークン
+  let rev = null;       // その版数（ずれたら 409 が返るので全体を送り直す）
+  let lastSent = {};    // サーバーに反映済みの入力値
+  const current = {};   // 受け取った計算結果（差分をマージしていく）
+
+  // FormData と同じ対象（form 属性で紐づく入力も含む）を name -> 値 にする
+  function snapshot() {
+    const values = {};
+    Array.from(form.elements).forEach(el => {
+      if (!el.name) return;
+      if (el.type === 'checkbox') {
+        values[el.name] = el.checked ? (el.value || 'on') : '';
+      } else if (el.type === 'radio') {
+        if (el.checked) values[el.name] = el.value;
+      } else {
+        values[el.name] = el.value;
+      }
+    });
+    return values;
+  }
+
+  function showError() {
+    const msg = "入力項目が不十分です";
+    document.querySelectorAll('[id$="_display"]').forEach(el => {
+      el.innerText = el.innerText.split(':')[0] + ': ' + msg;
+    });
+  }
+
   function updateCalculation(){
-    const formData = new FormData(form);
-    fetch('/dashboard/calculate', {
+    const values = snapshot();
+    const formula = formulaFor(values);
+    if (formula) {
+      try {
+        const data = formula.evaluate(values);
+        token = null;   // サーバー側の状態とはずれたので、次に使うときは全体を送る
+        Object.keys(current).forEach(k => delete current[k]);
+        Object.assign(current, data);
+        render(current);
+        return;
+      } catch (e) {
+        if (e instanceof CostFormula.InputError) {
+          showError();
+          return;
+        }
+        if (!(e instanceof CostFormula.Unsupported)) throw e;
+        // ここでは解釈できない入力なのでサーバーで計算する
+      }
+    }
+    const full = token === null;
+    const body = new FormData();
+    Object.entries(values).forEach(([k, v]) => {
+      if (full || lastSent[k] !== v) body.append(k, v);
+    });
+    if (full) {
+      body.append('_full', '1');
+    } else {
+      body.append('_token', token);
+      body.append('_rev', rev);
+    }
+
+    fetch('/dashboard/calculate/delta', {
       method: 'POST',
-      body: formData
+      body: body
     })
     .then(response => {
+      if (response.status === 409) {
+        // 状態が失効・競合したので、フォーム全体で取り直す
+        token = null;
+        updateCalculation();
+        return null;
+      }
       if (!response.ok) {
         return response.json().then(data => { throw data; });
       }
       return response.json();
     })
-    .then(data => {
-      // 全体結果の更新（カンマ＋円付き）
-      document.getElementById('production_plus_sales_display').innerText =
-          "製造原価＋販売管理費: " + numberWithCommas(data.production_plus_sales) + "円";
-      document.getElementById('profit_amount_display').innerText =
-          "利益額（1個あたり）: " + numberWithCommas(data.profit_amount) + "円";
-      document.getElementById('profit_amount_total_display').innerText =
-          "利益額（合計）: " + numberWithCommas(data.profit_amount_total) + "円";
-      document.getElementById('profit_ratio_display').innerText =
-          "利益率: " + numberWithCommas(data.profit_ratio.toFixed(2)) + "%";
-      document.getElementById('raw_material_cost_ratio_display').innerText =
-          "原材料費原価率: " + numberWithCommas(data.raw_material_cost_ratio.toFixed(2)) + "%";
-      document.getElementById('manufacturing_cost_ratio_display').innerText =
-          "製造販管費原価率: " + numberWithCommas(data.manufacturing_cost_ratio.toFixed(2)) + "%";
-      document.getElementById('sales_admin_cost_ratio_display').innerText =
-          "販売管理費率: " + numberWithCommas(data.sales_admin_cost_ratio.toFixed(2)) + "%";
-      document.getElementById('yield_coefficient_display').innerText =
-          "歩留まり係数: " + numberWithCommas(data.yield_coefficient);
-
-      document.getElementById('manufacturing_cost_total_display').innerText =
-          "製造販管費合計: " + numberWithCommas(data.manufacturing_cost_total) + "円";
-      document.getElementById('sales_admin_cost_total_display').innerText =
-          "販売管理費（1個あたり）: " + numberWithCommas(data.sales_admin_cost_total) + "円";
-
-      // 材料費各項目の更新（カンマ＋円付き）
-      document.getElementById('dohdai_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.dohdai_cost) + "円";
-      document.getElementById('kata_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.kata_cost) + "円";
-      document.getElementById('drying_fuel_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.drying_fuel_cost) + "円";
-      document.getElementById('bisque_fuel_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.bisque_fuel_cost) + "円";
-      document.getElementById('hassui_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.hassui_cost) + "円";
-      document.getElementById('paint_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.paint_cost) + "円";
-      document.getElementById('logo_copper_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.logo_copper_cost) + "円";
-      document.getElementById('glaze_material_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.glaze_material_cost) + "円";
-      document.getElementById('main_firing_gas_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.main_firing_gas_cost) + "円";
-      document.getElementById('transfer_sheet_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.transfer_sheet_cost) + "円";
-
-      // 材料費項目-小計（円付き）
-      document.getElementById('genzairyousyoukei_coefficient_display').innerText =
-          "材料費項目-小計: " + numberWithCommas(data.genzairyousyoukei_coefficient) + "円";
-      document.getElementById('raw_material_cost_total_display').innerText =
-          "原材料費合計: " + numberWithCommas(data.raw_material_cost_total) + "円";
-
-      // 製造販管費各項目の更新（カンマ＋円付き）
-      document.getElementById('chumikin_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.chumikin_cost) + "円";
-      document.getElementById('shiagechin_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.shiagechin_cost) + "円";
-      document.getElementById('haiimonochin_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.haiimonochin_cost) + "円";
-      document.getElementById('seisojiken_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.seisojiken_cost) + "円";
-      document.getElementById('soyakeire_dashi_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.soyakeire_dashi_cost) + "円";
-      document.getElementById('soyakebarimono_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.soyakebarimono_cost) + "円";
-      document.getElementById('doban_hari_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.doban_hari_cost) + "円";
-      document.getElementById('hassui_kakouchin_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.hassui_kakouchin_cost) + "円";
-      document.getElementById('shiyu_hiyou_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.shiyu_hiyou_cost) + "円";
-      document.getElementById('shiyu_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.shiyu_cost) + "円";
-      document.getElementById('kamairi_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.kamairi_cost) + "円";
-      document.getElementById('kamadashi_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.kamadashi_cost) + "円";
-      document.getElementById('hamasuri_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.hamasuri_cost) + "円";
-      document.getElementById('kenpin_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.kenpin_cost) + "円";
-      document.getElementById('print_kakouchin_cost_display').innerText =
-          "合計金額: " + numberWithCommas(data.print_kakouchin_cost) + "円";
-
-      // 製造項目-小計（円付き）
-      document.getElementById('seizousyoukei_coefficient_display').innerText =
-          "製造項目-小計: " + numberWithCommas(data.seizousyoukei_coefficient) + "円";
+    .then(result => {
+      if (!result) return;
+      token = result.token;
+      rev = result.rev;
+      lastSent = values;
+      Object.assign(current, result.changed);
+      render(current);
     })
-    .catch(error => {
-      const msg = "入力項目が不十分です";
-      document.querySelectorAll('[id$="_display"]').forEach(el => {
-        el.innerText = el.innerText.split(':')[0] + ': ' + msg;
-      });
-    });
+    .catch(showError);
+  }
+
+  function render(data){
+    // 全体結果の更新（カンマ＋円付き）
+    document.getElementById('production_plus_sales_display').innerText =
+        "製造原価＋販売管理費: " + numberWithCommas(data.production_plus_sales) + "円";
+    document.getElementById('profit_amount_display').innerText =
+        "利益額（1個あたり）: " + numberWithCommas(data.profit_amount) + "円";
+    document.getElementById('profit_amount_total_display').innerText =
+        "利益額（合計）: " + numberWithCommas(data.profit_amount_total) + "円";
+    document.getElementById('profit_ratio_display').innerText =
+        "利益率: " + numberWithCommas(data.profit_ratio.toFixed(2)) + "%";
+    document.getElementById('raw_material_cost_ratio_display').innerText =
+        "原材料費原価率: " + numberWithCommas(data.raw_material_cost_ratio.toFixed(2)) + "%";
+    document.getElementById('manufacturing_cost_ratio_display').innerText =
+        "製造販管費原価率: " + numberWithCommas(data.manufacturing_cost_ratio.toFixed(2)) + "%";
+    document.getElementById('sales_admin_cost_ratio_display').innerText =
+        "販売管理費率: " + numberWithCommas(data.sales_admin_cost_ratio.toFixed(2)) + "%";
+    document.getElementById('yield_coefficient_display').innerText =
+        "歩留まり係数: " + numberWithCommas(data.yield_coefficient);
+
+    document.getElementById('manufacturing_cost_total_display').innerText =
+        "製造販管費合計: " + numberWithCommas(data.manufacturing_cost_total) + "円";
+    document.getElementById('sales_admin_cost_total_display').innerText =
+        "販売管理費（1個あたり）: " + numberWithCommas(data.sales_admin_cost_total) + "円";
+
+    // 材料費各項目の更新（カンマ＋円付き）
+    document.getElementById('dohdai_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.dohdai_cost) + "円";
+    document.getElementById('kata_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.kata_cost) + "円";
+    document.getElementById('drying_fuel_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.drying_fuel_cost) + "円";
+    document.getElementById('bisque_fuel_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.bisque_fuel_cost) + "円";
+    document.getElementById('hassui_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.hassui_cost) + "円";
+    document.getElementById('paint_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.paint_cost) + "円";
+    document.getElementById('logo_copper_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.logo_copper_cost) + "円";
+    document.getElementById('glaze_material_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.glaze_material_cost) + "円";
+    document.getElementById('main_firing_gas_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.main_firing_gas_cost) + "円";
+    document.getElementById('transfer_sheet_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.transfer_sheet_cost) + "円";
+
+    // 材料費項目-小計（円付き）
+    document.getElementById('genzairyousyoukei_coefficient_display').innerText =
+        "材料費項目-小計: " + numberWithCommas(data.genzairyousyoukei_coefficient) + "円";
+    document.getElementById('raw_material_cost_total_display').innerText =
+        "原材料費合計: " + numberWithCommas(data.raw_material_cost_total) + "円";
+
+    // 製造販管費各項目の更新（カンマ＋円付き）
+    document.getElementById('chumikin_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.chumikin_cost) + "円";
+    document.getElementById('shiagechin_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.shiagechin_cost) + "円";
+    document.getElementById('haiimonochin_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.haiimonochin_cost) + "円";
+    document.getElementById('seisojiken_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.seisojiken_cost) + "円";
+    document.getElementById('soyakeire_dashi_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.soyakeire_dashi_cost) + "円";
+    document.getElementById('soyakebarimono_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.soyakebarimono_cost) + "円";
+    document.getElementById('doban_hari_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.doban_hari_cost) + "円";
+    document.getElementById('hassui_kakouchin_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.hassui_kakouchin_cost) + "円";
+    document.getElementById('shiyu_hiyou_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.shiyu_hiyou_cost) + "円";
+    document.getElementById('shiyu_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.shiyu_cost) + "円";
+    document.getElementById('kamairi_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.kamairi_cost) + "円";
+    document.getElementById('kamadashi_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.kamadashi_cost) + "円";
+    document.getElementById('hamasuri_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.hamasuri_cost) + "円";
+    document.getElementById('kenpin_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.kenpin_cost) + "円";
+    document.getElementById('print_kakouchin_cost_display').innerText =
+        "合計金額: " + numberWithCommas(data.print_kakouchin_cost) + "円";
+
+    // 製造項目-小計（円付き）
+    document.getElementById('seizousyoukei_coefficient_display').innerText =
+        "製造項目-小計: " + numberWithCommas(data.seizousyoukei_coefficient) + "円";
   }
 
-  // 入力項目にイベントリスナーを設定
-  const inputs = form.querySelectorAll('input');
+  // プリセット適用：保存時に計算済みの結果をそのまま表示する（計算リクエストは送らない）
+  // 保存済みの結果は既定の係数なので、プロファイルが効く入力ならここで計算し直す
+  form.addEventListener('preset-applied', e => {
+    token = null;   // 次の変更ではフォーム全体で取り直す
+    if ((profiles && profiles.user) || needsServer(snapshot())) {
+      updateCalculation();
+      return;
+    }
+    Object.keys(current).forEach(k => delete current[k]);
+    Object.assign(current, e.detail.data);
+    render(current);
+  });
+
+  // 入力項目にイベントリスナーを設定（宛名など form 属性で紐づく入力も。宛名で係数が変わる）
+  const inputs = Array.from(form.elements).filter(el => el.tagName === 'INPUT');
   inputs.forEach(input => {
     input.addEventListener('input', updateCalculation);
     input.addEventListener('change', updateCalculation);
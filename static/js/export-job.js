@@ -0,0 +1,58 @@
+/*  static/js/export-job.js
+   ──────────────────────────────────────────────
+   「Excel をダウンロード」をジョブ経由にする。
+   POST /export/jobs（フォームの入力付き）でジョブを登録 → 状態をポーリング →
+   done になったらダウンロード URL へ移動する。
+   JavaScript が無効なときはリンク先（同期版 /export/excel）のまま。
+   ──────────────────────────────────────────────
+*/
+
+document.addEventListener("DOMContentLoaded", () => {
+  const link = document.getElementById("excel-download");
+  if (!link) return;
+
+  const label = link.textContent;
+  let busy = false;
+
+  function finish(message) {
+    busy = false;
+    link.textContent = label;
+    if (message) alert(message);
+  }
+
+  function poll(url, delay) {
+    setTimeout(() => {
+      fetch(url)
+        .then(res => res.json().then(data => ({ ok: res.ok, data })))
+        .then(({ ok, data }) => {
+          if (!ok) throw data;
+          if (data.status === "done") {
+            finish();
+            window.location.href = data.download_url;
+          } else if (data.status === "failed") {
+            finish(data.error);
+          } else {
+            poll(url, Math.min(delay * 1.5, 3000));
+          }
+        })
+        .catch(err => finish((err && err.error) || "Excel の作成状況を取得できませんでした。"));
+    }, delay);
+  }
+
+  link.addEventListener("click", e => {
+    e.preventDefault();
+    if (busy) return;
+    busy = true;
+    link.textContent = "作成中…";
+
+    // 画面の入力を送り、サーバーで計算し直した結果を出力する
+    const form = document.getElementById("calc-form");
+    fetch(link.dataset.jobsUrl, { method: "POST", body: form ? new FormData(form) : undefined })
+      .then(res => res.json().then(data => ({ ok: res.ok, data })))
+      .then(({ ok, data }) => {
+        if (!ok) throw data;
+        poll(data.status_url, 300);
+      })
+      .catch(err => finish((err && err.error) || "Excel の作成を開始できませんでした。"));
+  });
+});
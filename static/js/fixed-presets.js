@@ -1,108 +1,136 @@
 /*  static/js/fixed-presets.js
    ──────────────────────────────────────────────
-   プリセットボタンを動的に生成し、クリックすると
-   入力フォームに一括で値を投入して 'preset‑applied'
-   イベントを発火させる。
+   プリセットボタンをサーバーのカタログ（/presets/）から
+   生成し、クリックすると入力フォームに一括で値を投入して
+   'preset‑applied' イベントを発火させる。
 
-   ・ボタンを増やしたいときは PRESETS 配列に
-     { name: "...", data: { inputName: 値, ... } } を
-     追加するだけで OK
-   ・auto‑calc.js 側で
-       form.addEventListener('preset-applied', updateCalculation);
-     を登録しておくことで、投入直後に再計算される
+   ・プリセットはサーバー側（presets テーブル）で管理する。
+     各プリセットはフォームの全項目（form）と、保存時に
+     計算済みの結果（data）を持つ
+   ・auto‑calc.js 側で 'preset-applied' を受け取り、
+     data をそのまま表示する（計算リクエストは送らない）
+   ・一覧はページ単位で読み込み、「もっと見る」で続きを、
+     検索欄で製品名の部分一致を絞り込む
+   ・python assets.py でサムネイルを作ってあれば、ページに埋め込まれた
+     #static-images の AVIF / WebP を <picture> で使う
    ──────────────────────────────────────────────
 */
 
 document.addEventListener("DOMContentLoaded", () => {
-  /* === ① 固定プリセット定義 ===================================== */
-  const PRESETS = [
-    {
-      name: "MMD六角皿S",
-      img : "img/mmd_s.png",
-      data: {
-        sales_price:           380,
-        order_quantity:        1000,
-        product_weight:        200,
-        mold_unit_price:       2500,
-        mold_count:            2,
-        glaze_cost:            8500,
-        poly_count:            650,
-        kiln_count:            1760,
-        gas_unit_price:        140,
-        loss_defective:        0.1,
-        sawaimono_work:        700,
-        seisojiken_work:       200,
-        soyakeire_work:        250,
-        soyakebarimono_work:   300,
-        hassui_kakouchin_work: 200,
-        shiyu_work:            100,
-        kamairi_time:          8,
-        kamadashi_time:        4,
-        hamasuri_time:         3,
-        kenpin_time:           6
-      }
-    },
-    {
-      name: "ネンド様フェイブ",
-      img : "img/nendosama_fave.png",
-      data: {
-        sales_price:           450,
-        order_quantity:        1000,
-        product_weight:        7,
-        mold_unit_price:       3500,
-        mold_count:            10,
-        glaze_cost:            8500,
-        poly_count:            5000,
-        kiln_count:            52800,
-        gas_unit_price:        140,
-        loss_defective:        0.15,
-        sawaimono_work:        800,
-        seisojiken_work:       200,
-        soyakeire_work:        300,
-        soyakebarimono_work:   400,
-        hassui_kakouchin_work: 200,
-        shiyu_work:            200,
-        kamairi_time:          8,
-        kamadashi_time:        4,
-        hamasuri_time:         3,
-        kenpin_time:           6
-      }
-    }
-  ];
-  /* =============================================================== */
+  const bar    = document.getElementById("preset-bar");
+  const form   = document.getElementById("calc-form");
+  const list   = document.getElementById("preset-list");
+  const more   = document.getElementById("preset-more");
+  const search = document.getElementById("preset-search");
+  if (!bar || !form || !list) return;
+
+  const FALSE_VALUES = ["", "0", "false", "off", "no"];
+  const SEARCH_DELAY_MS = 300;
+
+  /* サムネイル（{元のパス: {src, avif, webp}}、無ければ元画像） */
+  const imagesEl = document.getElementById("static-images");
+  const IMAGES = imagesEl ? JSON.parse(imagesEl.textContent) : {};
 
-  const bar  = document.getElementById("preset-bar");
-  const form = document.getElementById("calc-form");
-  if (!bar || !form) return;
+  const escapeHtml = s => String(s).replace(/[&<>"']/g, c => (
+    { "&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;" }[c]
+  ));
+
+  function presetImage(preset) {
+    if (!preset.img) return "";
+    const alt = escapeHtml(preset.name);
+    const image = IMAGES[preset.img];
+    if (!image) return `<img src="/static/${escapeHtml(preset.img)}" alt="${alt}" loading="lazy">`;
+    const sources = ["avif", "webp"]
+      .filter(fmt => image[fmt])
+      .map(fmt => `<source type="image/${fmt}" srcset="${image[fmt]}" sizes="80px">`)
+      .join("");
+    return `<picture>${sources}<img src="${image.src}" alt="${alt}"
+             width="80" height="80" loading="lazy" decoding="async"></picture>`;
+  }
 
   /* ボタン生成 */
-  PRESETS.forEach(preset => {
+  function addButton(preset) {
     const btn = document.createElement("button");
+    btn.type = "button";
     btn.className = "preset-btn";
     btn.innerHTML = `
-     <img src="/static/${preset.img}" alt="${preset.name}">
-     <span>${preset.name}</span>
+     ${presetImage(preset)}
+     <span>${escapeHtml(preset.name)}</span>
    `;
-    btn.addEventListener("click", () => applyPreset(preset.data));
-    bar.appendChild(btn);
-  });
+    btn.addEventListener("click", () => applyPreset(preset));
+    list.appendChild(btn);
+  }
+
+  /* 一覧の読み込み（after が無ければ最初から） */
+  let query = "";
+  let nextCursor = null;
+  let loading = null;
+
+  function load(after) {
+    const url = new URL(bar.dataset.url, location.href);
+    if (query) url.searchParams.set("q", query);
+    if (after) url.searchParams.set("after", after);
+    const requested = query;
+    loading = fetch(url)
+      .then(res => res.json())
+      .then(page => {
+        if (requested !== query) return;          // 検索語が変わった後の古い応答
+        if (!after) list.innerHTML = "";
+        page.presets.forEach(addButton);
+        nextCursor = page.next;
+        if (more) more.hidden = !nextCursor;
+      })
+      .catch(() => { if (more) more.hidden = !nextCursor; })
+      .finally(() => { loading = null; });
+  }
+
+  if (more) {
+    more.addEventListener("click", () => {
+      if (nextCursor && !loading) load(nextCursor);
+    });
+  }
+  if (search) {
+    let timer = null;
+    search.addEventListener("input", () => {
+      clearTimeout(timer);
+      timer = setTimeout(() => {
+        query = search.value.trim();
+        nextCursor = null;
+        load(null);
+      }, SEARCH_DELAY_MS);
+    });
+  }
+  load(null);
 
-  /* 値の一括投入 → sales_price に input イベントを発火 */
-  function applyPreset(data) {
-    Object.entries(data).forEach(([k, v]) => {
-      const el = form.querySelector(`[name="${k}"]`);
-      if (!el) return;
+  /* 値の一括投入 → 計算済みの結果を 'preset-applied' で渡す */
+  function applyPreset(preset) {
+    Array.from(form.elements).forEach(el => {
+      if (!el.name || !(el.name in preset.form)) return;
+      const v = preset.form[el.name];
       if (el.type === "radio") {
-        form.querySelectorAll(`[name="${k}"]`).forEach(r => {
-          r.checked = Number(r.value) === Number(v);
-        });
+        el.checked = el.value === String(v);
       } else if (el.type === "checkbox") {
-        el.checked = Boolean(v);
+        el.checked = !FALSE_VALUES.includes(String(v).toLowerCase());
       } else {
         el.value = v;
       }
     });
-    const trigger = form.querySelector('[name="sales_price"]');
-    if (trigger) trigger.dispatchEvent(new Event("input", { bubbles: true }));
+
+    if (!preset.data) {
+      // 計算済みの結果が無いプリセットは、従来どおり入力イベントで計算させる
+      const trigger = form.querySelector('[name="sales_price"]');
+      if (trigger) trigger.dispatchEvent(new Event("input", { bubbles: true }));
+      return;
+    }
+    form.dispatchEvent(new CustomEvent("preset-applied", { detail: { data: preset.data } }));
+
+    // Excel 出力用にセッションの結果も差し替える（計算はしない）
+    const body = new FormData();
+    ["client_name", "subject"].forEach(name => {
+      const el = form.elements.namedItem(name);
+      if (el) body.append(name, el.value);
+    });
+    fetch(new URL(`${preset.id}/apply`, new URL(bar.dataset.url, location.href)),
+          { method: "POST", body: body });
   }
 });
@@ -0,0 +1,254 @@
+/*  static/js/formula.js
+   ──────────────────────────────────────────────
+   formula_spec.py の式グラフ（SPEC）をブラウザで評価する。
+   サーバーの CostModel と同じ規則（入力の検証順・左からの加算・偶数丸め）で
+   dashboard_data と同じキー・同じ値を返す。
+     CostFormula.load(spec).evaluate(values)   values はフォームの name -> 値
+   ・入力が不十分（空欄・0 除算・require の条件）なら InputError
+   ・ここでは Python と同じ解釈ができるか判断できない値（"1_000" や全角数字など）は
+     Unsupported。呼び出し側はサーバー（/dashboard/calculate/delta）に計算を任せる
+   Node からも require して使える（tests/test_formula_parity.py の突き合わせ用）。
+   ──────────────────────────────────────────────
+*/
+
+(function (root) {
+  class InputError extends Error {}
+  class Unsupported extends Error {}
+
+  // Python の int() / float() と確実に同じ値になる書き方だけを受け付ける
+  const INT_RE = /^[+-]?\d+$/;
+  const FLOAT_RE = /^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$/;
+
+  function parseNumber(raw, kind) {
+    const text = String(raw === undefined || raw === null ? '' : raw).trim();
+    if (text === '') throw new InputError('入力項目が不十分です');
+    // 小数・指数表記は int() が必ず失敗する
+    if (kind === 'int' && !INT_RE.test(text) && FLOAT_RE.test(text)) {
+      throw new InputError('入力項目が不十分です');
+    }
+    if (!(kind === 'int' ? INT_RE : FLOAT_RE).test(text)) throw new Unsupported(text);
+    const value = Number(text);
+    if (kind === 'int' && !Number.isSafeInteger(value)) throw new Unsupported(text);
+    if (!Number.isFinite(value)) throw new Unsupported(text);
+    return value;
+  }
+
+  const PARSERS = {
+    name: v => String(v || '').trim().replace(/様$/, '').trim(),
+    text: v => String(v || '').trim(),
+    int: v => parseNumber(v, 'int'),
+    float: v => parseNumber(v, 'float'),
+  };
+
+  // float() が必ず失敗する文字列（空白だけ・inf / nan 以外の英字だけ）
+  const NOT_A_NUMBER_RE = /^[A-Za-z]*$/;
+  const SPECIAL_FLOAT_RE = /^(inf|infinity|nan)$/i;
+
+  // safe_float: 空・数値でなければ 0（判断できない書き方はサーバーへ）
+  function safeFloat(raw) {
+    if (raw === undefined || raw === null || raw === '' || raw === ' ') return 0;
+    const text = String(raw).trim();
+    if (FLOAT_RE.test(text)) return Number(text);
+    if (NOT_A_NUMBER_RE.test(text) && !SPECIAL_FLOAT_RE.test(text)) return 0;
+    throw new Unsupported(text);
+  }
+
+  // float(form.get(name, '0') or 0)
+  function price(raw) {
+    if (raw === undefined || raw === null || raw === '') return 0;
+    const text = String(raw).trim();
+    if (FLOAT_RE.test(text)) return Number(text);
+    if (NOT_A_NUMBER_RE.test(text) && !SPECIAL_FLOAT_RE.test(text)) {
+      throw new InputError('単価が数値ではありません');
+    }
+    throw new Unsupported(text);
+  }
+
+  function divide(a, b) {
+    if (b === 0) throw new InputError('0 で割ることはできません');
+    return a / b;
+  }
+
+  // Python の round(x, 0)（偶数丸め）
+  function round0(x) {
+    const r = Math.round(x);
+    return (r - x === 0.5 && r % 2 !== 0) ? r - 1 : r;
+  }
+
+  const ARITH = {
+    '+': (a, b) => a + b,
+    '-': (a, b) => a - b,
+    '*': (a, b) => a * b,
+    '/': divide,
+  };
+  const COMPARE = {
+    '>': (a, b) => a > b, '>=': (a, b) => a >= b, '<': (a, b) => a < b,
+    '<=': (a, b) => a <= b, '==': (a, b) => a === b, '!=': (a, b) => a !== b,
+  };
+
+  // 式 -> (env) => 値。env = {inp, form, st, units, unit}
+  function compile(expr, spec, flags, groups) {
+    if (typeof expr === 'number') return () => expr;
+    const [op, ...args] = expr;
+    const sub = e => compile(e, spec, flags, groups);
+
+    switch (op) {
+      case 'const': {
+        const value = spec.constants[args[0]];
+        return () => value;
+      }
+      case 'in': return env => env.inp[args[0]];
+      case 'field': return env => safeFloat(env.form[args[0]]);
+      case 'price': return env => price(env.form[args[0]]);
+      case 'flag': {
+        const on = flags.has(args[0]);
+        return () => on;
+      }
+      case 'ref': return env => env.st[args[0]];
+      case 'unit': return env => env.unit;
+      case 'units':
+      case 'costs': {
+        const keys = groups[args[0]];
+        // Python の sum() と同じく左から足す
+        return op === 'units'
+          ? env => keys.reduce((total, key) => total + env.units[key], 0)
+          : env => keys.reduce((total, key) => total + env.st[key], 0);
+      }
+      case 'safe_div': {
+        const [a, b] = args.map(sub);
+        return env => {
+          const d = b(env);
+          return d > 0 ? a(env) / d : 0;
+        };
+      }
+      case 'if': {
+        const [c, a, b] = args.map(sub);
+        return env => (c(env) ? a(env) : b(env));
+      }
+      case 'and': {
+        const [a, b] = args.map(sub);
+        return env => a(env) && b(env);
+      }
+      case 'or': {
+        const [a, b] = args.map(sub);
+        return env => a(env) || b(env);
+      }
+      case 'require': {
+        const cond = sub(args[0]);
+        const message = args[1];
+        const body = sub(args[2]);
+        return env => {
+          if (!cond(env)) throw new InputError(message);
+          return body(env);
+        };
+      }
+    }
+    if (ARITH[op]) {
+      const fn = ARITH[op];
+      const parts = args.map(sub);
+      return env => parts.slice(1).reduce((acc, part) => fn(acc, part(env)), parts[0](env));
+    }
+    if (COMPARE[op]) {
+      const fn = COMPARE[op];
+      const [a, b] = args.map(sub);
+      return env => fn(a(env), b(env));
+    }
+    throw new Error('unknown operator: ' + op);
+  }
+
+  // チェック済みフラグの組み合わせごとにコンパイルした手順
+  function build(spec, flags) {
+    const groups = {};
+    const terms = [];
+    const termSection = {};
+    spec.groups.forEach(group => {
+      groups[group.name] = [];
+      group.terms.forEach(term => {
+        termSection[term.key] = group.name;
+        if (!flags.has(term.flag)) return;
+        groups[group.name].push(term.key);
+        terms.push({
+          key: term.key,
+          section: group.name,
+          unit: compile(term.unit, spec, flags, groups),
+          cost: compile(group.cost, spec, flags, groups),
+        });
+      });
+    });
+    const nodes = spec.nodes.map(([name, section, expr]) => ({
+      name, section, fn: compile(expr, spec, flags, groups),
+    }));
+    const enabled = new Set(terms.map(t => t.key));
+    return { terms, nodes, enabled, termSection };
+  }
+
+  function load(spec) {
+    const cache = new Map();
+    const flagNames = [];
+    spec.groups.forEach(g => g.terms.forEach(t => flagNames.push(t.flag)));
+    spec.nodes.forEach(([, , expr]) => {
+      (function walk(e) {
+        if (!Array.isArray(e)) return;
+        if (e[0] === 'flag') flagNames.push(e[1]);
+        else e.slice(1).forEach(walk);
+      })(expr);
+    });
+
+    function program(values) {
+      const flags = new Set(flagNames.filter(name => values[name]));
+      const key = Array.from(flags).sort().join(',');
+      if (!cache.has(key)) cache.set(key, build(spec, flags));
+      return cache.get(key);
+    }
+
+    function evaluate(values) {
+      const inp = {};
+      spec.inputs.forEach(([name, kind]) => {
+        inp[name] = PARSERS[kind](values[name]);
+      });
+      const prog = program(values);
+      const env = { inp, form: values, st: {}, units: {}, unit: 0 };
+
+      // 単価（require の検査もここで、項目の並び順に行う）
+      prog.terms.forEach(term => { env.units[term.key] = term.unit(env); });
+      // セクション順に 項目の金額 → ノード
+      spec.sections.forEach(section => {
+        prog.terms.forEach(term => {
+          if (term.section !== section) return;
+          env.unit = env.units[term.key];
+          env.st[term.key] = term.cost(env);
+        });
+        prog.nodes.forEach(node => {
+          if (node.section === section) env.st[node.name] = node.fn(env);
+        });
+      });
+
+      const data = {};
+      spec.outputs.forEach(key => {
+        let value;
+        if (key in prog.termSection) {
+          value = prog.enabled.has(key) ? env.st[key] : 0;
+        } else if (key in env.st) {
+          value = env.st[key];
+        } else {
+          value = inp[key];
+        }
+        if (typeof value === 'number') {
+          if (!Number.isFinite(value)) throw new Unsupported(key);
+          value = round0(value);
+        }
+        data[key] = value;
+      });
+      return data;
+    }
+
+    return { version: spec.version, evaluate };
+  }
+
+  const api = { load, InputError, Unsupported };
+  if (typeof module !== 'undefined' && module.exports) {
+    module.exports = api;
+  } else {
+    root.CostFormula = api;
+  }
+})(this);
@@ -0,0 +1,30 @@
+/*  static/js/history.js
+   ──────────────────────────────────────────────
+   履歴一覧の「詳細」を開いたときだけ、その 1 件の
+   入力・計算結果を /estimate/history/<id> から読み込む。
+   ──────────────────────────────────────────────
+*/
+
+document.addEventListener("DOMContentLoaded", () => {
+  document.querySelectorAll("details.history-detail").forEach(details => {
+    details.addEventListener("toggle", () => {
+      if (!details.open || details.dataset.loaded) return;
+      details.dataset.loaded = "1";
+
+      const table = details.querySelector("table");
+      fetch(details.dataset.url)
+        .then(res => res.json())
+        .then(data => {
+          Object.entries(data).forEach(([key, value]) => {
+            const tr = table.insertRow();
+            tr.insertCell().textContent = key;
+            tr.insertCell().textContent = value;
+          });
+        })
+        .catch(() => {
+          delete details.dataset.loaded;
+          table.insertRow().insertCell().textContent = "読み込めませんでした。";
+        });
+    });
+  });
+});
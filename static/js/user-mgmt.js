@@ -0,0 +1,84 @@
+/*  static/js/user-mgmt.js
+   ──────────────────────────────────────────────
+   ユーザー一覧の「さらに表示」で、次のページを
+   /user_mgmt/?format=json から読み込んで表に追加する。
+   （JS が無ければリンクのまま次ページへ移動する）
+   ユーザー削除の直後は、関連データ削除ジョブの進み具合を表示する。
+   ──────────────────────────────────────────────
+*/
+
+const PURGE_POLL_MS = 1000;
+
+const watchPurge = status => {
+  const poll = () => {
+    fetch(status.dataset.url)
+      .then(res => res.json())
+      .then(job => {
+        const p = job.progress || {};
+        const counts = `履歴 ${p.excel_history || 0} 件・見積り ${p.estimates || 0} 件・ファイル ${p.files || 0} 件`;
+        if (job.status === "done") {
+          status.textContent = `関連データの削除が完了しました（${counts}）。`;
+        } else if (job.status === "failed" || job.error) {
+          status.textContent = job.error || "関連データの削除に失敗しました。";
+        } else {
+          status.textContent = `関連データを削除しています…（${counts}）`;
+          setTimeout(poll, PURGE_POLL_MS);
+        }
+      })
+      .catch(() => setTimeout(poll, PURGE_POLL_MS * 5));
+  };
+  poll();
+};
+
+document.addEventListener("DOMContentLoaded", () => {
+  const status = document.getElementById("purge-status");
+  if (status) watchPurge(status);
+
+  const more = document.getElementById("user-more");
+  const table = document.getElementById("user-table");
+  if (!more || !table) return;
+
+  const deleteUrl = id => table.dataset.deleteUrl.replace(/\/0(?=\?|$)/, "/" + id);
+
+  const addRow = user => {
+    const tr = table.insertRow();
+    tr.insertCell().textContent = user.id;
+    tr.insertCell().textContent = user.account_name;
+    const form = document.createElement("form");
+    form.method = "post";
+    form.action = deleteUrl(user.id);
+    form.style.display = "inline";
+    const button = document.createElement("button");
+    button.type = "submit";
+    button.textContent = "削除";
+    button.addEventListener("click", e => {
+      if (!confirm("削除しますか？")) e.preventDefault();
+    });
+    form.appendChild(button);
+    tr.insertCell().appendChild(form);
+  };
+
+  more.addEventListener("click", e => {
+    e.preventDefault();
+    if (more.dataset.loading) return;
+    more.dataset.loading = "1";
+
+    const url = new URL(more.dataset.jsonUrl, location.href);
+    url.searchParams.set("after", more.dataset.next);
+    fetch(url)
+      .then(res => res.json())
+      .then(data => {
+        data.users.forEach(addRow);
+        if (data.next) {
+          more.dataset.next = data.next;
+          const href = new URL(more.href, location.href);
+          href.searchParams.set("after", data.next);
+          more.href = href;
+        } else {
+          more.remove();
+        }
+      })
+      .catch(() => { more.textContent = "読み込めませんでした。もう一度"; })
+      .finally(() => { delete more.dataset.loading; });
+  });
+});
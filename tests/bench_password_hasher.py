@@ -0,0 +1,90 @@
+# tests/bench_password_hasher.py ―― ログインのスループット計測（pytest では集めない）
+#
+# /login を Flask のテストクライアントで叩くので、試行制限（login_throttle）・
+# users の検索（find_user_for_login）・ハッシュ計算（hasher）・セッション保存まで本番と同じ経路を通る。
+# config の DB に計測用のアカウントを 1 つ作り、終わったら消す。
+#
+#   python tests/bench_password_hasher.py [クライアント数] [ログイン回数]
+
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app  # noqa: E402
+from password_hasher import hasher  # noqa: E402
+from repository import get_repository  # noqa: E402
+
+
+def benchmark(clients: int = 32, logins: int = 200) -> dict:
+    """
+    clients 個のスレッドから合計 logins 回 /login したときのスループットと応答の内訳、
+    そのあいだ他のリクエスト（GET /）にかかった時間を返す。
+    """
+    account_name = f"bench-{secrets.token_hex(4)}"
+    password = 'benchmark-password'
+    per_client = max(1, logins // clients)
+    repo = get_repository()
+    user_id = repo.create_user(account_name, hasher.hash(password))
+
+    statuses, login_ms = Counter(), []
+    lock = threading.Lock()
+
+    def login():
+        client = app.test_client()
+        for _ in range(per_client):
+            started = time.perf_counter()
+            rv = client.post('/login', data={'account_name': account_name, 'password': password})
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                statuses[rv.status_code] += 1
+                login_ms.append(elapsed)
+
+    def probe(stop, samples):
+        # ログイン以外のリクエストの応答時間
+        client = app.test_client()
+        while not stop.is_set():
+            started = time.perf_counter()
+            client.get('/')
+            samples.append((time.perf_counter() - started) * 1000)
+            time.sleep(0.01)
+
+    stop, samples = threading.Event(), []
+    prober = threading.Thread(target=probe, args=(stop, samples))
+    threads = [threading.Thread(target=login) for _ in range(clients)]
+    try:
+        started = time.perf_counter()
+        prober.start()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        stop.set()
+        prober.join()
+        repo.delete_user(user_id)
+
+    samples.sort()
+    login_ms.sort()
+    return {
+        "seconds": round(elapsed, 3),
+        "logins_per_sec": round(per_client * clients / elapsed, 1),
+        # 302: 成功 / 503: 混雑（枠が空かない・時間切れ） / 429: 試行制限
+        "status": dict(sorted(statuses.items())),
+        "login_p50_ms": round(login_ms[len(login_ms) // 2], 3),
+        "login_p95_ms": round(login_ms[int(len(login_ms) * 0.95)], 3),
+        "other_request_p50_ms": round(samples[len(samples) // 2], 3) if samples else None,
+        "other_request_p95_ms": round(samples[int(len(samples) * 0.95)], 3) if samples else None,
+        "hasher_stats": hasher.stats(),
+    }
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:3]]
+    print(json.dumps(benchmark(*args), indent=2))
@@ -0,0 +1,6 @@
+# tests/conftest.py ―― リポジトリの直下（app.py などのあるところ）を import できるようにする
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
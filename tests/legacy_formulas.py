@@ -0,0 +1,387 @@
+# tests/legacy_formulas.py ―― 式グラフ（formula_spec.SPEC）導入前の calculate_* 一式
+#
+# アプリからはもう使わない。tests/test_formula_parity.py が期待値（オラクル）として使うためだけに残す。
+# 係数は既定値（formula_spec.CONSTANTS）固定。
+
+from formula_spec import CONSTANTS, safe_div, safe_float
+
+######################################
+# 定数・係数（値は formula_spec.SPEC にある）
+######################################
+DOHDAI_COEFFICIENT       = CONSTANTS["DOHDAI_COEFFICIENT"]
+DRYING_FUEL_COEFFICIENT  = CONSTANTS["DRYING_FUEL_COEFFICIENT"]
+BISQUE_FUEL_COEFFICIENT  = CONSTANTS["BISQUE_FUEL_COEFFICIENT"]
+HASSUI_COEFFICIENT       = CONSTANTS["HASSUI_COEFFICIENT"]
+PAINT_COEFFICIENT        = CONSTANTS["PAINT_COEFFICIENT"]
+FIRING_GAS_CONSTANT      = CONSTANTS["FIRING_GAS_CONSTANT"]
+MOLD_DIVISOR             = CONSTANTS["MOLD_DIVISOR"]
+HOURLY_WAGE              = CONSTANTS["HOURLY_WAGE"]
+NOUHIN_JINKENHI_CHARGE   = CONSTANTS["NOUHIN_JINKENHI_CHARGE"]
+GASOLINE_CHARGE          = CONSTANTS["GASOLINE_CHARGE"]
+
+
+def round_values_in_dict(data, digits=0):
+    for key, val in data.items():
+        if isinstance(val, float):
+            data[key] = round(val, digits)
+    return data
+
+def parse_input_data(req):
+    try:
+        client_name     = req.get('client_name', '').strip()
+        # Excel テンプレートに既に「様」があるため、入力で重複しないよう末尾の「様」を除外
+        client_name     = client_name.removesuffix('様').strip()
+        subject         = req.get('subject', '').strip()
+        sales_price     = float(req.get('sales_price', '').strip())
+        order_quantity  = int(req.get('order_quantity', '').strip())
+        product_weight  = float(req.get('product_weight', '').strip())
+        mold_unit_price = float(req.get('mold_unit_price', '').strip())
+        mold_count      = int(req.get('mold_count', '').strip())
+        glaze_cost      = float(req.get('glaze_cost', '').strip())
+        poly_count      = int(req.get('poly_count', '').strip())
+        kiln_count      = int(req.get('kiln_count', '').strip())
+        gas_unit_price  = float(req.get('gas_unit_price', '').strip())
+        loss_defective  = float(req.get('loss_defective', '').strip())
+    except Exception as e:
+        raise ValueError("入力項目が不十分です: " + str(e))
+
+    return {
+        "client_name": client_name,
+        "subject": subject,
+        "sales_price": sales_price,
+        "order_quantity": order_quantity,
+        "product_weight": product_weight,
+        "mold_unit_price": mold_unit_price,
+        "mold_count": mold_count,
+        "glaze_cost": glaze_cost,
+        "poly_count": poly_count,
+        "kiln_count": kiln_count,
+        "gas_unit_price": gas_unit_price,
+        "loss_defective": loss_defective,
+    }
+
+def calculate_raw_material_costs(inp, form):
+    include_dohdai          = form.get('include_dohdai')
+    include_kata            = form.get('include_kata')
+    include_drying_fuel     = form.get('include_drying_fuel')
+    include_bisque_fuel     = form.get('include_bisque_fuel')
+    include_hassui          = form.get('include_hassui')
+    include_paint           = form.get('include_paint')
+    include_logo_copper     = form.get('include_logo_copper')
+    include_glaze_material  = form.get('include_glaze_material')
+    include_main_firing_gas = form.get('include_main_firing_gas')
+    include_transfer_sheet  = form.get('include_transfer_sheet')
+
+    sales_price     = inp["sales_price"]
+    order_quantity  = inp["order_quantity"]
+    product_weight  = inp["product_weight"]
+    mold_unit_price = inp["mold_unit_price"]
+    mold_count      = inp["mold_count"]
+    glaze_cost      = inp["glaze_cost"]
+    poly_count      = inp["poly_count"]
+    kiln_count      = inp["kiln_count"]
+    gas_unit_price  = inp["gas_unit_price"]
+
+    dohdai_cost           = 0
+    kata_cost             = 0
+    drying_fuel_cost      = 0
+    bisque_fuel_cost      = 0
+    hassui_cost           = 0
+    paint_cost            = 0
+    logo_copper_cost      = 0
+    glaze_material_cost   = 0
+    main_firing_gas_cost  = 0
+    transfer_sheet_cost   = 0
+
+    copper_unit_price         = 0
+    transfer_sheet_unit_price = 0
+
+    if include_dohdai:
+        dohdai_cost = product_weight * DOHDAI_COEFFICIENT * order_quantity
+
+    if include_kata:
+        if mold_count <= 0:
+            raise ValueError("使用型の数出し数が0以下です。")
+        kata_cost = (mold_unit_price / mold_count) / MOLD_DIVISOR * order_quantity
+
+    if include_drying_fuel:
+        drying_fuel_cost = product_weight * DRYING_FUEL_COEFFICIENT * order_quantity
+
+    if include_bisque_fuel:
+        bisque_fuel_cost = product_weight * BISQUE_FUEL_COEFFICIENT * order_quantity
+
+    if include_hassui:
+        hassui_cost = product_weight * HASSUI_COEFFICIENT * order_quantity
+
+    if include_paint:
+        paint_cost = product_weight * PAINT_COEFFICIENT * order_quantity
+
+    if include_logo_copper:
+        copper_unit_price = float(form.get('copper_unit_price', '0') or 0)
+        logo_copper_cost  = copper_unit_price * order_quantity
+
+    if include_glaze_material:
+        if poly_count <= 0:
+            raise ValueError("ポリの枚数が0以下です。")
+        glaze_material_cost = (glaze_cost / poly_count) * order_quantity
+
+    if include_main_firing_gas:
+        if kiln_count <= 0:
+            raise ValueError("窯入数が0以下です。")
+        main_firing_gas_cost = (gas_unit_price * FIRING_GAS_CONSTANT) / kiln_count * order_quantity
+
+    if include_transfer_sheet:
+        transfer_sheet_unit_price = float(form.get('transfer_sheet_unit_price', '0') or 0)
+        transfer_sheet_cost       = transfer_sheet_unit_price * order_quantity
+
+    genzairyousyoukei_coefficient = (
+    (product_weight * DOHDAI_COEFFICIENT if include_dohdai else 0)
+    + ((mold_unit_price / mold_count / MOLD_DIVISOR) if include_kata and mold_count > 0 else 0)
+    + (product_weight * DRYING_FUEL_COEFFICIENT if include_drying_fuel else 0)
+    + (product_weight * BISQUE_FUEL_COEFFICIENT if include_bisque_fuel else 0)
+    + (product_weight * HASSUI_COEFFICIENT if include_hassui else 0)
+    + (product_weight * PAINT_COEFFICIENT if include_paint else 0)
+    + (copper_unit_price if include_logo_copper else 0)
+    + ((glaze_cost / poly_count) if include_glaze_material and poly_count > 0 else 0)
+    + ((gas_unit_price * FIRING_GAS_CONSTANT / kiln_count) if include_main_firing_gas and kiln_count > 0 else 0)
+    + (transfer_sheet_unit_price if include_transfer_sheet else 0)
+)
+
+    raw_material_cost_total = (
+        dohdai_cost + kata_cost + drying_fuel_cost + bisque_fuel_cost
+        + hassui_cost + paint_cost + logo_copper_cost
+        + glaze_material_cost + main_firing_gas_cost + transfer_sheet_cost
+    )
+
+    raw_material_cost_ratio = (
+    genzairyousyoukei_coefficient * (1 + inp["loss_defective"])
+) / sales_price * 100
+    # 1＋ロスの意味は、「ロス分も含めた実際にかかる材料費」
+
+    
+    return {
+        "dohdai_cost": dohdai_cost,
+        "kata_cost": kata_cost,
+        "drying_fuel_cost": drying_fuel_cost,
+        "bisque_fuel_cost": bisque_fuel_cost,
+        "hassui_cost": hassui_cost,
+        "paint_cost": paint_cost,
+        "logo_copper_cost": logo_copper_cost,
+        "glaze_material_cost": glaze_material_cost,
+        "main_firing_gas_cost": main_firing_gas_cost,
+        "transfer_sheet_cost": transfer_sheet_cost,
+
+        "raw_material_cost_total": raw_material_cost_total,
+        "raw_material_cost_ratio": raw_material_cost_ratio,
+        "genzairyousyoukei_coefficient": genzairyousyoukei_coefficient
+    }
+
+def calculate_manufacturing_costs(inp, form, raw_material_cost_total):
+    include_chumikin         = form.get('include_chumikin')
+    include_shiagechin       = form.get('include_shiagechin')
+    include_haiimonochin     = form.get('include_haiimonochin')
+    include_seisojiken       = form.get('include_seisojiken')
+    include_soyakeire_dashi  = form.get('include_soyakeire_dashi')
+    include_soyakebarimono   = form.get('include_soyakebarimono')
+    include_doban_hari       = form.get('include_doban_hari')
+    include_hassui_kakouchin = form.get('include_hassui_kakouchin')
+    include_shiyu_hiyou      = form.get('include_shiyu_hiyou')
+    include_shiyu_cost       = form.get('include_shiyu_cost')
+    include_kamairi          = form.get('include_kamairi')
+    include_kamadashi        = form.get('include_kamadashi')
+    include_hamasuri         = form.get('include_hamasuri')
+    include_kenpin           = form.get('include_kenpin')
+    include_print_kakouchin  = form.get('include_print_kakouchin')
+
+    order_quantity  = inp["order_quantity"]
+    mold_unit_price = inp["mold_unit_price"]
+    kiln_count      = inp["kiln_count"]
+    loss_defective  = inp["loss_defective"]
+    sales_price     = inp["sales_price"]
+
+    chumikin_cost  = safe_float(form.get('chumikin_unit'))  * order_quantity if include_chumikin  else 0
+    shiagechin_cost= safe_float(form.get('shiagechin_unit'))* order_quantity if include_shiagechin else 0
+
+    haiimonochin_cost   = safe_div(mold_unit_price, safe_float(form.get('sawaimono_work')))       * order_quantity if include_haiimonochin else 0
+    seisojiken_cost     = safe_div(HOURLY_WAGE,   safe_float(form.get('seisojiken_work')))        * order_quantity if include_seisojiken else 0
+    soyakeire_dashi_cost= safe_div(HOURLY_WAGE,   safe_float(form.get('soyakeire_work')))         * order_quantity if include_soyakeire_dashi else 0
+    soyakebarimono_cost = safe_div(HOURLY_WAGE,   safe_float(form.get('soyakebarimono_work')))    * order_quantity if include_soyakebarimono else 0
+
+    doban_hari_cost       = safe_float(form.get('doban_hari_unit'))       * order_quantity if include_doban_hari       else 0
+    hassui_kakouchin_cost = safe_div(HOURLY_WAGE, safe_float(form.get('hassui_kakouchin_work')))  * order_quantity if include_hassui_kakouchin else 0
+    shiyu_hiyou_cost = safe_float(form.get('shiyu_hiyou_unit')) * order_quantity if include_shiyu_hiyou else 0
+    shiyu_cost          = safe_div(HOURLY_WAGE,   safe_float(form.get('shiyu_work')))             * order_quantity if include_shiyu_cost else 0
+    
+    kamairi_cost  = (HOURLY_WAGE * safe_float(form.get('kamairi_time'))   / kiln_count * order_quantity) if include_kamairi  else 0
+    kamadashi_cost= (HOURLY_WAGE * safe_float(form.get('kamadashi_time')) / kiln_count * order_quantity) if include_kamadashi else 0
+    hamasuri_cost = (HOURLY_WAGE * safe_float(form.get('hamasuri_time'))  / kiln_count * order_quantity) if include_hamasuri else 0
+    kenpin_cost   = (HOURLY_WAGE * safe_float(form.get('kenpin_time'))    / kiln_count * order_quantity) if include_kenpin   else 0
+
+    print_kakouchin_cost = safe_float(form.get('print_kakouchin_unit')) * order_quantity if include_print_kakouchin else 0
+
+    seizousyoukei_total = (
+        chumikin_cost + shiagechin_cost + haiimonochin_cost + seisojiken_cost +
+        soyakeire_dashi_cost + soyakebarimono_cost + doban_hari_cost +
+        hassui_kakouchin_cost + shiyu_hiyou_cost + shiyu_cost +
+        kamairi_cost + kamadashi_cost + hamasuri_cost +
+        kenpin_cost + print_kakouchin_cost
+    )
+
+    seizousyoukei_coefficient = seizousyoukei_total / order_quantity if order_quantity else 0
+    yield_coefficient         = (seizousyoukei_coefficient + raw_material_cost_total / order_quantity) * loss_defective
+    manufacturing_cost_total  = seizousyoukei_total + (yield_coefficient * order_quantity)
+    manufacturing_cost_ratio  = ((seizousyoukei_coefficient + yield_coefficient) / sales_price * 100) if sales_price else 0
+
+    return {
+        "chumikin_cost": chumikin_cost,
+        "shiagechin_cost": shiagechin_cost,
+        "haiimonochin_cost": haiimonochin_cost,
+        "seisojiken_cost": seisojiken_cost,
+        "soyakeire_dashi_cost": soyakeire_dashi_cost,
+        "soyakebarimono_cost": soyakebarimono_cost,
+        "doban_hari_cost": doban_hari_cost,
+        "hassui_kakouchin_cost": hassui_kakouchin_cost,
+        "shiyu_hiyou_cost": shiyu_hiyou_cost,
+        "shiyu_cost": shiyu_cost,
+        "kamairi_cost": kamairi_cost,
+        "kamadashi_cost": kamadashi_cost,
+        "hamasuri_cost": hamasuri_cost,
+        "kenpin_cost": kenpin_cost,
+        "print_kakouchin_cost": print_kakouchin_cost,
+        "seizousyoukei_coefficient": seizousyoukei_coefficient,
+        "yield_coefficient": yield_coefficient,
+        "manufacturing_cost_total": manufacturing_cost_total,
+        "manufacturing_cost_ratio": manufacturing_cost_ratio,
+    }
+
+def calculate_sales_admin_cost(form, order_quantity, total_cost):
+    include_nouhin_jinkenhi = form.get('include_nouhin_jinkenhi')
+    include_gasoline        = form.get('include_gasoline')
+
+    total_sales_admin_cost = 0
+    if include_nouhin_jinkenhi:
+        total_sales_admin_cost += NOUHIN_JINKENHI_CHARGE
+    if include_gasoline:
+        total_sales_admin_cost += GASOLINE_CHARGE
+
+    sales_admin_cost_total = total_sales_admin_cost / order_quantity if order_quantity else 0
+
+    sales_price = float(form.get('sales_price', 0))
+    order_quantity = int(form.get('order_quantity', 1))
+
+    include_nouhin_jinkenhi_value = NOUHIN_JINKENHI_CHARGE if include_nouhin_jinkenhi else 0
+    include_gasoline_value = GASOLINE_CHARGE if include_gasoline else 0
+
+    sales_admin_cost_ratio = (
+        (include_nouhin_jinkenhi_value + include_gasoline_value) / (sales_price * order_quantity) * 100
+    ) if sales_price > 0 and order_quantity > 0 else 0
+
+    return sales_admin_cost_total, sales_admin_cost_ratio
+
+
+def assemble_dashboard_data(
+    inp,
+    raw_dict,
+    man_dict,
+    sales_admin_cost_total,
+    sales_admin_cost_ratio
+):
+    client_name     = inp.get("client_name", "")
+    subject         = inp.get("subject", "")
+    sales_price     = inp["sales_price"]
+    order_quantity  = inp["order_quantity"]
+    product_weight  = inp["product_weight"]
+    mold_unit_price = inp["mold_unit_price"]
+    mold_count      = inp["mold_count"]
+    kiln_count      = inp["kiln_count"]
+    gas_unit_price  = inp["gas_unit_price"]
+    loss_defective  = inp["loss_defective"]
+    poly_count      = inp["poly_count"]
+    glaze_cost      = inp["glaze_cost"]
+
+    total_cost = (
+        sales_price + order_quantity + product_weight +
+        mold_unit_price + mold_count + kiln_count +
+        gas_unit_price + loss_defective
+    )
+
+    raw_material_cost_total = raw_dict.get("raw_material_cost_total", 0)
+    raw_material_cost_ratio = raw_dict.get("raw_material_cost_ratio", 0)
+    manufacturing_cost_total = man_dict.get("manufacturing_cost_total", 0)
+    yield_coefficient = man_dict.get("yield_coefficient", 0)
+
+    production_cost_total = raw_material_cost_total + manufacturing_cost_total
+    production_plus_sales = production_cost_total + sales_admin_cost_total
+
+    profit_amount = sales_price - (
+    raw_dict.get("genzairyousyoukei_coefficient", 0) +
+    man_dict.get("seizousyoukei_coefficient", 0) +
+    man_dict.get("yield_coefficient", 0) +
+    sales_admin_cost_total
+)
+
+    
+    profit_amount_total = profit_amount * order_quantity
+    profit_ratio = (profit_amount / sales_price) * 100 if sales_price else 0
+
+    manufacturing_cost_ratio = man_dict.get("manufacturing_cost_ratio", 0)
+
+    return {
+        "client_name": client_name,
+        "subject": subject,
+        "sales_price": sales_price,
+        "order_quantity": order_quantity,
+        "product_weight": product_weight,
+        "mold_unit_price": mold_unit_price,
+        "mold_count": mold_count,
+        "kiln_count": kiln_count,
+        "gas_unit_price": gas_unit_price,
+        "loss_defective": loss_defective,
+        "poly_count": poly_count,
+        "glaze_cost": glaze_cost,
+        "total_cost": total_cost,
+
+        "raw_material_cost_total": raw_material_cost_total,
+        "raw_material_cost_ratio": raw_material_cost_ratio,
+        "dohdai_cost": raw_dict.get("dohdai_cost", 0),
+        "kata_cost": raw_dict.get("kata_cost", 0),
+        "drying_fuel_cost": raw_dict.get("drying_fuel_cost", 0),
+        "bisque_fuel_cost": raw_dict.get("bisque_fuel_cost", 0),
+        "hassui_cost": raw_dict.get("hassui_cost", 0),
+        "paint_cost": raw_dict.get("paint_cost", 0),
+        "logo_copper_cost": raw_dict.get("logo_copper_cost", 0),
+        "glaze_material_cost": raw_dict.get("glaze_material_cost", 0),
+        "main_firing_gas_cost": raw_dict.get("main_firing_gas_cost", 0),
+        "transfer_sheet_cost": raw_dict.get("transfer_sheet_cost", 0),
+        "genzairyousyoukei_coefficient": raw_dict.get("genzairyousyoukei_coefficient", 0),
+
+        "chumikin_cost": man_dict.get("chumikin_cost", 0),
+        "shiagechin_cost": man_dict.get("shiagechin_cost", 0),
+        "haiimonochin_cost": man_dict.get("haiimonochin_cost", 0),
+        "seisojiken_cost": man_dict.get("seisojiken_cost", 0),
+        "soyakeire_dashi_cost": man_dict.get("soyakeire_dashi_cost", 0),
+        "soyakebarimono_cost": man_dict.get("soyakebarimono_cost", 0),
+        "doban_hari_cost": man_dict.get("doban_hari_cost", 0),
+        "hassui_kakouchin_cost": man_dict.get("hassui_kakouchin_cost", 0),
+        "shiyu_hiyou_cost": man_dict.get("shiyu_hiyou_cost", 0),
+        "shiyu_cost": man_dict.get("shiyu_cost", 0),
+        "kamairi_cost": man_dict.get("kamairi_cost", 0),
+        "kamadashi_cost": man_dict.get("kamadashi_cost", 0),
+        "hamasuri_cost": man_dict.get("hamasuri_cost", 0),
+        "kenpin_cost": man_dict.get("kenpin_cost", 0),
+        "print_kakouchin_cost": man_dict.get("print_kakouchin_cost", 0),
+        "yield_coefficient": yield_coefficient,
+        "manufacturing_cost_total": manufacturing_cost_total,
+        "manufacturing_cost_ratio": manufacturing_cost_ratio,
+        "seizousyoukei_coefficient": man_dict.get("seizousyoukei_coefficient", 0),
+
+        "sales_admin_cost_total": sales_admin_cost_total,
+        "sales_admin_cost_ratio": sales_admin_cost_ratio,
+
+        "production_cost_total": production_cost_total,
+        "production_plus_sales": production_plus_sales,
+        "profit_amount": profit_amount,
+        "profit_amount_total": profit_amount_total,
+        "profit_ratio": profit_ratio
+    }
+
@@ -0,0 +1,270 @@
+# tests/test_formula_parity.py ―― 式グラフ（formula_spec.SPEC）の突き合わせ
+#
+# 旧来の calculate_* 一式（tests/legacy_formulas.py）を期待値にして
+#   ・コンパイル済みの SPEC（_compute_dashboard_data）
+#   ・バッチ計算（compute_dashboard_batch, VectorFormula）
+#   ・static/js/formula.js（node が無ければ skip）
+# を突き合わせる。係数プロファイルと what-if スイープはスカラー版と突き合わせる。入力は種を固定した乱数と、境界値（0 除算・空欄・丸めの .5）の固定の入力。
+# 値は型（int / float）まで、エラーは例外の型と文言まで一致を確認する。
+#
+#   python -m pytest tests/test_formula_parity.py
+
+import json
+import os
+import random
+import shutil
+import subprocess
+
+import pytest
+
+import legacy_formulas as legacy
+from blueprints import dashboard as d
+from formula_spec import SPEC, _references
+from profiles import Profile
+
+SEEDS = (0, 1, 2)
+COUNT = 2000
+
+NODE_RUNNER = """
+const CostFormula = require(process.argv[1]);
+const input = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+const formula = CostFormula.load(input.spec);
+const out = input.forms.map(values => {
+  try {
+    return {data: formula.evaluate(values)};
+  } catch (e) {
+    if (e instanceof CostFormula.Unsupported) return {unsupported: e.message};
+    if (e instanceof CostFormula.InputError) return {error: e.message};
+    throw e;
+  }
+});
+process.stdout.write(JSON.stringify(out));
+"""
+FORMULA_JS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'js', 'formula.js'
+)
+
+
+# ----------------- 入力 ----------------- #
+def _form_fields() -> list:
+    names = set()
+    for group in SPEC["groups"]:
+        for term in group["terms"]:
+            refs = _references(term["unit"], {})
+            names |= refs.get('field', set()) | refs.get('price', set())
+    return sorted(names)
+
+
+def _random_form(rng) -> dict:
+    """境界値（0・負・空・小数の発注数など）を混ぜた入力。"""
+    def number(low, high, integer=False):
+        roll = rng.random()
+        if roll < 0.04:
+            return ''
+        if roll < 0.08:
+            return '0'
+        if roll < 0.10:
+            return str(-rng.randint(1, 5))
+        if integer:
+            return str(rng.randint(1, 500)) if roll > 0.12 else '2.5'
+        return str(round(rng.uniform(low, high), rng.choice((0, 1, 2, 3))))
+
+    form = {
+        'client_name': rng.choice(('', '株式会社テスト様', ' 佐藤 様 ')),
+        'subject': rng.choice(('', '湯呑', ' 皿 ')),
+        'sales_price': number(50, 5000),
+        'order_quantity': number(1, 2000, integer=True),
+        'product_weight': number(10, 2000),
+        'mold_unit_price': number(0, 50000),
+        'mold_count': number(1, 20, integer=True),
+        'glaze_cost': number(0, 5000),
+        'poly_count': number(1, 50, integer=True),
+        'kiln_count': number(1, 300, integer=True),
+        'gas_unit_price': number(50, 300),
+        'loss_defective': rng.choice(('0', '0.05', '0.1', '0.125', '1', number(0, 1))),
+    }
+    for flag in d.INCLUDE_FLAGS:
+        if rng.random() < 0.6:
+            form[flag] = 'on'
+    for name in _form_fields():
+        form[name] = rng.choice(('', ' ', '0', 'abc', number(0, 500), number(0, 500), number(0, 50)))
+    return form
+
+
+BASE_FORM = {
+    'client_name': '', 'subject': '',
+    'sales_price': '1200', 'order_quantity': '100', 'product_weight': '350',
+    'mold_unit_price': '20000', 'mold_count': '2', 'glaze_cost': '800',
+    'poly_count': '10', 'kiln_count': '50', 'gas_unit_price': '120', 'loss_defective': '0.05',
+}
+
+
+def _edge_forms() -> list:
+    """0 除算・空欄・丸めの .5 になる入力（フラグは全部オンと全部オフの両方）。"""
+    variants = [{}]
+    # 割る数の 0
+    for name in ('sales_price', 'order_quantity', 'mold_count', 'poly_count', 'kiln_count'):
+        variants.append({name: '0'})
+    variants.append({'loss_defective': '1'})
+    # 空欄（1 つずつと全部）
+    for name in BASE_FORM:
+        variants.append({name: ''})
+    variants.append(dict.fromkeys(BASE_FORM, ''))
+    # 丸めの .5（偶数丸め）と小数の発注数
+    for value in ('0.5', '1.5', '2.5', '12.5', '1199.5'):
+        variants.append({'sales_price': value})
+        variants.append({'product_weight': value})
+    variants.append({'order_quantity': '2.5'})
+    variants.append({'order_quantity': '1', 'sales_price': '0.5', 'product_weight': '0.5'})
+
+    forms = []
+    for variant in variants:
+        for flags in ((), d.INCLUDE_FLAGS):
+            form = {**BASE_FORM, **variant}
+            for flag in flags:
+                form[flag] = 'on'
+            for name in _form_fields():
+                form.setdefault(name, '2.5')
+            forms.append(form)
+    return forms
+
+
+def _cases():
+    cases = [pytest.param(_edge_forms(), id='edge')]
+    for seed in SEEDS:
+        rng = random.Random(seed)
+        cases.append(pytest.param([_random_form(rng) for _ in range(COUNT)], id=f'seed{seed}'))
+    return cases
+
+
+# ----------------- 期待値（旧来の calculate_*） ----------------- #
+def _legacy(form):
+    inp = legacy.parse_input_data(form)
+    total_cost = (
+        inp["sales_price"] + inp["order_quantity"] + inp["product_weight"] +
+        inp["mold_unit_price"] + inp["mold_count"] + inp["kiln_count"] +
+        inp["gas_unit_price"] + inp["loss_defective"]
+    )
+    raw_dict = legacy.calculate_raw_material_costs(inp, form)
+    man_dict = legacy.calculate_manufacturing_costs(inp, form, raw_dict["raw_material_cost_total"])
+    sat, sar = legacy.calculate_sales_admin_cost(form, inp["order_quantity"], total_cost)
+    return legacy.round_values_in_dict(legacy.assemble_dashboard_data(inp, raw_dict, man_dict, sat, sar))
+
+
+def _outcome(fn, form):
+    try:
+        data = fn(form)
+    except (ValueError, ZeroDivisionError) as e:
+        return ('error', type(e).__name__, str(e))
+    return ('data', [(k, type(v).__name__, v) for k, v in data.items()])
+
+
+def _values(expected) -> dict:
+    return {k: v for k, _, v in expected[1]}
+
+
+@pytest.fixture(scope='module', params=_cases())
+def cases(request):
+    forms = request.param
+    return forms, [_outcome(_legacy, form) for form in forms]
+
+
+# ----------------- 突き合わせ ----------------- #
+def test_spec_matches_legacy(cases):
+    forms, expected = cases
+    mismatch = [
+        (form, want, got) for form, want in zip(forms, expected)
+        if (got := _outcome(d._compute_dashboard_data, form)) != want
+    ]
+    assert not mismatch, json.dumps(mismatch[:5], ensure_ascii=False, default=str)
+
+
+@pytest.mark.filterwarnings('error::RuntimeWarning')
+def test_batch_matches_legacy(cases):
+    forms, expected = cases
+    rows = d.compute_dashboard_batch([d._normalize_batch_row(f) for f in forms])
+    mismatch = []
+    for form, want, row in zip(forms, expected, rows):
+        # エラー行は {"error": スカラー版と同じ例外の文言}
+        if row != (_values(want) if want[0] == 'data' else {"error": want[2]}):
+            mismatch.append((form, want, row))
+    assert not mismatch, json.dumps(mismatch[:5], ensure_ascii=False, default=str)
+
+
+@pytest.mark.filterwarnings('error::RuntimeWarning')
+def test_batch_matches_scalar_with_profile(cases):
+    """係数プロファイル（定数の上書き）でもバッチ計算はスカラー版と一致する。"""
+    forms, _ = cases
+    profile = Profile(1, 'テスト', 1, {
+        'HOURLY_WAGE': 1875, 'MOLD_DIVISOR': 7, 'GASOLINE_CHARGE': 0, 'PAINT_COEFFICIENT': 0.5,
+    })
+    forms = [d._normalize_batch_row(f) for f in forms]
+    rows = d.compute_dashboard_batch(forms, profile)
+    mismatch = []
+    for form, row in zip(forms, rows):
+        try:
+            want = d._compute_dashboard_data(form, profile)
+        except (ValueError, ZeroDivisionError) as e:
+            want = {"error": str(e)}
+        if row != want:
+            mismatch.append((form, want, row))
+    assert not mismatch, json.dumps(mismatch[:5], ensure_ascii=False, default=str)
+
+
+@pytest.mark.filterwarnings('error::RuntimeWarning')
+def test_sweep_matches_scalar():
+    """スイープの各格子点は、その売価・発注数・ロス率で計算し直した結果と一致する。"""
+    form = {**BASE_FORM, **dict.fromkeys(d.INCLUDE_FLAGS, 'on')}
+    for name in _form_fields():
+        form[name] = '2.5'
+    axes = {
+        'sales_price': [300.0, 1200.0, 1199.5],
+        'order_quantity': [1, 7, 100, 2500],
+        'loss_defective': [0.0, 0.05, 0.125, 1.0],
+    }
+    inp = d.EstimateInput.from_form(form)
+    profit = {}
+    for row in d.iter_profit_surface(inp, form, axes):
+        if "break_even" in row:
+            continue
+        for loss, amount, ratio in zip(axes['loss_defective'], row["profit_amount"], row["profit_ratio"]):
+            profit[row["sales_price"], row["order_quantity"], loss] = (amount, ratio)
+
+    for (price, quantity, loss), got in profit.items():
+        data = d._compute_dashboard_data(
+            {**form, 'sales_price': str(price), 'order_quantity': str(quantity), 'loss_defective': str(loss)}
+        )
+        assert got == (data["profit_amount"], data["profit_ratio"]), (price, quantity, loss)
+    assert len(profit) == 3 * 4 * 4
+
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='node が見つかりません')
+def test_js_matches_legacy(cases):
+    forms, expected = cases
+    # ブラウザのフォームと同じ形（チェックなしは ''）
+    browser_forms = [{**dict.fromkeys(d.INCLUDE_FLAGS, ''), **f} for f in forms]
+    proc = subprocess.run(
+        [shutil.which('node'), '-e', NODE_RUNNER, FORMULA_JS],
+        input=json.dumps({"spec": SPEC, "forms": browser_forms}, ensure_ascii=False),
+        capture_output=True, text=True, check=True,
+    )
+    mismatch = []
+    for form, want, result in zip(forms, expected, json.loads(proc.stdout)):
+        if "unsupported" in result:
+            continue                    # ブラウザはサーバーに計算を任せる
+        if want[0] == 'error':
+            ok = "error" in result
+        else:
+            ok = "data" in result and result["data"] == _values(want)
+        if not ok:
+            mismatch.append((form, want, result))
+    assert not mismatch, json.dumps(mismatch[:5], ensure_ascii=False, default=str)
+
+
+def test_edge_forms_cover_errors_and_ties():
+    """固定の入力が 0 除算のエラーと丸めの .5 の両方を実際に通っていること。"""
+    outcomes = [_outcome(_legacy, form) for form in _edge_forms()]
+    assert any(o[0] == 'error' and o[1] == 'ZeroDivisionError' for o in outcomes)
+    assert any(o[0] == 'error' and o[1] == 'ValueError' for o in outcomes)
+    ties = [o for o in outcomes if o[0] == 'data' and dict((k, v) for k, _, v in o[1]).get('sales_price') in (0, 2, 12)]
+    assert ties
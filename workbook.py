@@ -0,0 +1,259 @@
+# workbook.py ―― ひな形 .xlsx に値を差し込んでブックを作る（ひな形キャッシュ）
+#
+# blueprints/export.py（ダウンロード・履歴・一括出力）から使う。
+# 一括出力のプロセスプールは spawn で起動するので、子プロセスが import するのはこのモジュールだけに
+# なるよう、Flask・DB・ジョブキューなどアプリ側のモジュールは import しない（config だけ）。
+
+from io import BytesIO
+import datetime
+import hashlib
+import os
+import re
+import threading
+import time
+import zipfile
+
+import openpyxl
+from openpyxl.cell.cell import MergedCell, ERROR_CODES, ILLEGAL_CHARACTERS_RE
+from openpyxl.utils.cell import get_column_letter
+
+import config
+
+# === 1. ひな形パス（テンプレは static/template/ に置く） ==========
+TPL_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),  # flask-project/
+    "static", "template", "estimate_template.xlsx"
+)
+
+# 差し込むセル（座標 → dashboard_data のキー。None は出力日）
+OUTPUT_CELLS = (
+    ("D3", "client_name"),
+    ("B5", "subject"),
+    ("F1", None),
+)
+
+# === 2. ひな形キャッシュ =========================================
+# 毎回 load_workbook() でひな形全体を解析していたのを、プロセス内で 1 回にする。
+# ・高速経路     : 「openpyxl が保存したひな形」の zip を骨組みとして持ち、
+#                  差し込むセルの XML だけを置き換えて書き出す（openpyxl を使わない）
+# ・openpyxl 経路 : 高速経路で扱えない値（数式扱いになる文字列など）のときだけ。
+#                  ひな形はメモリ上のバイト列から読む（Workbook は deepcopy するとスタイルが壊れる）
+# どちらも同じバイト列になる（zip の日時と docProps/core.xml の日時は出力時刻）。
+_SENTINEL = "\ue000{}\ue000"
+
+
+def _merged_index(ws) -> dict:
+    """結合範囲内の各座標 → 左上セルの座標。"""
+    index = {}
+    for rng in ws.merged_cells.ranges:
+        anchor = f"{get_column_letter(rng.min_col)}{rng.min_row}"
+        for row in range(rng.min_row, rng.max_row + 1):
+            for col in range(rng.min_col, rng.max_col + 1):
+                index[f"{get_column_letter(col)}{row}"] = anchor
+    return index
+
+
+def _xml_text(value: str) -> str:
+    # openpyxl（ElementTree で書き出し）と同じエスケープ
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _fast_path_ok(value) -> bool:
+    """openpyxl がただの文字列セルとして書く値か（それ以外は openpyxl 経路へ）。"""
+    return (
+        isinstance(value, str)
+        and len(value) <= 32767
+        and not (len(value) > 1 and value.startswith("="))
+        and value not in ERROR_CODES
+        and value == value.strip()
+        and "\r" not in value
+        and ILLEGAL_CHARACTERS_RE.search(value) is None
+    )
+
+
+class _TemplateCache:
+    """ひな形の解析結果と高速出力用の骨組み。ひな形ファイルが更新されたら作り直す。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+
+    def _ensure(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            with open(self.path, "rb") as f:
+                self.template = f.read()
+            self.fingerprint = hashlib.sha256(self.template).hexdigest()
+            self.merged = _merged_index(self._load().active)
+            self._build_skeleton()
+            self._mtime = mtime
+
+    def _load(self):
+        return openpyxl.load_workbook(BytesIO(self.template))
+
+    def template_fingerprint(self) -> str:
+        """ひな形の内容ハッシュ（ひな形が変われば blob の key も変わる）。"""
+        self._ensure()
+        return self.fingerprint
+
+    # --- openpyxl 経路 ---
+    def new_workbook(self):
+        """ひな形を開いた Workbook（ディスクは読まない）。"""
+        self._ensure()
+        return self._load()
+
+    # --- 高速経路 ---
+    def _render(self, values: dict) -> bytes:
+        wb = self._load()
+        ws = wb.active
+        for coord, value in values.items():
+            ws[coord].value = value
+        _set_full_calc(wb)
+        bio = BytesIO()
+        wb.save(bio)
+        return bio.getvalue()
+
+    def _build_skeleton(self):
+        anchors = [self.merged.get(coord, coord) for coord, _ in OUTPUT_CELLS]
+        marked = self._render({a: _SENTINEL.format(a) for a in anchors})
+        blank = self._render({a: "" for a in anchors})
+
+        entries = []
+        with zipfile.ZipFile(BytesIO(marked)) as zf:
+            for info in zf.infolist():
+                entries.append((info, zf.read(info)))
+        # 差し込み先のシート（目印の入っている XML）
+        first = _SENTINEL.format(anchors[0]).encode("utf-8")
+        sheet_name = next(info.filename for info, data in entries if first in data)
+        with zipfile.ZipFile(BytesIO(blank)) as zf:
+            blank_sheet = zf.read(sheet_name).decode("utf-8")
+
+        # sheet XML をセル単位で切り分ける
+        sheet = dict((info.filename, data) for info, data in entries)[sheet_name].decode("utf-8")
+        pieces, slots, pos = [], [], 0
+        for anchor in sorted(anchors, key=sheet.find):
+            marker = _SENTINEL.format(anchor)
+            at = sheet.index(marker)
+            empty = re.search(rf'<c r="{anchor}"[^>]*?/>', blank_sheet).group(0)
+            start = sheet.rindex(f'<c r="{anchor}"', 0, at)
+            end = sheet.index("</c>", at) + len("</c>")
+            pieces.append(sheet[pos:start])
+            slots.append((anchor, sheet[start:at], sheet[at + len(marker):end], empty))
+            pos = end
+        pieces.append(sheet[pos:])
+
+        # core.xml の作成・更新日時を出力時刻に差し替えられるようにする
+        core = dict((info.filename, data) for info, data in entries)["docProps/core.xml"].decode("utf-8")
+        core_parts = re.split(r"\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ", core)
+
+        self.entries = entries
+        self.sheet_name = sheet_name
+        self.sheet_pieces = pieces
+        self.sheet_slots = slots
+        self.core_parts = core_parts
+
+    def write_fast(self, values: dict, out) -> bool:
+        """
+        values（座標 → 文字列）を差し込んだ .xlsx を out へ書き出す。
+        骨組みが使えない値が含まれていたら False を返す（何も書かない）。
+        """
+        self._ensure()
+        if not all(_fast_path_ok(v) for v in values.values()):
+            return False
+        values = {self.merged.get(c, c): v for c, v in values.items()}
+
+        parts = []
+        for piece, (anchor, head, tail, empty) in zip(self.sheet_pieces, self.sheet_slots):
+            parts.append(piece)
+            value = values.get(anchor, "")
+            parts.append(head + _xml_text(value) + tail if value else empty)
+        parts.append(self.sheet_pieces[-1])
+        sheet = "".join(parts).encode("utf-8")
+
+        stamp = datetime.datetime.now(tz=datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        core = stamp.join(self.core_parts).encode("utf-8")
+
+        date_time = time.localtime(time.time())[:6]
+        with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            for info, data in self.entries:
+                zinfo = zipfile.ZipInfo(info.filename, date_time)
+                zinfo.compress_type = info.compress_type
+                zinfo.external_attr = info.external_attr
+                if info.filename == self.sheet_name:
+                    data = sheet
+                elif info.filename == "docProps/core.xml":
+                    data = core
+                zf.writestr(zinfo, data)
+        return True
+
+
+template_cache = _TemplateCache(TPL_PATH)
+
+
+# === 3. 結合セルでも安全に書き込むユーティリティ ================
+def set_value(ws, coord: str, value, merged: dict | None = None):
+    """
+    coord が結合セルの途中でも左上セルへ代入。
+    merged（座標 → 左上座標の索引）があれば範囲を走査せずに引く。
+    """
+    cell = ws[coord]
+    if isinstance(cell, MergedCell):
+        if merged is not None:
+            ws[merged[coord]].value = value
+            return
+        # 含まれる結合範囲を探す
+        for rng in ws.merged_cells.ranges:
+            if coord in rng:
+                ws.cell(rng.min_row, rng.min_col, value)
+                break
+    else:
+        cell.value = value
+
+
+def _set_full_calc(wb):
+    # ── 式再計算フラグ─────────────
+    if hasattr(wb, "calculation") and wb.calculation is not None:
+        # openpyxl ≥ 3.1
+        wb.calculation.fullCalcOnLoad = True
+    elif hasattr(wb, "calc_properties") and wb.calc_properties is not None:
+        # openpyxl 3.0 系
+        wb.calc_properties.fullCalcOnLoad = True
+    # ────────────────────────────────────────
+
+
+# === 4. ワークブック生成 =========================================
+def _build_workbook_openpyxl(values: dict) -> BytesIO:
+    wb = template_cache.new_workbook()
+    ws = wb.active               # 見積書シートは 1 枚目想定
+
+    for coord, value in values.items():
+        set_value(ws, coord, value, template_cache.merged)
+    _set_full_calc(wb)
+
+    # メモリへ保存
+    bio = BytesIO()
+    wb.save(bio)
+    bio.seek(0)
+    return bio
+
+
+def build_from_values(values: dict) -> BytesIO:
+    if config.EXPORT_FAST_PATH:
+        bio = BytesIO()
+        if template_cache.write_fast(values, bio):
+            bio.seek(0)
+            return bio
+    return _build_workbook_openpyxl(values)
+
+
+def build_workbook_bytes(values: dict) -> bytes:
+    """
+    一括出力のプロセスプールのワーカーが実行する入口（ひな形キャッシュはワーカープロセスごとに持つ）。
+    spawn の子はこの関数を引くためにこのモジュールだけを import する。
+    """
+    return build_from_values(values).getvalue()
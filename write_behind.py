@@ -0,0 +1,361 @@
+# write_behind.py ―― リクエストの外でまとめて書く（write-behind）
+#
+# ・CoalescingWriter : 同じキー（ユーザーなど）への書き込みが短時間に続いたとき、
+#                      最後の値だけを delay 秒後に 1 回書く
+# ・BatchWriter      : 行をためて executemany でまとめて書く（spool ファイルで取りこぼさない。
+#                      何度やっても書けない行は切り離して dead-letter ファイルへ）
+# 書き込みは専用スレッドで行うのでリクエストは DB を待たない。
+# プロセス終了時には残っている分を書き切る。
+
+import atexit
+import fcntl
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class CoalescingWriter:
+    """
+    submit(key, value) された値を key ごとに 1 つだけ保持し、
+    最初の submit から delay 秒たったら write(key, value) を呼ぶ。
+    """
+
+    def __init__(self, write, delay: float, name: str = 'write-behind'):
+        self.write = write
+        self.delay = delay
+        self._pending = {}              # key -> (deadline, value)
+        self._cond = threading.Condition()
+        self.submitted = 0
+        self.written = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def submit(self, key, value):
+        with self._cond:
+            entry = self._pending.get(key)
+            # 締め切りは最初の submit から数える（書き込みが先送りされ続けないように）
+            deadline = entry[0] if entry else time.monotonic() + self.delay
+            self._pending[key] = (deadline, value)
+            self.submitted += 1
+            self._cond.notify()
+
+    def _take_due(self, now: float) -> list:
+        due = [(k, v) for k, (deadline, v) in self._pending.items() if deadline <= now]
+        for key, _ in due:
+            del self._pending[key]
+        return due
+
+    def _write_all(self, items):
+        written = failed = 0
+        for key, value in items:
+            try:
+                self.write(key, value)
+                written += 1
+            except Exception:   # noqa: BLE001  （1 件の失敗で他を止めない）
+                failed += 1
+                logger.exception('write-behind failed for %r', key)
+        with self._cond:
+            self.written += written
+            self.failed += failed
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                now = time.monotonic()
+                due = self._take_due(now)
+                if not due:
+                    next_deadline = min(d for d, _ in self._pending.values())
+                    self._cond.wait(next_deadline - now)
+                    continue
+            self._write_all(due)
+
+    def flush(self):
+        """保留中の値を今すぐ書く（終了時・テスト用）。"""
+        with self._cond:
+            items = [(k, v) for k, (_, v) in self._pending.items()]
+            self._pending.clear()
+        self._write_all(items)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "pending": len(self._pending),
+                "submitted": self.submitted,
+                "written": self.written,
+                "failed": self.failed,
+            }
+
+
+# ----------------- 行をまとめて書く（spool 付き） ----------------- #
+class WriteBehindFull(RuntimeError):
+    """キューが上限に達していて、待っても空かなかった。"""
+
+
+class _Spool:
+    """
+    まだ DB に書けていない行を残しておく追記専用ファイル（1 行 1 JSON）。
+    プロセスごとに <dir>/<name>.<pid>.<乱数>.spool を作り、使っている間は flock で押さえる。
+    ロックの取れる spool は落ちたプロセスの残りなので、起動時に読み直す。
+    """
+
+    def __init__(self, directory: str, name: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.name = name
+        self.path = os.path.join(directory, f"{name}.{os.getpid()}.{secrets.token_hex(4)}.spool")
+        self._f = open(self.path, 'a+', encoding='utf-8')
+        fcntl.flock(self._f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def append(self, seq: int, row):
+        self._f.write(json.dumps([seq, row], ensure_ascii=False) + '\n')
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def ack(self, seq: int):
+        """seq までを書き終えた印（spool を切り詰めてよいかの判定に使う）。"""
+        self._f.write(json.dumps(['ack', seq]) + '\n')
+        self._f.flush()
+
+    def truncate(self):
+        self._f.seek(0)
+        self._f.truncate()
+
+    def dead_letter(self, rows):
+        """書けない行を <dir>/<name>.dead に追記する（起動時に読み直さない。調べてから手で戻す）。"""
+        path = os.path.join(self.directory, f"{self.name}.dead")
+        with open(path, 'a', encoding='utf-8') as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _read(path: str) -> list:
+        rows, acked = {}, 0
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    head, body = json.loads(line)
+                except ValueError:
+                    continue        # 書きかけの最終行
+                if head == 'ack':
+                    acked = max(acked, body)
+                else:
+                    rows[head] = body
+        return [row for seq, row in sorted(rows.items()) if seq > acked]
+
+    def recover(self) -> list:
+        """他プロセスが残した spool から未書き込みの行を取り出し、そのファイルを消す。"""
+        recovered = []
+        for entry in os.scandir(self.directory):
+            if (not entry.name.startswith(self.name + '.') or not entry.name.endswith('.spool')
+                    or entry.path == self.path):
+                continue
+            with open(entry.path, 'a+', encoding='utf-8') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue        # 生きているプロセスが使用中
+                recovered.extend(self._read(entry.path))
+                os.remove(entry.path)
+        return recovered
+
+    def close(self):
+        self._f.close()
+
+
+class BatchWriter:
+    """
+    submit(row) された行をためて、max_rows 行たまるか interval 秒たったら
+    write_batch(rows) でまとめて書く。
+    ・キューは max_queue 行まで。溢れたら最大 put_timeout 秒待ち、空かなければ WriteBehindFull
+    ・spool_dir を渡すと受け付けた行をファイルにも残し、書けたら ack する（少なくとも 1 回）
+    ・書き込みに失敗した行はキューの先頭に戻して、少し待ってから再試行する
+    ・transient の例外（接続断など）は何度でも再試行する。それ以外の失敗が max_retries 回
+      続いたバッチは半分ずつに分けて書き直し、1 行でも書けない行は dead-letter に回す
+      （spool があれば <name>.dead へ、無ければログに残して捨てる）。後続の行は止めない
+    """
+
+    def __init__(self, write_batch, max_rows: int, interval: float, max_queue: int,
+                 spool_dir: str | None = None, name: str = 'batch-writer',
+                 put_timeout: float = 1.0, retry_delay: float = 1.0,
+                 max_retries: int = 3, transient: tuple = ()):
+        self.write_batch = write_batch
+        self.max_rows = max_rows
+        self.interval = interval
+        self.max_queue = max_queue
+        self.put_timeout = put_timeout
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+        self.transient = transient
+        self._attempts = 0              # 先頭のバッチが transient 以外で続けて失敗した回数
+        self._queue = deque()           # (seq, row)
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._seq = 0
+        self._spool = _Spool(spool_dir, name) if spool_dir else None
+        # metrics
+        self.submitted = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.failures = 0
+        self.isolations = 0
+        self.dead_lettered = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+        if self._spool is not None:
+            for row in self._spool.recover():
+                self._enqueue(row)
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _enqueue(self, row):
+        self._seq += 1
+        if self._spool is not None:
+            self._spool.append(self._seq, row)
+        self._queue.append((self._seq, row))
+
+    def submit(self, row):
+        with self._cond:
+            deadline = time.monotonic() + self.put_timeout
+            while len(self._queue) >= self.max_queue:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise WriteBehindFull('write-behind queue is full')
+                self._cond.wait(remaining)
+            self._enqueue(row)
+            self.submitted += 1
+            if len(self._queue) >= self.max_rows:
+                self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._queue) < self.max_rows:
+                    self._cond.wait(self.interval)
+            if not self.flush_once():
+                time.sleep(self.retry_delay)
+
+    def flush_once(self) -> bool:
+        """最大 max_rows 行を書く。書けずにキューへ戻した行があれば False。"""
+        with self._flush_lock:
+            with self._cond:
+                batch = [self._queue.popleft()
+                         for _ in range(min(self.max_rows, len(self._queue)))]
+                self._cond.notify_all()
+            if not batch:
+                return True
+
+            started = time.perf_counter()
+            dead = []
+            try:
+                self.write_batch([row for _, row in batch])
+            except Exception as e:   # noqa: BLE001  （行は捨てずに再試行する）
+                logger.exception('batch write failed (%d rows)', len(batch))
+                if isinstance(e, self.transient) or self._attempts < self.max_retries:
+                    if not isinstance(e, self.transient):
+                        self._attempts += 1
+                    self._requeue(batch)
+                    return False
+                # 同じバッチが何度やっても書けない：分けて書き、書けない行だけを切り離す
+                dead, rest = self._write_isolated(batch)
+                with self._cond:
+                    self.isolations += 1
+                self._dead_letter(dead)
+                if rest:
+                    self._requeue(rest)
+                    return False
+            self._attempts = 0
+            elapsed = (time.perf_counter() - started) * 1000
+
+            with self._cond:
+                self.flushes += 1
+                self.rows_written += len(batch) - len(dead)
+                self.last_flush_ms = elapsed
+                self.max_flush_ms = max(self.max_flush_ms, elapsed)
+                self.total_flush_ms += elapsed
+                if self._spool is not None:
+                    if self._queue:
+                        self._spool.ack(batch[-1][0])
+                    else:
+                        self._spool.truncate()
+            return True
+
+    def _requeue(self, items):
+        with self._cond:
+            self._queue.extendleft(reversed(items))
+            self.failures += 1
+
+    def _write_isolated(self, batch):
+        """
+        batch を半分ずつに分けて書き、(1 行でも書けなかった項目, 未書き込みの項目) を返す。
+        途中で transient の失敗が起きたら、その時点で書いていない分を未書き込みとして返す。
+        """
+        dead = []
+        pending = [batch]               # 後ろから取り出す（前半を先に書く）
+        while pending:
+            part = pending.pop()
+            try:
+                self.write_batch([row for _, row in part])
+            except self.transient:
+                rest = part + [item for p in pending for item in p]
+                return dead, sorted(rest, key=lambda item: item[0])
+            except Exception:   # noqa: BLE001
+                if len(part) == 1:
+                    dead.extend(part)
+                else:
+                    mid = len(part) // 2
+                    pending.append(part[mid:])
+                    pending.append(part[:mid])
+        return dead, []
+
+    def _dead_letter(self, items):
+        if not items:
+            return
+        rows = [row for _, row in items]
+        logger.error('dropping %d unwritable rows to dead-letter: %r', len(rows), rows)
+        if self._spool is not None:
+            self._spool.dead_letter(rows)
+        with self._cond:
+            self.dead_lettered += len(rows)
+
+    def flush(self):
+        """キューが空になるまで書く（失敗したらそこでやめる）。"""
+        while self._queue:
+            if not self.flush_once():
+                return False
+        return True
+
+    def close(self):
+        """終了時の同期フラッシュ。書けなかった行は spool に残り、次回の起動で書く。"""
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "queue_depth": len(self._queue),
+                "max_queue": self.max_queue,
+                "submitted": self.submitted,
+                "flushes": self.flushes,
+                "rows_written": self.rows_written,
+                "failures": self.failures,
+                "isolations": self.isolations,
+                "dead_lettered": self.dead_lettered,
+                "last_flush_ms": round(self.last_flush_ms, 3),
+                "max_flush_ms": round(self.max_flush_ms, 3),
+                "avg_flush_ms": round(self.total_flush_ms / self.flushes, 3) if self.flushes else 0.0,
+            }